@@ -6,7 +6,13 @@
 # Copyright 2007,, Frank Scholz <coherence@beebits.net>
 from lxml import etree
 
+import os
+import json
 import time
+
+from twisted.internet import defer, reactor
+from twisted.python import failure, reflect
+
 from coherence.extern.simple_plugin import Plugin
 
 from coherence import log
@@ -284,6 +290,17 @@ class BackendItem(log.Loggable):
         """
         return self.cover
 
+    def get_cache_data(self):
+        """ called by a LazyContainer keeping its children in a
+            ChildrenCache
+            should return
+
+            - the arguments (args, kwargs) to create that item again,
+              the parent left out for a Container
+            - or None, if the item can't be created from them
+        """
+        return None
+
     def __repr__(self):
         return "%s[%s]" % (self.__class__.__name__, self.get_name())
 
@@ -411,14 +428,113 @@ class Container(BackendItem):
         return self.update_id
 
 
+def _utf8(value):
+    """ the strings json.load returned as str again """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_utf8(v) for v in value]
+    if isinstance(value, dict):
+        return dict((_utf8(k), _utf8(v)) for k, v in value.items())
+    return value
+
+
+class ChildrenCache(log.Loggable):
+    """
+    The children of the LazyContainers of a store, kept in a file so
+    after a restart they are browsed before the network is asked again.
+
+    A container is stored under its cache key with the time it was
+    retrieved and, per child, its external id, class and the arguments
+    BackendItem.get_cache_data returned.
+    """
+    logCategory = 'children_cache'
+
+    directory = os.path.expanduser('~/.cache/coherence/children')
+    # seconds to collect changes before saving them
+    save_delay = 5
+
+    def __init__(self, name, reactor=reactor):
+        log.Loggable.__init__(self)
+        self.name = name
+        self.reactor = reactor
+        self.containers = None
+        self._save_call = None
+
+    def path(self):
+        return os.path.join(self.directory, self.name + '.json')
+
+    def get(self, key):
+        """ (last_updated, children) stored for key, or None """
+        if self.containers is None:
+            self.load()
+        entry = self.containers.get(key)
+        if entry is None:
+            return None
+        return entry['last_updated'], entry['children']
+
+    def put(self, key, last_updated, children):
+        if self.containers is None:
+            self.load()
+        self.containers[key] = {'last_updated': last_updated,
+                                'children': children}
+        if self._save_call is None:
+            self._save_call = self.reactor.callLater(self.save_delay, self.save)
+
+    def load(self):
+        try:
+            with open(self.path()) as f:
+                self.containers = _utf8(json.load(f))
+        except (IOError, ValueError):
+            self.containers = {}
+        self.reactor.addSystemEventTrigger('before', 'shutdown', self.save)
+
+    def save(self):
+        if self._save_call is not None:
+            if self._save_call.active():
+                self._save_call.cancel()
+            self._save_call = None
+        if self.containers is None:
+            return
+        path = self.path()
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(path + '.part', 'w') as f:
+                json.dump(self.containers, f)
+            os.rename(path + '.part', path)
+        except (IOError, OSError, TypeError, ValueError), msg:
+            self.warning("saving the children of %s failed: %s", self.name, msg)
+
+
 class LazyContainer(Container):
     logCategory = 'lazyContainer'
 
+    # seconds before a failed retrieval is tried again,
+    # doubled with every further failure
+    retry_backoff = 10
+    max_retry_backoff = 600
+
+    # pages of a paged retriever requested ahead of the ones still
+    # missing, set from the prefetch_pages option of the store
+    prefetch_pages = 2
+
+    # the key of the children in the ChildrenCache of the store,
+    # derived from the parent's key and the external id if None
+    cache_key = None
+
     def __init__(self, parent, title, external_id=None, refresh=0, childrenRetriever=None, **kwargs):
         Container.__init__(self, parent, title)
 
         self.childrenRetrievingNeeded = True
+        # the Deferreds waiting for the campaign in progress
         self.childrenRetrievingDeferred = None
+        # a campaign succeeded, there are children to serve while refreshing
+        self.children_retrieved = False
+        self.retrieval_failures = 0
+        self.retry_at = 0
+        self.children_restored = False
+        self.children_staged = False
         self.childrenRetriever = childrenRetriever
         self.children_retrieval_campaign_in_progress = False
         self.childrenRetriever_params = kwargs
@@ -440,7 +556,13 @@ class LazyContainer(Container):
 
     def add_child(self, child, external_id=None, update=True):
         if self.children_retrieval_campaign_in_progress is True:
-            self.retrieved_children[external_id] = child
+            if self.children_staged is True:
+                self.retrieved_children[external_id] = child
+                return
+            if external_id is not None and external_id in self.children_by_external_id:
+                # a page retried
+                return
+            Container.add_child(self, child, external_id=external_id, update=update)
         else:
             Container.add_child(self, child, external_id=external_id, update=update)
 
@@ -491,64 +613,300 @@ class LazyContainer(Container):
         self.last_updated = time.time()
         self.retrieved_children = {}
         self.children_retrieval_campaign_in_progress = True
+        # the first campaign adds the children right away, so the
+        # pages in are browsed while the rest is retrieved, later ones
+        # collect them to replace the children served meanwhile
+        self.children_staged = self.children_retrieved
 
     def end_children_retrieval_campaign(self, success=True):
         self.children_retrieval_campaign_in_progress = False
         if success is True:
-            self.update_children(self.retrieved_children, self.children_by_external_id)
+            if self.children_staged is True:
+                self.update_children(self.retrieved_children, self.children_by_external_id)
             self.update_id += 1
         self.last_updated = time.time()
         self.retrieved_children = {}
+        self.children_staged = False
 
     def retrieve_children(self, start=0, page=0):
+        """ retrieve the children, from page on if the retriever is paged,
+            returns a Deferred firing after the last page
+        """
+        ahead = 0
+        semaphore = None
+        if self.has_pages is True and self.store is not None:
+            ahead = getattr(self.store, 'prefetch_pages', self.prefetch_pages)
+            semaphore = getattr(self.store, 'page_requests', None)
+        return PagedRetrieval(self, start, page, ahead, semaphore).begin()
+
+    def retrieve_all_children(self, start=0, request_count=0):
+        """ refresh the children, a Deferred firing with them afterwards
 
-        def items_retrieved(result, page, start_offset):
-            if self.childrenRetrievingNeeded is True:
-                new_offset = len(self.retrieved_children)
-                return self.retrieve_children(new_offset, page + 1)  # we try the next page
-            return self.retrieved_children
-
-        self.childrenRetrievingNeeded = False
-        if self.has_pages is True:
-            self.childrenRetriever_params['offset'] = start
-            self.childrenRetriever_params['page'] = page
-        d = self.childrenRetriever(**self.childrenRetriever_params)
-        d.addCallback(items_retrieved, page, start)
+            concurrent calls share the one campaign in progress
+        """
+        d = self.refresh_children(start, request_count)
+        d.addCallback(lambda _: Container.get_children(self, start, request_count))
         return d
 
-    def retrieve_all_children(self, start=0, request_count=0):
+    def refresh_children(self, start=0, request_count=0):
+        """ returns a Deferred firing once the campaign in progress, or a
+            new one if there is none, has ended
+
+            with a request_count it fires as soon as the first campaign
+            has retrieved the children from start to start + request_count
+        """
+        d = defer.Deferred()
+        needed = None
+        if request_count > 0:
+            needed = start + request_count
+        if self.childrenRetrievingDeferred is not None:
+            self.childrenRetrievingDeferred.append((d, needed))
+            return d
+        self.childrenRetrievingDeferred = [(d, needed)]
 
         def all_items_retrieved(result):
             self.end_children_retrieval_campaign(True)
-            return super(LazyContainer, self).get_children(start, request_count)
+            self.retrieval_failures = 0
+            self.retry_at = 0
+            self.children_retrieved = True
+            self.cache_children()
 
         def error_while_retrieving_items(error):
             self.end_children_retrieval_campaign(False)
-            return super(LazyContainer, self).get_children(start, request_count)
+            self.retrieval_failures += 1
+            backoff = min(self.retry_backoff * 2 ** (self.retrieval_failures - 1),
+                          self.max_retry_backoff)
+            self.warning("retrieving the children of %r failed, retrying in %d s: %s",
+                         self.name, backoff, error.getErrorMessage())
+            self.retry_at = time.time() + backoff
+            self.childrenRetrievingNeeded = True
+
+        def done(result):
+            if isinstance(result, failure.Failure):
+                # updating the children failed, the callers get the
+                # ones we have
+                error_while_retrieving_items(result)
+            waiting, self.childrenRetrievingDeferred = self.childrenRetrievingDeferred, None
+            for w, needed in waiting:
+                w.callback(None)
 
         self.start_children_retrieval_campaign()
         if self.childrenRetriever is not None:
-            d = self.retrieve_children(start)
-            if start == 0:
-                d.addCallbacks(all_items_retrieved, error_while_retrieving_items)
-            return d
+            r = defer.maybeDeferred(self.retrieve_children, 0)
+            r.addCallbacks(all_items_retrieved, error_while_retrieving_items)
         else:
-            self.end_children_retrieval_campaign()
-            return self.children
+            r = defer.succeed(None)
+            r.addCallback(all_items_retrieved)
+        r.addBoth(done)
+        return d
+
+    def page_retrieved(self):
+        """ answer the callers waiting for children the first campaign
+            has retrieved by now
+        """
+        if self.children_staged is True or self.childrenRetrievingDeferred is None:
+            return
+        answered = [(d, needed) for d, needed in self.childrenRetrievingDeferred
+                    if needed is not None and len(self.children) >= needed]
+        if not answered:
+            return
+        self.childrenRetrievingDeferred = [w for w in self.childrenRetrievingDeferred
+                                           if w not in answered]
+        for d, needed in answered:
+            d.callback(None)
+
+    def get_cache_key(self):
+        if self.cache_key is not None:
+            return self.cache_key
+        if isinstance(self.parent, LazyContainer) and self.external_id is not None:
+            parent_key = self.parent.get_cache_key()
+            if parent_key is not None:
+                return '%s/%s' % (parent_key, self.external_id)
+        return None
+
+    def get_children_cache(self):
+        if self.store is None:
+            return None
+        return getattr(self.store, 'children_cache', None)
+
+    def cache_children(self):
+        """ store the children retrieved, if all of them can be """
+        cache = self.get_children_cache()
+        key = self.get_cache_key()
+        if cache is None or key is None:
+            return
+        records = []
+        for external_id, child in self.children_by_external_id.items():
+            data = child.get_cache_data()
+            if data is None:
+                self.debug("%r can't be cached, not caching %s", child, key)
+                return
+            args, kwargs = data
+            records.append([external_id, reflect.qual(child.__class__), list(args), kwargs])
+        if len(records) != len(self.children):
+            return
+        cache.put(key, self.last_updated, records)
+
+    def restore_children(self):
+        """ add the children cached from an earlier run, they are
+            served while the first retrieval runs
+        """
+        if self.children_restored is True or self.store is None:
+            return
+        self.children_restored = True
+        cache = self.get_children_cache()
+        key = self.get_cache_key()
+        if cache is None or key is None or self.children_retrieved is True:
+            return
+        cached = cache.get(key)
+        if cached is None:
+            return
+        last_updated, records = cached
+        children = []
+        try:
+            for external_id, qual, args, kwargs in records:
+                if external_id in self.children_by_external_id:
+                    continue
+                cls = reflect.namedAny(qual)
+                if issubclass(cls, Container):
+                    child = cls(self, *args, **kwargs)
+                else:
+                    child = cls(*args, **kwargs)
+                children.append((external_id, child))
+        except Exception, msg:
+            self.warning("restoring the cached children of %s failed: %s", key, msg)
+            return
+        for external_id, child in children:
+            Container.add_child(self, child, external_id=external_id, update=False)
+        self.info("restored %d children of %s", len(children), key)
+        self.children_retrieved = True
+        self.last_updated = last_updated
+        self.update_id += 1
+
+    def get_child_count(self):
+        self.restore_children()
+        return Container.get_child_count(self)
+
+    def get_item(self):
+        self.restore_children()
+        return Container.get_item(self)
 
     def get_children(self, start=0, request_count=0):
+        self.restore_children()
 
         # Check if an update is needed since last update
         current_time = time.time()
         delay_since_last_updated = current_time - self.last_updated
         period = self.refresh
-        if (period > 0) and (delay_since_last_updated > period):
+        if (period > 0) and (delay_since_last_updated > period) and \
+           self.childrenRetrievingDeferred is None:
             self.info("Last update is older than %d s -> update data", period)
             self.childrenRetrievingNeeded = True
 
-        if self.childrenRetrievingNeeded is True:
-            return self.retrieve_all_children(start, request_count)
-        return Container.get_children(self, start, request_count)
+        if self.childrenRetrievingDeferred is None:
+            if self.childrenRetrievingNeeded is not True or current_time < self.retry_at:
+                return Container.get_children(self, start, request_count)
+        if self.children_retrieved is True:
+            # stale while revalidate, the callers get the
+            # previous children while the campaign runs
+            if self.childrenRetrievingDeferred is None:
+                self.refresh_children()
+            return Container.get_children(self, start, request_count)
+        return self.retrieve_all_children(start, request_count)
+
+
+class PagedRetrieval(object):
+    """
+    The pages of a retrieval campaign of a LazyContainer.
+
+    The retriever sets childrenRetrievingNeeded of the container when
+    there is a page after the one it was asked for. Once the first page
+    is in, its size gives the offsets of the next ones, and up to ahead
+    pages are requested beyond the ones still missing, through the
+    semaphore of the store if it has one. A page beyond the last is of
+    no harm, its failure is ignored.
+    """
+
+    def __init__(self, container, start=0, page=0, ahead=0, semaphore=None):
+        self.container = container
+        self.start = start
+        self.first = page
+        self.ahead = ahead
+        self.semaphore = semaphore
+        self.next = page
+        self.last = None
+        self.page_size = None
+        self.running = set()
+        self.failed = {}
+        self.finished = defer.Deferred()
+
+    def begin(self):
+        self.request(self.first)
+        return self.finished
+
+    def count(self):
+        container = self.container
+        if container.children_staged is True:
+            return len(container.retrieved_children)
+        return len(container.children)
+
+    def request(self, page):
+        container = self.container
+        self.next = page + 1
+        self.running.add(page)
+        params = dict(container.childrenRetriever_params)
+        if container.has_pages is True:
+            params['page'] = page
+            if page == self.first:
+                params['offset'] = self.start
+            else:
+                params['offset'] = self.start + (page - self.first) * self.page_size
+
+        def call():
+            before = self.count()
+            container.childrenRetrievingNeeded = False
+            d = defer.maybeDeferred(container.childrenRetriever, **params)
+            # retrievers knowing it already tell about the next page
+            # right away, the others in their callback, just before ours
+            more = container.childrenRetrievingNeeded
+            container.childrenRetrievingNeeded = False
+            d.addBoth(self.retrieved, page, more, before)
+            return d
+
+        if self.semaphore is not None:
+            self.semaphore.run(call)
+        else:
+            call()
+
+    def retrieved(self, result, page, more, before):
+        container = self.container
+        more = more or container.childrenRetrievingNeeded
+        container.childrenRetrievingNeeded = False
+        self.running.discard(page)
+        if page == self.first:
+            self.page_size = max(self.count() - before, 1)
+        if isinstance(result, failure.Failure):
+            self.failed[page] = result
+            more = False
+        if not more and (self.last is None or page < self.last):
+            self.last = page
+        container.page_retrieved()
+        self.fill()
+
+    def fill(self):
+        if self.last is None and self.page_size is not None:
+            ahead = 0
+            if self.container.has_pages is True:
+                ahead = self.ahead
+            missing = min(self.running or [self.next])
+            while self.last is None and self.next <= missing + ahead:
+                self.request(self.next)
+        if self.last is not None and not self.running and not self.finished.called:
+            failures = [f for page, f in sorted(self.failed.items()) if page <= self.last]
+            if failures:
+                self.finished.errback(failures[0])
+            else:
+                self.finished.callback(self.container.retrieved_children)
 
 ROOT_CONTAINER_ID = 0
 SEED_ITEM_ID = 1000
@@ -560,6 +918,17 @@ class AbstractBackendStore (BackendStore):
         self.next_id = SEED_ITEM_ID
         self.store = {}
 
+        self.children_cache = None
+        if kwargs.get('children_cache', 'no') in [1, 'Yes', 'yes', 'True', 'true']:
+            name = self.__class__.__name__
+            if kwargs.get('uuid'):
+                name += '-' + kwargs['uuid'].replace(':', '_').replace('/', '_')
+            self.children_cache = ChildrenCache(name)
+
+        self.prefetch_pages = int(kwargs.get('prefetch_pages', LazyContainer.prefetch_pages))
+        # page requests of the LazyContainers running at once
+        self.page_requests = defer.DeferredSemaphore(int(kwargs.get('max_page_requests', 2)))
+
     def len(self):
         return len(self.store)
 
@@ -12,8 +12,7 @@ from lxml import etree
 
 from coherence.backend import BackendItem, BackendStore
 from coherence.upnp.core import DIDLLite
-from coherence.upnp.core.utils import ReverseProxyUriResource
-from twisted.web import client
+from coherence.upnp.core.utils import ReverseProxyUriResource, getPage
 from twisted.internet import task, reactor
 
 XML_URL = "http://www.apple.com/trailers/home/xml/current.xml"
@@ -114,8 +113,8 @@ class AppleTrailersStore(BackendStore):
         return result
 
     def update_data(self):
-        dfr = client.getPage(XML_URL)
-        dfr.addCallback(etree.fromstring)
+        dfr = getPage(XML_URL)
+        dfr.addCallback(lambda result: etree.fromstring(result[0]))
         dfr.addCallback(self.parse_data)
         dfr.addCallback(self.queue_update)
         return dfr
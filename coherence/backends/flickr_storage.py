@@ -1007,7 +1007,8 @@ class FlickrStore(BackendStore):
             self.info(error)
             return failure.Failure(errorCode(718))
 
-        d = getPage(SourceURI)
+        # the whole photo, no timeout
+        d = getPage(SourceURI, timeout=0)
         d.addCallbacks(gotPage, gotError, None, None, [SourceURI], None)
 
         transfer_id = 0  # FIXME
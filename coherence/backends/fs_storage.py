@@ -7,7 +7,6 @@
 
 import os
 import stat
-import glob
 import tempfile
 import shutil
 import time
@@ -40,6 +39,8 @@ from coherence.upnp.core.DIDLLite import simple_dlna_tags
 from coherence.upnp.core.soap_service import errorCode
 
 from coherence.upnp.core import utils
+from coherence.upnp.core.streaming import open_files
+from coherence import thumbnails
 
 #FIXME: doesn't work, migrate to twisted.inotify
 try:
@@ -70,25 +71,119 @@ class NoThumbnailFound(Exception):
     """no thumbnail found"""
 
 
-def _find_thumbnail(filename, thumbnail_folder='.thumbs'):
-    """ looks for a thumbnail file of the same basename
-        in a folder named '.thumbs' relative to the file
+def _thumbnail_pn(mimetype):
+    if mimetype == 'image/jpeg':
+        return 'DLNA.ORG_PN=JPEG_TN'
+    return 'DLNA.ORG_PN=PNG_TN'
 
-        returns the filename of the thumb, its mimetype and the correspondig DLNA PN string
-        or throws an Exception otherwise
+
+class DirectoryIndex(object):
+    """ the sidecar files of a directory - its cover, the captions and the
+        contents of its thumbnail folder - taken from a single listing
+
+        names is the listing itself, kept until the walk takes it
     """
-    name, ext = os.path.splitext(os.path.basename(filename))
-    pattern = os.path.join(os.path.dirname(filename), thumbnail_folder, name + '.*')
-    for f in glob.glob(pattern):
-        mimetype, _ = mimetypes.guess_type(f, strict=False)
-        if mimetype in ('image/jpeg', 'image/png'):
-            if mimetype == 'image/jpeg':
-                dlna_pn = 'DLNA.ORG_PN=JPEG_TN'
-            else:
-                dlna_pn = 'DLNA.ORG_PN=PNG_TN'
-            return os.path.abspath(f), mimetype, dlna_pn
-    else:
-        raise NoThumbnailFound()
+
+    def __init__(self, path, thumbnail_folder='.thumbs'):
+        self.path = path
+        self.thumbnail_folder = thumbnail_folder
+        # taken before the listing, a change while listing is seen
+        self.mtimes = self._mtimes()
+        self.names = os.listdir(path)
+        self.cover = None
+        jpgs = [name for name in self.names if os.path.splitext(name)[1] in ('.jpg', '.JPG')]
+        pngs = [name for name in self.names if os.path.splitext(name)[1] in ('.png', '.PNG')]
+        if jpgs or pngs:
+            self.cover = os.path.join(path, (jpgs or pngs)[0])
+        self.captions = set(name for name in self.names if name.endswith('.srt'))
+        # basename -> (filename, mimetype, dlna_pn)
+        self.thumbnails = {}
+        if thumbnail_folder in self.names:
+            folder = os.path.join(path, thumbnail_folder)
+            try:
+                names = os.listdir(folder)
+            except OSError:
+                names = []
+            for name in names:
+                mimetype, _ = mimetypes.guess_type(name, strict=False)
+                if mimetype in ('image/jpeg', 'image/png'):
+                    basename = os.path.splitext(name)[0]
+                    if basename not in self.thumbnails:
+                        self.thumbnails[basename] = (os.path.abspath(os.path.join(folder, name)),
+                                                     mimetype, _thumbnail_pn(mimetype))
+
+    def _mtimes(self):
+        mtimes = []
+        for path in (self.path, os.path.join(self.path, self.thumbnail_folder)):
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def changed(self):
+        """ whether a file was added or removed since the listing """
+        return self._mtimes() != self.mtimes
+
+    def take_names(self):
+        names, self.names = self.names, None
+        return names
+
+    def thumbnail(self, filename):
+        """ the thumbnail of filename in the thumbnail folder, a file of
+            the same basename, as its path, mimetype and DLNA PN string,
+            raises L{NoThumbnailFound} if there is none """
+        name, ext = os.path.splitext(os.path.basename(filename))
+        try:
+            return self.thumbnails[name]
+        except KeyError:
+            raise NoThumbnailFound()
+
+    def caption(self, filename):
+        """ the path of the .srt file of filename, None if there is none """
+        name, ext = os.path.splitext(os.path.basename(filename))
+        if name + '.srt' in self.captions:
+            return os.path.join(self.path, name + '.srt')
+        return None
+
+
+class SidecarIndex(object):
+    """ the L{DirectoryIndex} of every directory, so that creating the
+        items of a directory doesn't list it over and over again
+
+        an index is dropped on every inotify event in its directory
+        and built again when asked for next time. Without inotify,
+        check_mtime is set and an index is built again once the
+        modification time of its directory or thumbnail folder changed
+    """
+
+    check_mtime = False
+
+    def __init__(self):
+        self.directories = {}
+
+    def get(self, path):
+        index = self.directories.get(path)
+        if index is None or (self.check_mtime and index.changed()):
+            index = self.directories[path] = DirectoryIndex(path)
+        return index
+
+    def children(self, path):
+        """ the names in the directory, from the listing the index was
+            built from if that is still around """
+        names = self.get(path).take_names()
+        if names is None:
+            names = os.listdir(path)
+        return names
+
+    def thumbnail(self, filename):
+        return self.get(os.path.dirname(filename)).thumbnail(filename)
+
+    def caption(self, filename):
+        return self.get(os.path.dirname(filename)).caption(filename)
+
+    def invalidate(self, path):
+        self.directories.pop(path, None)
 
 
 class FSItem(BackendItem):
@@ -137,11 +232,6 @@ class FSItem(BackendItem):
             if(isinstance(self.location, FilePath) and
                self.location.isdir() == True):
                 self.check_for_cover_art()
-                if getattr(self, 'cover', None):
-                    _, ext = os.path.splitext(self.cover)
-                    """ add the cover image extension to help clients not reacting on
-                        the mimetype """
-                    self.item.albumArtURI = ''.join((urlbase, str(self.id), '?cover', ext))
         else:
             self.get_url = lambda: self.url
 
@@ -249,8 +339,9 @@ class FSItem(BackendItem):
 
             if(self.mimetype in ('image/jpeg', 'image/png') or
                self.mimetype.startswith('video/')):
+                found = None
                 try:
-                    filename, mimetype, dlna_pn = _find_thumbnail(self.get_path())
+                    filename, mimetype, dlna_pn = self.store.sidecars.thumbnail(self.get_path())
                 except NoThumbnailFound:
                     pass
                 except:
@@ -267,12 +358,16 @@ class FSItem(BackendItem):
                     if not hasattr(self.item, 'attachments'):
                         self.item.attachments = {}
                     self.item.attachments[hash_from_path] = utils.StaticFile(filename)
+                    found = dlna_pn.split('=')[1]
+
+                service = getattr(self.store, 'thumbnails', None)
+                if service is not None:
+                    self.add_thumbnails(service, exclude=found)
 
             if self.mimetype.startswith('video/'):
                 # check for a subtitles file
-                caption, _ = os.path.splitext(self.get_path())
-                caption = caption + '.srt'
-                if os.path.exists(caption):
+                caption = self.store.sidecars.caption(self.get_path())
+                if caption is not None:
                     hash_from_path = str(id(caption))
                     mimetype = 'smi/caption'
                     new_res = Resource(self.url + '?attachment=' + hash_from_path,
@@ -290,6 +385,36 @@ class FSItem(BackendItem):
             except:
                 self.item.date = None
 
+    def add_thumbnails(self, service, exclude=None):
+        """ add the renditions of the thumbnail service, a res for every
+            DLNA profile, rendered on demand or in the background
+
+            nothing is looked up on the disk, the service lists its
+            cache once and the location was stat'ed for the size already """
+        path = self.get_path()
+        try:
+            mtime = self.location.getmtime()
+        except OSError:
+            return
+        dlna_tags = simple_dlna_tags[:]
+        dlna_tags[3] = 'DLNA.ORG_FLAGS=00f00000000000000000000000000000'
+        if not hasattr(self.item, 'attachments'):
+            self.item.attachments = {}
+        for profile in service.profiles(self.mimetype):
+            if profile == exclude:
+                continue
+            mimetype = thumbnails.PROFILES[profile][0]
+            new_res = Resource(self.url + '?attachment=' + profile,
+                'http-get:*:%s:%s' % (mimetype, ';'.join(['DLNA.ORG_PN=' + profile] + dlna_tags)))
+            new_res.size = None
+            cached = service.cached(path, mtime, profile)
+            if cached is not None:
+                new_res.size = cached[1]
+            self.item.res.append(new_res)
+            self.item.attachments[profile] = thumbnails.ThumbnailResource(service, path, mtime, profile)
+        if self.store.prefetch_thumbnails:
+            service.prefetch(path, mtime, self.mimetype, exclude=exclude)
+
     def rebuild(self, urlbase):
         #print "rebuild", self.mimetype
         if self.mimetype != 'item':
@@ -342,17 +467,21 @@ class FSItem(BackendItem):
             that comes around
         """
         try:
-            jpgs = [i.path for i in self.location.children() if i.splitext()[1] in ('.jpg', '.JPG')]
-            try:
-                self.cover = jpgs[0]
-            except IndexError:
-                pngs = [i.path for i in self.location.children() if i.splitext()[1] in ('.png', '.PNG')]
-                try:
-                    self.cover = pngs[0]
-                except IndexError:
-                    return
+            cover = self.store.sidecars.get(self.location.path).cover
         except UnicodeDecodeError:
             self.warning("UnicodeDecodeError - there is something wrong with a file located in %r", self.location.path)
+            return
+        except OSError, msg:
+            self.warning("can't list %r: %r", self.location.path, msg)
+            return
+        self.cover = cover
+        if cover is not None:
+            _, ext = os.path.splitext(cover)
+            """ add the cover image extension to help clients not reacting on
+                the mimetype """
+            self.item.albumArtURI = ''.join((self.url, '?cover', ext))
+        else:
+            self.item.albumArtURI = None
 
     def remove(self):
         #print "FSItem remove", self.id, self.get_name(), self.parent
@@ -465,7 +594,11 @@ class FSStore(BackendStore):
                {'option': 'ignore_patterns', 'type': 'string', 'help': 'list of regex patterns, matching filenames will be ignored'},
                {'option': 'enable_inotify', 'type': 'string', 'default': 'yes', 'help': 'enable real-time monitoring of the content folders'},
                {'option': 'enable_destroy', 'type': 'string', 'default': 'no', 'help': 'enable deleting a file via an UPnP method'},
-               {'option': 'import_folder', 'type': 'string', 'help': 'The path to store files imported via an UPnP method, if empty the Import method is disabled'}
+               {'option': 'import_folder', 'type': 'string', 'help': 'The path to store files imported via an UPnP method, if empty the Import method is disabled'},
+               {'option': 'thumbnails', 'type': 'string', 'default': 'yes', 'help': 'offer thumbnails in the DLNA sizes for images and videos, needs the Python Imaging Library'},
+               {'option': 'thumbnail_cache', 'type': 'string', 'default': thumbnails.ThumbnailService.directory, 'help': 'the directory the thumbnails are kept in', 'level': 'advance'},
+               {'option': 'thumbnail_workers', 'type': 'int', 'default': 2, 'help': 'how many thumbnails are rendered at once', 'level': 'advance'},
+               {'option': 'prefetch_thumbnails', 'type': 'string', 'default': 'yes', 'help': 'render the thumbnails of new files in the background', 'level': 'advance'}
               ]
 
     def __init__(self, server, **kwargs):
@@ -490,6 +623,7 @@ class FSStore(BackendStore):
         self.content = Set([os.path.abspath(x) for x in self.content])
         ignore_patterns = kwargs.get('ignore_patterns', [])
         self.store = {}
+        self.sidecars = SidecarIndex()
 
         self.inotify = None
 
@@ -503,6 +637,7 @@ class FSStore(BackendStore):
                 self.info("%s", no_inotify_reason)
         else:
             self.info("FSStore content auto-update disabled upon user request")
+        self.sidecars.check_mtime = self.inotify is None
 
 
         if kwargs.get('enable_destroy', 'no') == 'yes':
@@ -514,6 +649,20 @@ class FSStore(BackendStore):
             if not os.path.isdir(self.import_folder):
                 self.import_folder = None
 
+        self.thumbnails = None
+        self.prefetch_thumbnails = utils.means_true(kwargs.get('prefetch_thumbnails', 'yes'))
+        if utils.means_true(kwargs.get('thumbnails', 'yes')):
+            if thumbnails.renderer_available():
+                self.thumbnails = thumbnails.service
+                if 'thumbnail_cache' in kwargs:
+                    self.thumbnails.directory = os.path.abspath(kwargs['thumbnail_cache'])
+                try:
+                    self.thumbnails.workers = int(kwargs.get('thumbnail_workers', self.thumbnails.workers))
+                except ValueError:
+                    self.warning("invalid thumbnail_workers %r", kwargs['thumbnail_workers'])
+            else:
+                self.info("no thumbnails, the Python Imaging Library is missing")
+
         self.ignore_file_pattern = re.compile('|'.join(['^\..*'] + list(ignore_patterns)))
         parent = None
         self.update_id = 0
@@ -646,10 +795,10 @@ class FSStore(BackendStore):
             container = containers.pop()
             try:
                 self.debug('adding %r', container.location)
-                for child in container.location.children():
-                    if ignore_file_pattern.match(child.basename()) != None:
+                for name in self.sidecars.children(container.location.path):
+                    if ignore_file_pattern.match(name) != None:
                         continue
-                    new_container = self.append(child.path, container)
+                    new_container = self.append(os.path.join(container.location.path, name), container)
                     if new_container != None:
                         containers.append(new_container)
             except UnicodeDecodeError:
@@ -742,12 +891,20 @@ class FSStore(BackendStore):
         self.info("Event %s on %s - parameter %r",
             ', '.join(self.inotify.flag_to_human(mask)), path.path, parameter)
 
+        # the sidecar files of the directory might have changed
+        self.sidecars.invalidate(path.dirname())
+        if path.splitext()[1].lower() in ('.jpg', '.png'):
+            parent = self.get_by_id(parameter)
+            if parent is not None and parent.mimetype == 'directory':
+                parent.check_for_cover_art()
+
         if mask & IN_CHANGED:
             # FIXME react maybe on access right changes, loss of read rights?
             #print '%s was changed, parent %d (%s)' % (path, parameter, iwp.path)
-            pass
+            open_files.invalidate(path.path)
 
         if(mask & IN_DELETE or mask & IN_MOVED_FROM):
+            open_files.invalidate(path.path)
             self.info('%s was deleted, parent %r (%s)', path.path, parameter, path.parent.path)
             id = self.get_id_by_name(parameter, path.path)
             if id != None:
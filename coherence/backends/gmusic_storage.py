@@ -9,7 +9,7 @@
 This is a Media Backend that allows you to access your Google Play Music Library.
 """
 
-from coherence import log
+from coherence import log, proxy_cache
 from coherence.backend import BackendStore
 from coherence.backend import BackendItem
 from coherence.upnp.core import DIDLLite
@@ -18,15 +18,10 @@ from twisted.internet import reactor, task
 from twisted.web import server
 from gmusicapi import Mobileclient
 
-import tempfile
 import traceback
 import sys
-import os
 
-# Define global identifiers as well as the cache
-cache = {}
-
-recent_cache = {}
+# Define global identifiers
 ROOT_ID = 0
 TRACKS_ID = 10
 ALBUM_ID = 20
@@ -190,55 +185,16 @@ class GmusicProxyStream(utils.ReverseProxyResource, log.Loggable):
         if hasattr(self, 'connection'):
             self.connection.transport.loseConnection()
 
-    def gotDownloadError(self, error, request):
-        self.info("Unable to download stream to file: %s", self.stream_url)
-        self.info(request)
-        self.info(error)
-
-    def gotFile(self, result, (request, tmpfile, filename)):
-        downloadedFile = utils.StaticFile(filename, self.parent.mimetype)
-        downloadedFile.type = self.parent.mimetype
-        self.filesize = downloadedFile.getFileSize()
-        self.mimetype = self.parent.mimetype
-        downloadedFile.encoding = None
-        self.info("File downloaded")
-        cache[self.id] = (tmpfile, filename)
-        # mark as recent
-        recent_cache[self.id] = cache[self.id]
-        file = downloadedFile.render(request)
-        self.info("File rendered")
-        if isinstance(file, int):
-            return file
-        request.write(file)
-        request.finish()
-
     def getFile(self, request):
-
-        if not self.id in cache:
-            real_url = self.store.api.get_stream_url(self.id)
-
-            (tmpfile, tmpfilename) = tempfile.mkstemp()
-            res = utils.downloadPage(real_url, tmpfilename, supportPartial=1)
-            res.addCallback(self.gotFile, (request, tmpfile, tmpfilename))
-            res.addErrback(self.gotDownloadError, request)
+        key = 'gmusic:%s' % self.id
+        url = None
+        if not proxy_cache.cache.complete(key):
+            url = self.store.api.get_stream_url(self.id)
             self.info("Started download")
-            return server.NOT_DONE_YET
-
-        else:
-            downloadedFile = utils.StaticFile(cache[self.id][1], self.parent.mimetype)
-            # mark as recent
-            recent_cache[self.id] = cache[self.id]
-            downloadedFile.type = self.parent.mimetype
-            self.filesize = downloadedFile.getFileSize()
-            self.parent.item.size = self.filesize
-            self.mimetype = self.parent.mimetype
-            downloadedFile.encoding = None
-            self.info("File downloaded")
-            file = downloadedFile.render(request)
-            self.info("File rendered")
-            if isinstance(file, int):
-                return file
-            request.write(file)
+        resource = proxy_cache.cache.resource(url, key, self.parent.mimetype)
+        res = resource.render(request)
+        if res != server.NOT_DONE_YET:
+            request.write(res)
             request.finish()
 
     def render(self, request):
@@ -400,15 +356,6 @@ class GmusicStore(BackendStore):
         dfr.addCallback(self._update_container)
         # in ANY case queue an update of the data
         dfr.addBoth(self.queue_update)
-        # finally clean the tempfiles
-        print("Cleaning tempfiles")
-        for file_id, file_tmp in cache.iteritems():
-            if file_id not in recent_cache:
-                os.close(file_tmp[0])
-                os.remove(file_tmp[1])
-        cache.clear()
-        cache.update(recent_cache)
-        recent_cache.clear()
 
     def get_data(self):
         subscribed_to_playlists = [p for p in self.api.get_all_playlists() if p.get('type') == 'SHARED']
@@ -11,7 +11,7 @@ from twisted.internet import defer, reactor
 from twisted.python.failure import Failure
 from twisted.web import server
 
-from coherence.upnp.core import utils
+from coherence.upnp.core import outbound, utils
 
 from coherence.upnp.core import DIDLLite
 from coherence.upnp.core.DIDLLite import classChooser, Resource, DIDLElement
@@ -121,12 +121,13 @@ class PlaylistStreamProxy(utils.ReverseProxyUriResource, log.Loggable):
                 return None
 
             playlist_url = self.uri
-            d = utils.getPage(playlist_url, timeout=20)
+            d = utils.getPage(playlist_url, timeout=20, priority=outbound.PRIORITY_PLAYBACK)
             d.addCallbacks(got_playlist, got_error)
             return server.NOT_DONE_YET
 
         self.info("this is our render method %s %s %s %s", request.method, request.uri, request.client, request.clientproto)
-        self.info("render %s", request.getAllHeaders())
+        if self.isEnabledFor(log.INFO):
+            self.info("render %s", request.getAllHeaders())
         if request.clientproto == 'HTTP/1.1':
             self.connection = request.getHeader('connection')
             if self.connection:
@@ -158,6 +159,9 @@ class IRadioItem(BackendItem):
         # do nothing: we suppose the replacement item is the same
         return
 
+    def get_cache_data(self):
+        return (self.station_id, self.name, self.stream_url, self.mimetype), {}
+
     def get_item(self):
         if self.item == None:
             upnp_id = self.get_id()
@@ -224,6 +228,7 @@ class IRadioStore(AbstractBackendStore):
             same_genres = [genre]
         title = genre.encode('utf-8')
         family_item = LazyContainer(parent, title, genre, self.refresh, self.retrieveItemsForGenre, genres=same_genres, per_page=1)
+        family_item.cache_key = 'genre:%s' % title
 
         # we will use a specific child items sorter
         # in order to get the sub-genre containers first
@@ -9,7 +9,7 @@
 from twisted.internet import defer, reactor
 from twisted.web import server
 
-from coherence.upnp.core import utils
+from coherence.upnp.core import outbound, utils
 
 from coherence.upnp.core import DIDLLite
 
@@ -71,7 +71,7 @@ class ProxyStream(utils.ReverseProxyUriResource, log.Loggable):
 
             playlist_url = self.uri
             #print "playlist URL:", playlist_url
-            d = utils.getPage(playlist_url, timeout=20)
+            d = utils.getPage(playlist_url, timeout=20, priority=outbound.PRIORITY_PLAYBACK)
             d.addCallbacks(got_playlist, got_error)
             return server.NOT_DONE_YET
 
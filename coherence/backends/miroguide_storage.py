@@ -92,11 +92,6 @@ class MiroGuideStore(AbstractBackendStore):
 
         self.proxy_mode = kwargs.get('proxy_mode', 'redirect')
         self.cache_directory = kwargs.get('cache_directory', '/tmp/coherence-cache')
-        try:
-            if self.proxy_mode != 'redirect':
-                os.mkdir(self.cache_directory)
-        except:
-            pass
         self.cache_maxsize = kwargs.get('cache_maxsize', 100000000)
         self.buffer_size = kwargs.get('buffer_size', 750000)
 
@@ -156,9 +156,23 @@ class ExternalProcessProducer(log.Loggable):
         self.written = 0
         self.data = ''
         self.ended = False
-        request.registerProducer(self, 0)
+        self.paused = False
+        # a push producer, we stop reading from the process while the
+        # request can't take more
+        request.registerProducer(self, True)
+        self.spawn()
+
+    def spawn(self):
+        argv = self.pipeline.split()
+        executable = argv[0]
+        argv[0] = os.path.basename(argv[0])
+        self.process = reactor.spawnProcess(ExternalProcessProtocol(self), executable, argv, {})
+        if self.paused:
+            self.process.pauseProducing()
 
     def write_data(self, data):
+        if not self.request:
+            return
         if data:
             print "write %d bytes of data" % len(data)
             self.written += len(data)
@@ -172,24 +186,23 @@ class ExternalProcessProducer(log.Loggable):
             self.request = None
 
     def resumeProducing(self):
-        print "resumeProducing", self.request
-        if not self.request:
-            return
-        if self.process == None:
-            argv = self.pipeline.split()
-            executable = argv[0]
-            argv[0] = os.path.basename(argv[0])
-            self.process = reactor.spawnProcess(ExternalProcessProtocol(self), executable, argv, {})
+        self.paused = False
+        if self.process is not None:
+            self.process.resumeProducing()
 
     def pauseProducing(self):
-        pass
+        self.paused = True
+        if self.process is not None:
+            self.process.pauseProducing()
 
     def stopProducing(self):
         print "stopProducing", self.request
-        self.request.unregisterProducer()
+        if not self.request:
+            return
+        request, self.request = self.request, None
+        request.unregisterProducer()
         self.process.loseConnection()
-        self.request.finish()
-        self.request = None
+        request.finish()
 
 
 class Item(BackendItem):
@@ -20,6 +20,7 @@ To enable personalized features (e.g. 'Following' streams), add 'access_token' k
 
 import json
 import urllib
+from datetime import datetime
 
 from coherence.log import Loggable
 from dateutil import parser as dateutil_parser
@@ -148,10 +149,17 @@ class StreamsContainer(TwitchLazyContainer):
     self.viewers = viewers
     self.channels = channels
 
+    self.streams_url = streams_url
     self.children_url = streams_url % TWITCH_API_URL
     self.cover_url = cover_url
     self.sorting_method = sort_by_viewers
 
+  def get_cache_data(self):
+    kwargs = dict((k, v) for k, v in self.childrenRetriever_params.items() if k != 'parent')
+    kwargs.update(viewers=self.viewers, channels=self.channels, streams_url=self.streams_url,
+                  cover_url=self.cover_url, limit=self.limit)
+    return (self.name,), kwargs
+
   def result_handler(self, result, **kwargs):
     for stream in result['streams']:
       created_at = dateutil_parser.parse(stream['created_at'])
@@ -175,6 +183,7 @@ class TwitchStreamItem(BackendItem):
     self.created_at = created_at
     self.preview_url = preview_url
     self.viewers = viewers
+    self.channel_url = url
     self.location = LiveStreamerProxyResource(url, 'best')
 
   def get_item(self):
@@ -202,6 +211,14 @@ class TwitchStreamItem(BackendItem):
     # TODO update fields
     return True
 
+  def get_cache_data(self):
+    created_at = self.created_at
+    if isinstance(created_at, datetime):
+      created_at = created_at.isoformat()
+    return (self.name, self.channel_url), {'status': self.status, 'viewers': self.viewers,
+                                           'created_at': created_at,
+                                           'preview_url': self.preview_url}
+
 
 class TwitchStore(AbstractBackendStore):
   logCategory = 'twitch_store'
@@ -227,6 +244,15 @@ class TwitchStore(AbstractBackendStore):
       'default': '',
       'help': 'access token to show personalized list of followed streams'
     },
+    {
+      'option': 'children_cache',
+      'text': 'Cache directory listings:',
+      'type': 'string',
+      'default': 'no',
+      'enum': ('yes', 'no'),
+      'help': 'keep the games and streams listed on disk, to be browsed right after a restart',
+      'level': 'advance'
+    },
     {
       'option': 'version',
       'text': 'UPnP Version:',
@@ -275,6 +301,7 @@ class TwitchStore(AbstractBackendStore):
                                    streams_url='%s/streams/followed',
                                    limit=settings.get('limit', 25),
                                    oauth_token=self.access_token)
+      games_dir.cache_key = 'following'
       root_item.add_child(games_dir)
 
     # 'Games' directory
@@ -284,6 +311,7 @@ class TwitchStore(AbstractBackendStore):
                                  title=settings.get('name', 'Top Games'),
                                  limit=settings.get('limit', 10),
                                  children_limit=settings.get('children_limit', 25))
+      games_dir.cache_key = 'games'
       root_item.add_child(games_dir)
 
     # 'Top Streams' directory
@@ -292,6 +320,7 @@ class TwitchStore(AbstractBackendStore):
       games_dir = StreamsContainer(root_item,
                                    title=settings.get('name', 'Top Streams'),
                                    limit=settings.get('limit', 25))
+      games_dir.cache_key = 'streams'
       root_item.add_child(games_dir)
 
 
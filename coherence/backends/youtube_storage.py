@@ -4,19 +4,17 @@
 # Copyright 2009, Jean-Michel Sizun
 # Copyright 2009 Frank Scholz <coherence@beebits.net>
 
-import os.path
-
 from twisted.internet import reactor, threads
 
 from twisted.web import server, static
 from twisted.web.error import PageRedirect
 
-from coherence.upnp.core import utils
+from coherence.upnp.core import outbound, utils
 from coherence.upnp.core.utils import ReverseProxyUriResource, ReverseProxyResource
 from coherence.upnp.core import DIDLLite
 from coherence.backend import BackendStore, BackendItem
 
-from coherence import log
+from coherence import log, proxy_cache
 
 from gdata.youtube.service import YouTubeService
 from coherence.extern.youtubedl import FileDownloader, YoutubeIE, MetacafeIE, YoutubePlaylistIE
@@ -45,10 +43,9 @@ class TestVideoProxy(ReverseProxyUriResource, log.Loggable):
             self.id = '%d' % self.id
         self.proxy_mode = proxy_mode
 
-        self.cache_directory = cache_directory
-        self.cache_maxsize = int(cache_maxsize)
         self.buffer_size = int(buffer_size)
-        self.downloader = None
+        if proxy_mode in ('buffer', 'buffered'):
+            proxy_cache.cache.configure(cache_directory, cache_maxsize)
 
         self.video_url = None  # the url we get from the youtube page
         self.stream_url = None  # the real video stream, cached somewhere
@@ -69,7 +66,8 @@ class TestVideoProxy(ReverseProxyUriResource, log.Loggable):
     def render(self, request):
 
         self.info("VideoProxy render %s %s %s", request, self.stream_url, self.video_url)
-        self.info("VideoProxy headers: %s", request.getAllHeaders())
+        if self.isEnabledFor(log.INFO):
+            self.info("VideoProxy headers: %s", request.getAllHeaders())
         self.info("VideoProxy id: %s", self.id)
 
         d = request.notifyFinish()
@@ -113,7 +111,8 @@ class TestVideoProxy(ReverseProxyUriResource, log.Loggable):
 
     def followRedirects(self, request):
         self.info("HTTP redirect  %s %s", request, self.stream_url)
-        d = utils.getPage(self.stream_url, method="HEAD", followRedirect=0)
+        d = utils.getPage(self.stream_url, method="HEAD", followRedirect=0,
+                          priority=outbound.PRIORITY_PLAYBACK)
 
         def gotHeader(result, request):
             data, header = result
@@ -156,56 +155,15 @@ class TestVideoProxy(ReverseProxyUriResource, log.Loggable):
             request.write(res)
             return
         elif self.proxy_mode in ('buffer', 'buffered'):
-            # download stream to cache,
+            # download stream to the proxy cache,
             # and send it to the client in // after X bytes
-            filepath = os.path.join(self.cache_directory, self.id)
-
-            file_is_already_available = False
-            if (os.path.exists(filepath)
-                and os.path.getsize(filepath) == self.filesize):
-                res = self.renderFile(request, filepath)
-                if isinstance(res, int):
-                    return res
+            resource = proxy_cache.cache.resource(
+                self.stream_url, 'video:%s' % self.id, self.getMimetype(),
+                self.filesize or None, prebuffer=self.buffer_size)
+            res = resource.render(request)
+            if res != server.NOT_DONE_YET:
                 request.write(res)
                 request.finish()
-            else:
-                if request.method != 'HEAD':
-                    self.downloadFile(request, filepath, None)
-                    range = request.getHeader('range')
-                    if range is not None:
-                        bytesrange = range.split('=')
-                        assert bytesrange[0] == 'bytes', \
-                               "Syntactically invalid http range header!"
-                        start, end = bytesrange[1].split('-', 1)
-                        #print "%r %r" %(start,end)
-                        if start:
-                            start = int(start)
-                            if end:
-                                end = int(end)
-                            else:
-                                end = self.filesize - 1
-                            # Are we requesting something beyond the current size of the file?
-                            try:
-                                size = os.path.getsize(filepath)
-                            except OSError:
-                                size = 0
-                            if (start >= size and
-                                end + 10 > self.filesize and
-                                end - start < 200000):
-                                #print "let's hand that through, it is probably a mp4 index request"
-                                res = ReverseProxyResource.render(self, request)
-                                if isinstance(res, int):
-                                    return res
-                                request.write(res)
-                                return
-
-                res = self.renderBufferFile(request, filepath, self.buffer_size)
-                if res == '' and request.method != 'HEAD':
-                    return server.NOT_DONE_YET
-                if not isinstance(res, int):
-                    request.write(res)
-                if request.method == 'HEAD':
-                    request.finish()
 
         else:
             self.warning("Unsupported Proxy Mode: %s", self.proxy_mode)
@@ -217,85 +175,6 @@ class TestVideoProxy(ReverseProxyUriResource, log.Loggable):
             type = self.mimetype
         return type
 
-    def renderFile(self, request, filepath):
-        self.info('Cache file available %r %r ', request, filepath)
-        downloadedFile = utils.StaticFile(filepath, self.mimetype)
-        downloadedFile.type = self.getMimetype()
-        downloadedFile.encoding = None
-        return downloadedFile.render(request)
-
-    def renderBufferFile (self, request, filepath, buffer_size):
-        # Try to render file(if we have enough data)
-        self.info("renderBufferFile %s", filepath)
-        rendering = False
-        if os.path.exists(filepath) is True:
-            filesize = os.path.getsize(filepath)
-            if ((filesize >= buffer_size) or (filesize == self.filesize)):
-                rendering = True
-                self.info("Render file %s %s %s %s", filepath, self.filesize, filesize, buffer_size)
-                bufferFile = utils.BufferFile(filepath, self.filesize, MPEG4_MIMETYPE)
-                bufferFile.type = self.getMimetype()
-                bufferFile.encoding = None
-                try:
-                    return bufferFile.render(request)
-                except Exception, error:
-                    self.info(error)
-
-        if request.method != 'HEAD':
-            self.info('Will retry later to render buffer file')
-            reactor.callLater(0.5, self.renderBufferFile, request, filepath, buffer_size)
-        return ''
-
-    def downloadFinished(self, result):
-        self.info('Download finished!')
-        self.downloader = None
-
-    def gotDownloadError(self, error, request):
-        self.info("Unable to download stream to file: %s", self.stream_url)
-        self.info(request)
-        self.info(error)
-
-    def downloadFile(self, request, filepath, callback, *args):
-        if (self.downloader is None):
-            self.info("Proxy: download data to cache file %s", filepath)
-            self.checkCacheSize()
-            self.downloader = utils.downloadPage(self.stream_url, filepath, supportPartial=1)
-            self.downloader.addCallback(self.downloadFinished)
-            self.downloader.addErrback(self.gotDownloadError, request)
-        if(callback is not None):
-            self.downloader.addCallback(callback, request, filepath, *args)
-        return self.downloader
-
-    def checkCacheSize(self):
-        cache_listdir = os.listdir(self.cache_directory)
-
-        cache_size = 0
-        for filename in cache_listdir:
-            path = "%s%s%s" % (self.cache_directory, os.sep, filename)
-            statinfo = os.stat(path)
-            cache_size += statinfo.st_size
-        self.info("Cache size: %d (max is %s)", cache_size, self.cache_maxsize)
-
-        if (cache_size > self.cache_maxsize):
-            cache_targetsize = self.cache_maxsize * 2 / 3
-            self.info("Cache above max size: Reducing to %d", cache_targetsize)
-
-            def compare_atime(filename1, filename2):
-                path1 = "%s%s%s" % (self.cache_directory, os.sep, filename1)
-                path2 = "%s%s%s" % (self.cache_directory, os.sep, filename2)
-                cmp = int(os.stat(path1).st_atime - os.stat(path2).st_atime)
-                return cmp
-            cache_listdir = sorted(cache_listdir, compare_atime)
-
-            while (cache_size > cache_targetsize):
-                filename = cache_listdir.pop(0)
-                path = "%s%s%s" % (self.cache_directory, os.sep, filename)
-                cache_size -= os.stat(path).st_size
-                os.remove(path)
-                self.info("removed %s", filename)
-
-            self.info("new cache size is %d", cache_size)
-
 
 class YoutubeVideoItem(BackendItem):
 
@@ -417,11 +296,6 @@ class YouTubeStore(AbstractBackendStore):
         self.refresh = int(kwargs.get('refresh', 60)) * 60
         self.proxy_mode = kwargs.get('proxy_mode', 'redirect')
         self.cache_directory = kwargs.get('cache_directory', '/tmp/coherence-cache')
-        try:
-            if self.proxy_mode != 'redirect':
-                os.mkdir(self.cache_directory)
-        except:
-            pass
         self.cache_maxsize = kwargs.get('cache_maxsize', 100000000)
         self.buffer_size = kwargs.get('buffer_size', 750000)
 
@@ -251,7 +251,11 @@ class Coherence(log.Loggable):
         logfile = unicode(logfile)
     except (KeyError, AttributeError, TypeError):
       logfile = config.get('logfile', None)
-    log.init(logfile, logmode.upper())
+    try:
+      logformat = config.get('logging').get('format', log.LOG_FORMAT)
+    except (KeyError, AttributeError, TypeError):
+      logformat = config.get('logformat', log.LOG_FORMAT)
+    log.init(logfile, logmode.upper(), logformat)
 
     self.warning("Coherence UPnP framework version %s starting...", __version__)
 
@@ -370,6 +374,21 @@ class Coherence(log.Loggable):
 
     self.external_address = ':'.join((self.hostname, str(self.web_server_port)))
 
+    """ Outbound HTTP Initialization
+    """
+    from coherence.upnp.core import outbound
+    outbound.scheduler.configure(max_per_host=self.config.get('http_max_per_host'),
+                                 max_total=self.config.get('http_max_total'),
+                                 timeout=self.config.get('http_timeout'))
+
+    """ Page Cache Initialization
+    """
+    if self.config.get('page_cache', 'no') == 'yes':
+      from coherence.upnp.core import page_cache
+      page_cache.cache.configure(enabled=True,
+                                 directory=self.config.get('page_cache_directory'),
+                                 max_entries=self.config.get('page_cache_entries'))
+
     """ Control Point Initialization
     """
     if self.config.get('controlpoint', 'no') == 'yes' or self.config.get('json', 'no') == 'yes':
@@ -633,10 +652,10 @@ class Coherence(log.Loggable):
       pass
 
   @staticmethod
-  def connect(receiver, signal=louie.signal.All, sender=louie.sender.Any, weak=True):
+  def connect(receiver, signal=louie.signal.All, sender=louie.sender.Any, weak=True, priority=0):
     """ wrapper method around louie.connect
     """
-    louie.connect(receiver, signal=signal, sender=sender, weak=weak)
+    louie.connect(receiver, signal=signal, sender=sender, weak=weak, priority=priority)
 
   @staticmethod
   def disconnect(receiver, signal=louie.signal.All, sender=louie.sender.Any, weak=True):
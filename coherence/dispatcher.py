@@ -1,13 +1,23 @@
 
-from twisted.internet import defer
+import collections
+import time
+
+from twisted.internet import defer, task
 
 
 class Receiver(object):
-    def __init__(self, signal, callback, args, kwargs):
+    def __init__(self, signal, callback, args, kwargs, priority=0):
         self.signal = signal
         self.callback = callback
         self.arguments = args
         self.keywords = kwargs
+        # receivers of a lower priority are called first
+        self.priority = priority
+        # the calls and the seconds they took, without the time
+        # a Deferred they returned took to fire
+        self.calls = 0
+        self.time = 0.0
+        self.max_time = 0.0
 
     def __call__(self, *args, **kwargs):
         args = args + self.arguments
@@ -15,7 +25,15 @@ class Receiver(object):
         kw = self.keywords.copy()
         if kwargs:
             kw.update(kwargs)
-        return self.callback(*args, **kw)
+        start = time.time()
+        try:
+            return self.callback(*args, **kw)
+        finally:
+            took = time.time() - start
+            self.calls += 1
+            self.time += took
+            if took > self.max_time:
+                self.max_time = took
 
     def __repr__(self):
         return "<Receiver %s for %s: %s (%s, %s)>" % (id(self),
@@ -37,19 +55,46 @@ class Dispatcher(object):
 
     __signals__ = {}
 
+    # save_emit calls the receivers through a Cooperator, for at most
+    # emit_budget seconds in a mainloop iteration
+    cooperative = False
+    emit_budget = 0.01
+
     def __init__(self):
         self.receivers = {}
+        # the signals save_emit is going to emit
+        self._saved = []
+        # and the ones waiting for the Cooperator
+        self._cooperating = collections.deque()
+        self._cooperation = None
+        self._cooperator = None
         for signal in self.__signals__.iterkeys():
             self.receivers[signal] = []
 
     def connect(self, signal, callback, *args, **kw):
-        receiver = Receiver(signal, callback, args, kw)
+        return self.connect_priority(signal, 0, callback, *args, **kw)
+
+    def connect_priority(self, signal, priority, callback, *args, **kw):
+        """ connect callback to signal, called before the receivers
+            of a higher priority and after the ones of the same """
+        receiver = Receiver(signal, callback, args, kw, priority)
         try:
-            self.receivers[signal].append(receiver)
+            receivers = self.receivers[signal]
         except KeyError:
             raise UnknownSignal(signal)
+        index = len(receivers)
+        while index > 0 and receivers[index - 1].priority > priority:
+            index -= 1
+        receivers.insert(index, receiver)
         return receiver
 
+    def timings(self):
+        """ the receivers called, the slowest in total first """
+        receivers = [receiver for receivers in self.receivers.itervalues()
+                     for receiver in receivers if receiver.calls > 0]
+        receivers.sort(key=lambda receiver: receiver.time, reverse=True)
+        return receivers
+
     def disconnect(self, receiver):
         if not receiver:
             return
@@ -78,7 +123,7 @@ class Dispatcher(object):
     def deferred_emit(self, signal, *args, **kwargs):
         receivers = []
         dfrs = []
-        # TODO: the loop is blocking, use callLaters and/or coiterate here
+        # the loop is blocking, cooperative_emit isn't
         for receiver in self._get_receivers(signal):
             receivers.append(receiver)
             dfrs.append(defer.maybeDeferred(receiver, *args, **kwargs))
@@ -91,15 +136,75 @@ class Dispatcher(object):
         return result_dfr
 
     def save_emit(self, signal, *args, **kwargs):
+        """ emit signal in the next mainloop iteration, returns a Deferred
+            firing with the results
+
+            the signals saved during one iteration are emitted by a single
+            delayed call, a signal nobody is connected to isn't saved
+        """
+        try:
+            receivers = self._get_receivers(signal)
+        except UnknownSignal:
+            return defer.fail()
+        if not receivers:
+            return defer.succeed([])
         deferred = defer.Deferred()
-        # run the deferred_emit in as a callback
-        deferred.addCallback(self.deferred_emit, *args, **kwargs)
-        # and callback the deferred with the signal as the 'result' in the
-        # next mainloop iteration
-        from twisted.internet import reactor
-        reactor.callLater(0, deferred.callback, signal)
+        self._saved.append((signal, args, kwargs, deferred))
+        if len(self._saved) == 1:
+            from twisted.internet import reactor
+            reactor.callLater(0, self._emit_saved)
         return deferred
 
+    def _emit_saved(self):
+        saved, self._saved = self._saved, []
+        if self.cooperative:
+            self._cooperating.extend(saved)
+            if self._cooperation is None:
+                self._cooperation = self.get_cooperator().cooperate(self._emit_cooperating())
+            return
+        for signal, args, kwargs, deferred in saved:
+            self.deferred_emit(signal, *args, **kwargs).chainDeferred(deferred)
+
+    def _emit_cooperating(self):
+        # one task for all, the signals are emitted in the order saved
+        while self._cooperating:
+            signal, args, kwargs, deferred = self._cooperating.popleft()
+            for step in self._cooperative_calls(signal, args, kwargs, deferred):
+                yield step
+        self._cooperation = None
+
+    def get_cooperator(self):
+        if self._cooperator is None:
+            budget = self.emit_budget
+
+            def iteration():
+                deadline = time.time() + budget
+                return lambda: time.time() >= deadline
+            self._cooperator = task.Cooperator(terminationPredicateFactory=iteration)
+        return self._cooperator
+
+    def cooperative_emit(self, signal, *args, **kwargs):
+        """ like deferred_emit, but calls the receivers one at a time
+            through the Cooperator, so the mainloop isn't blocked by them
+        """
+        deferred = defer.Deferred()
+        self.get_cooperator().cooperate(
+            self._cooperative_calls(signal, args, kwargs, deferred))
+        return deferred
+
+    def _cooperative_calls(self, signal, args, kwargs, deferred):
+        receivers = list(self._get_receivers(signal))
+        dfrs = []
+        for receiver in receivers:
+            dfrs.append(defer.maybeDeferred(receiver, *args, **kwargs))
+            yield None
+        if not dfrs:
+            deferred.callback([])
+            return
+        result_dfr = defer.DeferredList(dfrs)
+        result_dfr.addCallback(self._merge_results_and_receivers, receivers)
+        result_dfr.chainDeferred(deferred)
+
     def _merge_results_and_receivers(self, result, receivers):
         # make a list of (rec1, res1), (rec2, res2), (rec3, res3) ...
         return [(receiver, result[counter])
@@ -33,11 +33,14 @@ signal.All = All
 # a slightly less raise-y-ish implementation as louie was not so picky, too
 class GlobalDispatcher(Dispatcher):
 
-    def connect(self, signal, callback, *args, **kw):
+    # new_device and the like fan out into expensive handlers
+    cooperative = True
+
+    def connect_priority(self, signal, priority, callback, *args, **kw):
         if not signal in self.receivers:
             # ugly hack
             self.receivers[signal] = []
-        return Dispatcher.connect(self, signal, callback, *args, **kw)
+        return Dispatcher.connect_priority(self, signal, priority, callback, *args, **kw)
 
     def _get_receivers(self, signal):
         try:
@@ -60,11 +63,11 @@ def reset():
     _global_receivers_pool = {}
 
 
-def connect(receiver, signal=All, sender=Any, weak=True):
+def connect(receiver, signal=All, sender=Any, weak=True, priority=0):
     callback = receiver
     if signal in (Any, All):
         raise NotImplemented("This is not allowed. Signal HAS to be something")
-    receiver = _global_dispatcher.connect(signal, callback)
+    receiver = _global_dispatcher.connect_priority(signal, priority, callback)
     _global_receivers_pool[(callback, signal)] = receiver
     return receiver
 
@@ -77,6 +80,12 @@ def disconnect(receiver, signal=All, sender=Any, weak=True):
     return _global_dispatcher.disconnect(receiver)
 
 
+def timings():
+    """ the receivers called, the slowest in total first, with
+        their calls, time and max_time """
+    return _global_dispatcher.timings()
+
+
 def send(signal=All, sender=Anonymous, *arguments, **named):
     if signal in (Any, All):
         raise NotImplemented("This is not allowed. Signal HAS to be something")
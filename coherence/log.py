@@ -15,6 +15,39 @@ LOG_FORMAT = ('%(asctime)s %(levelname)s '
 
 ENV_VAR_NAME = 'COHEN_DEBUG'
 
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+CRITICAL = logging.CRITICAL
+
+# the format fields Logger.findCaller walks the stack for
+CALLER_FIELDS = ('%(pathname)', '%(filename)', '%(module)', '%(lineno)', '%(funcName)')
+
+# (logger name, level) -> whether a message gets through, valid as
+# long as the root logger stays in _state
+_enabled = {}
+_state = None
+
+
+def refresh():
+  """ forget the cached levels, called when they change """
+  global _state
+  _enabled.clear()
+  _state = (logging.root.level, logging.root.manager.disable, len(logging.root.handlers))
+
+
+def isEnabledFor(logger, level):
+  """ logger.isEnabledFor, cached """
+  if _state != (logging.root.level, logging.root.manager.disable, len(logging.root.handlers)):
+    refresh()
+  try:
+    return _enabled[(logger.name, level)]
+  except KeyError:
+    enabled = _enabled[(logger.name, level)] = logger.isEnabledFor(level)
+    return enabled
+
+
 # This is taken from std.-module logging, see Logger.findCaller below.
 # _srcfile is used when walking the stack to check when we've got the first
 # caller stack frame.
@@ -28,9 +61,52 @@ else:
 _srcfile = os.path.normcase(_srcfile)
 _srcfiles = (_srcfile, logging._srcfile)
 
+# co_filename -> whether it is this file or the logging module
+_skipped_files = {}
+
+
+def _skipped(filename):
+  try:
+    return _skipped_files[filename]
+  except KeyError:
+    skipped = _skipped_files[filename] = os.path.normcase(filename) in _srcfiles
+    return skipped
+
 
 class Logger(logging.Logger):
+
+  def setLevel(self, level):
+    logging.Logger.setLevel(self, level)
+    refresh()
+
+  def addHandler(self, handler):
+    logging.Logger.addHandler(self, handler)
+    refresh()
+
+  def removeHandler(self, handler):
+    logging.Logger.removeHandler(self, handler)
+    refresh()
+
+  def needsCaller(self):
+    """ whether a handler of ours formats where the message was logged,
+        looked at for every message, handlers and formatters change """
+    logger = self
+    while logger is not None:
+      for handler in logger.handlers:
+        if handler.formatter is None:
+          # logging's default format, just the message
+          continue
+        fmt = getattr(handler.formatter, '_fmt', None)
+        if fmt is None or any(field in fmt for field in CALLER_FIELDS):
+          return True
+      if not logger.propagate:
+        break
+      logger = logger.parent
+    return False
+
   def findCaller(self):
+    if not self.needsCaller():
+      return "(unknown file)", 0, "(unknown function)"
     # This is nearly a plain copy of logging.Logger.findCaller
     # Since findCaller tests for _srcfile to find the caller, we
     # need to test for this file and the loggin module.
@@ -45,8 +121,7 @@ class Logger(logging.Logger):
     rv = "(unknown file)", 0, "(unknown function)"
     while hasattr(f, "f_code"):
       co = f.f_code
-      filename = os.path.normcase(co.co_filename)
-      if filename in _srcfiles:  # # chaanged line
+      if _skipped(co.co_filename):  # # chaanged line
         f = f.f_back
         continue
       rv = (co.co_filename, f.f_lineno, co.co_name)
@@ -73,26 +148,37 @@ class Loggable(object):
   def __init__(self):
     self.__logger = logging.getLogger(self.logCategory)
 
+  def isEnabledFor(self, level):
+    """ whether a message of level gets logged, to skip computing
+        expensive arguments otherwise """
+    return isEnabledFor(self.__logger, level)
+
   def log(self, message, *args, **kwargs):
     self.__logger.log(message, *args, **kwargs)
 
   def warning(self, message, *args, **kwargs):
-    self.__logger.warning(message, *args, **kwargs)
+    if isEnabledFor(self.__logger, WARNING):
+      self.__logger.warning(message, *args, **kwargs)
 
   def info(self, message, *args, **kwargs):
-    self.__logger.info(message, *args, **kwargs)
+    if isEnabledFor(self.__logger, INFO):
+      self.__logger.info(message, *args, **kwargs)
 
   def critical(self, message, *args, **kwargs):
-    self.__logger.critical(message, *args, **kwargs)
+    if isEnabledFor(self.__logger, CRITICAL):
+      self.__logger.critical(message, *args, **kwargs)
 
   def debug(self, message, *args, **kwargs):
-    self.__logger.debug(message, *args, **kwargs)
+    if isEnabledFor(self.__logger, DEBUG):
+      self.__logger.debug(message, *args, **kwargs)
 
   def error(self, message, *args, **kwargs):
-    self.__logger.error(message, *args, **kwargs)
+    if isEnabledFor(self.__logger, ERROR):
+      self.__logger.error(message, *args, **kwargs)
 
   def exception(self, message, *args, **kwargs):
-    self.__logger.exception(message, *args, **kwargs)
+    if isEnabledFor(self.__logger, ERROR):
+      self.__logger.exception(message, *args, **kwargs)
 
   fatal = critical
   warn = warning
@@ -102,13 +188,16 @@ class Loggable(object):
 getLogger = logging.getLogger
 
 
-def init(logfilename=None, loglevel=logging.WARN):
+def init(logfilename=None, loglevel=logging.WARN, logformat=LOG_FORMAT):
+  """ without %(filename)s, %(lineno)s and the like in logformat the
+      stack isn't looked at for where a message was logged """
   logger = logging.getLogger()
   logging.addLevelName(100, 'NONE')
 
-  logging.basicConfig(filename=logfilename, level=loglevel, format=LOG_FORMAT)
+  logging.basicConfig(filename=logfilename, level=loglevel, format=logformat)
 
   if ENV_VAR_NAME in os.environ:
     logger.setLevel(os.environ[ENV_VAR_NAME])
   else:
     logger.setLevel(loglevel)
+  refresh()
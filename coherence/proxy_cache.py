@@ -0,0 +1,517 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+""" a disk cache for the media the internet backends proxy
+
+    a backend asks for the L{CachedResource} of a URL, under a key of
+    its own if the URL changes from request to request, like the signed
+    ones of a video site. The file is named by a hash of the key, so
+    all clients wanting the same media share it, and its downloads.
+
+    the file is stored in chunks of CHUNK_SIZE bytes. A download starts
+    at the chunk a client needs, on the pooled L{upstream} connections,
+    and ends at the end of the media or at the first chunk that is
+    there already. So a client seeking ahead gets a download of its
+    own, and a range is served as soon as its bytes are there, however
+    much is missing elsewhere.
+
+    the entries are kept in an LRU index in memory, saved with the
+    chunks present to index.json in the cache directory, so a restart
+    keeps what has been downloaded. Their sizes are added up as the
+    chunks arrive, and once the cache holds more than maxsize bytes the
+    least recently used entries nobody is reading are removed.
+"""
+
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import re
+
+from collections import OrderedDict
+
+from twisted.internet import defer, protocol, reactor
+from twisted.web import client, http, server, static
+from twisted.web.http_headers import Headers
+
+from coherence import log
+from coherence.upnp.core import upstream
+from coherence.upnp.core.utils import BufferFileTransfer
+
+CHUNK_SIZE = 2 ** 20
+
+# the names path() gives the cached files
+CACHE_FILE = re.compile(r'^[0-9a-f]{40}$')
+
+
+class CacheEntry(object):
+    """ a cached URL, the chunks we have of it and the downloads running """
+
+    def __init__(self, cache, key, url, path, length=None, mimetype=None, chunks=()):
+        self.cache = cache
+        self.key = key
+        self.url = url
+        self.path = path
+        self.length = length
+        self.mimetype = mimetype
+        self.chunks = set(chunks)
+        self.stored = sum(self.chunk_length(index) for index in self.chunks)
+        self.downloads = []
+        self.readers = 0
+        # the last download failed and there is none running
+        self.failed = False
+        self._waiters = []
+        self._counter = itertools.count()
+
+    def chunk_length(self, index):
+        if self.length is None:
+            return CHUNK_SIZE
+        return max(0, min(CHUNK_SIZE, self.length - index * CHUNK_SIZE))
+
+    @property
+    def complete(self):
+        if self.length is None:
+            return False
+        return len(self.chunks) * CHUNK_SIZE >= self.length
+
+    def available(self, offset):
+        """ return the end of the data available from offset on,
+            offset if there is none """
+        position = offset
+        while self.length is None or position < self.length:
+            index = position // CHUNK_SIZE
+            if index in self.chunks:
+                position = (index + 1) * CHUNK_SIZE
+                continue
+            for download in self.downloads:
+                if download.start <= position < download.position:
+                    position = download.position
+                    break
+            else:
+                break
+        if self.length is not None:
+            position = min(position, self.length)
+        return max(position, offset)
+
+    def ensure(self, offset):
+        """ start a download for offset, unless one is going to get
+            there soon """
+        if self.available(offset) > offset:
+            return
+        if self.length is not None and offset >= self.length:
+            return
+        for download in self.downloads:
+            if download.start <= offset <= download.position + self.cache.coalesce_gap:
+                return
+        self.failed = False
+        self.cache.download(self, offset - offset % CHUNK_SIZE)
+
+    def wait_for(self, offset):
+        """ return a Deferred firing once the byte at offset is there,
+            or it won't come as the downloads failed """
+        self.ensure(offset)
+        if self.available(offset) > offset or self.failed:
+            return defer.succeed(offset)
+        d = defer.Deferred()
+        heapq.heappush(self._waiters, (offset, next(self._counter), d))
+        return d
+
+    def chunk_done(self, index):
+        if index not in self.chunks:
+            self.chunks.add(index)
+            length = self.chunk_length(index)
+            self.stored += length
+            self.cache.stored(self, length)
+
+    def download_done(self, download, failed=False):
+        if download in self.downloads:
+            self.downloads.remove(download)
+        if failed and not self.downloads:
+            self.failed = True
+        self.wake()
+
+    def wake(self):
+        waiters = self._waiters
+        while waiters and (self.failed or self.available(waiters[0][0]) > waiters[0][0]):
+            offset, _, d = heapq.heappop(waiters)
+            # cancelled waiters ignore this
+            d.callback(offset)
+
+
+class Download(protocol.Protocol):
+    """ writes a response body into the chunks of its entry, from start
+        on, until it reaches a chunk that is there already """
+
+    def __init__(self, entry, start):
+        self.entry = entry
+        self.start = start
+        self.position = start
+        # what to drop of a 200 answer to a range request
+        self.skip = 0
+        self.file = None
+        self.stopped = False
+        self.finished = defer.Deferred()
+
+    def dataReceived(self, data):
+        if self.skip:
+            dropped = min(self.skip, len(data))
+            self.skip -= dropped
+            data = data[dropped:]
+        entry = self.entry
+        while data and self.file is not None:
+            index = self.position // CHUNK_SIZE
+            if self.position % CHUNK_SIZE == 0 and index in entry.chunks:
+                # caught up with what another download brought
+                self.stop()
+                break
+            room = (index + 1) * CHUNK_SIZE - self.position
+            piece, data = data[:room], data[room:]
+            self.file.seek(self.position)
+            self.file.write(piece)
+            self.position += len(piece)
+            if (self.position % CHUNK_SIZE == 0 or
+                self.position == entry.length):
+                entry.chunk_done(index)
+        if self.file is not None:
+            self.file.flush()
+        entry.wake()
+
+    def stop(self):
+        self.stopped = True
+        self._close()
+        self.transport.stopProducing()
+
+    def _close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def connectionLost(self, reason):
+        self._close()
+        entry = self.entry
+        complete = reason.check(client.ResponseDone, client.PotentialDataLoss)
+        if complete and entry.length is None:
+            # there was no Content-Length, now we know
+            entry.length = self.position
+            if self.position % CHUNK_SIZE:
+                entry.chunk_done(self.position // CHUNK_SIZE)
+        entry.download_done(self, failed=not (complete or self.stopped))
+        self.finished.callback(self)
+
+
+class CachedResource(static.File, log.Loggable):
+    """
+    A URL served from its L{CacheEntry}, a single range from whatever
+    part of it is asked for, waiting for its bytes as they are
+    downloaded.
+
+    A GET waits for prebuffer bytes before it starts sending.
+    """
+    logCategory = 'proxy_cache'
+    isLeaf = True
+
+    def __init__(self, entry, prebuffer=0):
+        static.File.__init__(self, entry.path)
+        log.Loggable.__init__(self)
+        self.entry = entry
+        self.prebuffer = prebuffer
+        self.encoding = None
+
+    def getFileSize(self):
+        return self.entry.length
+
+    def render_GET(self, request):
+        entry = self.entry
+        entry.readers += 1
+        request.notifyFinish().addBoth(self._reader_done)
+        if entry.length is None:
+            # the first answer tells us, have it start where the client does
+            start = 0
+            try:
+                ranges = self._parseRangeHeader(request.getHeader('range') or '')
+                if len(ranges) == 1 and ranges[0][0] is not None:
+                    start = ranges[0][0]
+            except ValueError:
+                pass
+            d = entry.wait_for(start)
+            request.notifyFinish().addErrback(lambda _: d.cancel())
+            d.addCallbacks(lambda _: self._render_later(request),
+                           lambda f: f.trap(defer.CancelledError))
+            return server.NOT_DONE_YET
+        return self._render(request)
+    render_HEAD = render_GET
+
+    def _reader_done(self, result):
+        self.entry.readers -= 1
+        self.entry.cache.touch(self.entry)
+
+    def _render_later(self, request):
+        if request.finished:
+            return
+        result = self._render(request)
+        if result != server.NOT_DONE_YET:
+            request.write(result)
+            request.finish()
+
+    def _render(self, request):
+        entry = self.entry
+        if entry.length is None:
+            request.setResponseCode(http.BAD_GATEWAY)
+            return '<html><p>the media is not available</p></html>'
+        request.setHeader('content-type', entry.mimetype or 'application/octet-stream')
+        request.setHeader('accept-ranges', 'bytes')
+        start, size = 0, entry.length
+        range = request.getHeader('range')
+        if range is not None:
+            try:
+                ranges = self._parseRangeHeader(range)
+            except ValueError:
+                ranges = []
+            # multiple ranges get all of it
+            if len(ranges) == 1:
+                start, size = self._doSingleRangeRequest(request, ranges[0])
+                if start == size == 0:
+                    return ''
+        request.setHeader('content-length', str(size))
+        if request.method == 'HEAD' or size == 0:
+            return ''
+        end = start + size
+        entry.ensure(start)
+        ready = entry.wait_for(min(start + max(self.prebuffer, 1), end) - 1)
+        request.notifyFinish().addErrback(lambda _: ready.cancel())
+        ready.addCallbacks(lambda _: self._send(request, start, end),
+                           lambda f: f.trap(defer.CancelledError))
+        return server.NOT_DONE_YET
+
+    def _send(self, request, start, end):
+        if request.finished:
+            return
+        f = open(self.entry.path, 'rb')
+        f.seek(start)
+        BufferFileTransfer(f, end, request, Segment(self.entry, start))
+
+
+class Segment(object):
+    """ the data of an entry available from a position on, for a
+        L{BufferFileTransfer} like a L{GrowingFile} """
+
+    def __init__(self, entry, start):
+        self.entry = entry
+        self.mark = start
+
+    @property
+    def size(self):
+        self.mark = self.entry.available(self.mark)
+        return self.mark
+
+    @property
+    def finished(self):
+        return self.entry.failed
+
+    def wait_for(self, offset):
+        return self.entry.wait_for(offset)
+
+
+class ProxyCache(log.Loggable):
+    """
+    The cache entries by key, least recently used first.
+
+    directory and maxsize are set by the backends proxying through it.
+    """
+    logCategory = 'proxy_cache'
+
+    directory = os.path.expanduser('~/.cache/coherence/proxy')
+    maxsize = 500 * 2 ** 20
+    # bytes a download may be behind an offset and still be waited for
+    coalesce_gap = 4 * 2 ** 20
+    # seconds to collect index changes before saving them
+    save_delay = 5
+
+    def __init__(self, reactor=reactor):
+        log.Loggable.__init__(self)
+        self.reactor = reactor
+        self.entries = OrderedDict()
+        self.size = 0
+        self.agent = None
+        self._save_call = None
+        self._evict_call = None
+
+    def configure(self, directory=None, maxsize=None):
+        if self.agent is not None:
+            # shared by all backends, the first one to use it decides
+            return
+        if directory is not None:
+            self.directory = directory
+        if maxsize is not None:
+            self.maxsize = int(maxsize)
+
+    def _prepare(self):
+        self.agent = client.RedirectAgent(upstream.pool)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.load()
+        self.reactor.addSystemEventTrigger('before', 'shutdown', self.save)
+
+    def path(self, key):
+        name = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def entry(self, url, key=None, mimetype=None, length=None):
+        """ return the entry of key, url if no key is given, created
+            if it isn't cached yet """
+        if self.agent is None:
+            self._prepare()
+        if key is None:
+            key = url
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = CacheEntry(self, key, url, self.path(key),
+                                                   length, mimetype)
+        else:
+            if url is not None:
+                # the URLs of some sites expire
+                entry.url = url
+            self.touch(entry)
+            if entry.length is None:
+                entry.length = length
+            entry.mimetype = entry.mimetype or mimetype
+        self.changed()
+        return entry
+
+    def complete(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and entry.complete
+
+    def resource(self, url, key=None, mimetype=None, length=None, prebuffer=0):
+        """ return the resource serving url from the cache """
+        return CachedResource(self.entry(url, key, mimetype, length), prebuffer)
+
+    def download(self, entry, start):
+        self.info("downloading %r from %d", entry.key, start)
+        download = Download(entry, start)
+        entry.downloads.append(download)
+        headers = Headers()
+        if start:
+            headers.setRawHeaders('range', ['bytes=%d-' % start])
+        d = self.agent.request('GET', entry.url, headers)
+
+        def got_response(response):
+            if response.code not in (http.OK, http.PARTIAL_CONTENT):
+                response.deliverBody(protocol.Protocol())
+                raise ValueError('%d %s' % (response.code, response.phrase))
+            if response.code == http.PARTIAL_CONTENT:
+                content_range = response.headers.getRawHeaders('content-range', [''])[0]
+                try:
+                    first, total = content_range.split(' ', 1)[1].split('-', 1)[0], \
+                                   content_range.rsplit('/', 1)[1]
+                    if int(first) != start:
+                        raise ValueError(content_range)
+                except (IndexError, ValueError):
+                    response.deliverBody(protocol.Protocol())
+                    raise ValueError('bad content-range %r' % content_range)
+                if total != '*' and entry.length is None:
+                    entry.length = int(total)
+            else:
+                # the server doesn't do ranges
+                download.skip = start
+                if entry.length is None and response.length != client.UNKNOWN_LENGTH:
+                    entry.length = response.length
+            content_type = response.headers.getRawHeaders('content-type')
+            if entry.mimetype is None and content_type:
+                entry.mimetype = content_type[0]
+            if not os.path.exists(entry.path):
+                open(entry.path, 'wb').close()
+            download.file = open(entry.path, 'r+b')
+            response.deliverBody(download)
+            self.changed()
+            return download.finished
+
+        def failed(failure):
+            self.warning("downloading %r failed: %s", entry.key, failure.getErrorMessage())
+            entry.download_done(download, failed=True)
+        d.addCallback(got_response)
+        d.addErrback(failed)
+        return d
+
+    def touch(self, entry):
+        if self.entries.get(entry.key) is entry:
+            self.entries[entry.key] = self.entries.pop(entry.key)
+
+    def stored(self, entry, length):
+        """ length bytes more of entry are in the cache """
+        self.size += length
+        self.changed()
+        if self.size > self.maxsize and self._evict_call is None:
+            self._evict_call = self.reactor.callLater(0, self.evict)
+
+    def evict(self):
+        """ remove the least recently used entries until the cache fits
+            into maxsize again """
+        self._evict_call = None
+        for key, entry in list(self.entries.items()):
+            if self.size <= self.maxsize:
+                break
+            if entry.readers or entry.downloads:
+                continue
+            del self.entries[key]
+            self.size -= entry.stored
+            self.info("evicting %r, %d bytes", key, entry.stored)
+            try:
+                os.unlink(entry.path)
+            except OSError:
+                pass
+        self.changed()
+
+    def changed(self):
+        if self._save_call is None:
+            self._save_call = self.reactor.callLater(self.save_delay, self.save)
+
+    def load(self):
+        """ read the index, removing the cache files it doesn't know of,
+            anything else in the directory is left alone """
+        index = os.path.join(self.directory, 'index.json')
+        try:
+            with open(index) as f:
+                records = json.load(f)
+        except (IOError, ValueError):
+            records = []
+        known = set(['index.json'])
+        for key, url, length, mimetype, chunks in records:
+            key, url = key.encode('utf-8'), url.encode('utf-8')
+            path = self.path(key)
+            if not os.path.exists(path):
+                continue
+            entry = CacheEntry(self, key, url, path, length, mimetype, chunks)
+            self.entries[key] = entry
+            self.size += entry.stored
+            known.add(os.path.basename(path))
+        for name in os.listdir(self.directory):
+            if name not in known and CACHE_FILE.match(name):
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def save(self):
+        if self._save_call is not None:
+            if self._save_call.active():
+                self._save_call.cancel()
+            self._save_call = None
+        if self.agent is None:
+            return
+        records = [(entry.key, entry.url, entry.length, entry.mimetype,
+                    sorted(entry.chunks))
+                   for entry in self.entries.values()]
+        index = os.path.join(self.directory, 'index.json')
+        try:
+            with open(index + '.part', 'w') as f:
+                json.dump(records, f)
+            os.rename(index + '.part', index)
+        except (IOError, OSError), msg:
+            self.warning("saving the index failed: %s", msg)
+
+
+cache = ProxyCache()
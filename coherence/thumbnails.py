@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+""" thumbnails of images and videos in the DLNA sizes
+
+    renditions are rendered by a pool of at most workers worker
+    processes, running this module with the Python Imaging Library, and,
+    for a video, ffmpeg to grab a frame first. a worker renders one
+    rendition after the other and quits when it has been idle for
+    idle_timeout seconds
+
+    they are kept in a cache directory, named by a hash of the source
+    path, its mtime and the DLNA profile, so a changed file gets new
+    renditions and the cache survives restarts. what is in the cache is
+    listed once, so a scan doesn't look for every rendition on the disk
+
+    renditions asked for by a client are rendered before the ones for
+    the folders being scanned, which are prepared in the background
+
+    run as a script it renders one rendition:
+
+        python -m coherence.thumbnails <source> <destination> <profile>
+
+    or, with --worker, the renditions given as JSON lines on stdin,
+    answering each with a JSON line, the error or null
+"""
+
+import hashlib
+import json
+import mimetypes
+import os
+import subprocess
+import sys
+
+from collections import deque, OrderedDict
+
+from twisted.internet import defer, protocol, reactor
+from twisted.web import http, resource, server, static
+
+from coherence import log
+
+# DLNA profile: mimetype, PIL format, maximal width and height
+PROFILES = {'JPEG_TN': ('image/jpeg', 'JPEG', 160, 160),
+            'JPEG_SM': ('image/jpeg', 'JPEG', 640, 480),
+            'PNG_TN': ('image/png', 'PNG', 160, 160)}
+
+EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png'}
+
+# seconds into a video its thumbnail is taken from
+VIDEO_FRAME_AT = 5
+
+# where the workers import us from, taken before anyone changes the
+# working directory
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def image_module():
+    """ the Image module of the Python Imaging Library, None without it """
+    try:
+        from PIL import Image
+    except ImportError:
+        try:
+            import Image
+        except ImportError:
+            return None
+    return Image
+
+
+def renderer_available():
+    """ whether we have the Python Imaging Library for the workers """
+    return image_module() is not None
+
+
+class ThumbnailFailed(Exception):
+    """ the rendition couldn't be rendered """
+
+
+def _bytes(path):
+    if isinstance(path, unicode):
+        return path.encode(sys.getfilesystemencoding() or 'utf-8')
+    return path
+
+
+class ThumbnailWorker(protocol.ProcessProtocol):
+    """ a worker process of the L{ThumbnailService}, rendering one
+        rendition after the other """
+
+    def __init__(self, service):
+        self.service = service
+        self.buffer = ''
+        self.job = None
+        self.stop_call = None
+
+    def run(self, source, path, profile):
+        """ returns a Deferred firing once the rendition is rendered """
+        self.job = defer.Deferred()
+        # the paths as bytes, which go through JSON as latin-1
+        job = [_bytes(source), _bytes(path), profile]
+        self.transport.write(json.dumps(job, encoding='latin-1') + '\n')
+        return self.job
+
+    def outReceived(self, data):
+        self.buffer += data
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            job, self.job = self.job, None
+            if job is None:
+                continue
+            try:
+                error = json.loads(line)
+            except ValueError:
+                error = 'garbled answer %r' % line
+            # free for the next rendition before the waiters are told
+            self.service._worker_idle(self)
+            if error:
+                job.errback(ThumbnailFailed(error))
+            else:
+                job.callback(None)
+
+    def errReceived(self, data):
+        self.service.debug("worker: %s", data.rstrip())
+
+    def stop(self):
+        self.stop_call = None
+        # not to be handed another rendition while it ends
+        if self in self.service.idle:
+            self.service.idle.remove(self)
+        self.transport.closeStdin()
+
+    def processEnded(self, reason):
+        if self.stop_call is not None and self.stop_call.active():
+            self.stop_call.cancel()
+        self.stop_call = None
+        self.service._worker_ended(self)
+        job, self.job = self.job, None
+        if job is not None:
+            job.errback(ThumbnailFailed(reason.getErrorMessage()))
+
+
+class ThumbnailService(log.Loggable):
+    """
+    Renders and caches the renditions, see the module docstring.
+
+    directory and workers are set from the MediaServer config.
+    """
+    logCategory = 'thumbnails'
+
+    directory = os.path.expanduser('~/.cache/coherence/thumbnails')
+    workers = 2
+    # seconds an idle worker waits for the next rendition
+    idle_timeout = 30
+    # the failed renditions that are remembered
+    max_failed = 1000
+    image_profiles = ('JPEG_TN', 'JPEG_SM')
+    video_profiles = ('JPEG_TN',)
+
+    def __init__(self, reactor=reactor):
+        log.Loggable.__init__(self)
+        self.reactor = reactor
+        self.running = 0
+        # (source, rendition, profile), wanted by a client and background
+        self.queue = deque()
+        self.background = deque()
+        # the Deferreds waiting for a rendition by its path
+        self.pending = {}
+        # renditions that can't be rendered, not tried again
+        self.failed = OrderedDict()
+        # the renditions in the cache, with their size if we know it
+        self.renditions = None
+        # the worker processes, and those waiting for a rendition
+        self.pool = []
+        self.idle = []
+        self.shutdown_trigger = None
+
+    def profiles(self, mimetype):
+        if mimetype.startswith('video/'):
+            return self.video_profiles
+        return self.image_profiles
+
+    def rendition(self, source, mtime, profile):
+        """ the path of the rendition of source in the cache """
+        format = PROFILES[profile][1]
+        key = hashlib.sha1('%s\0%r\0%s' % (_bytes(source), mtime, profile)).hexdigest()
+        return os.path.join(self.directory, key[:2], key + EXTENSIONS[format])
+
+    def _index(self):
+        """ the renditions in the cache, from one listing of each of its
+            directories """
+        if self.renditions is None:
+            self.renditions = {}
+            try:
+                folders = os.listdir(self.directory)
+            except OSError:
+                folders = []
+            for folder in folders:
+                folder = os.path.join(self.directory, folder)
+                try:
+                    names = os.listdir(folder)
+                except OSError:
+                    continue
+                for name in names:
+                    if not name.endswith('.part'):
+                        self.renditions[os.path.join(folder, name)] = None
+        return self.renditions
+
+    def cached(self, source, mtime, profile):
+        """ return the path of the rendition and its size, None if it
+            isn't known, if it is in the cache, None otherwise """
+        path = self.rendition(source, mtime, profile)
+        renditions = self._index()
+        if path in renditions:
+            return path, renditions[path]
+        return None
+
+    def generate(self, source, mtime, profile, background=False):
+        """ return a Deferred firing with the path of the rendition,
+            once it is rendered """
+        path = self.rendition(source, mtime, profile)
+        if path in self.failed:
+            return defer.fail(ThumbnailFailed(source, profile))
+        if path in self._index():
+            return defer.succeed(path)
+        d = defer.Deferred()
+        waiting = self.pending.get(path)
+        if waiting is not None:
+            waiting.append(d)
+            if not background:
+                self._promote(path)
+            return d
+        self.pending[path] = [d]
+        job = (source, path, profile)
+        if background:
+            self.background.append(job)
+        else:
+            self.queue.append(job)
+        self._dispatch()
+        return d
+
+    def prefetch(self, source, mtime, mimetype, exclude=None):
+        """ render the renditions of source not in the cache yet,
+            in the background, but the one of profile exclude """
+        for profile in self.profiles(mimetype):
+            if profile != exclude and self.cached(source, mtime, profile) is None:
+                d = self.generate(source, mtime, profile, background=True)
+                d.addErrback(lambda _: None)
+
+    def _promote(self, path):
+        for job in self.background:
+            if job[1] == path:
+                self.background.remove(job)
+                self.queue.append(job)
+                break
+
+    def _dispatch(self):
+        while self.running < self.workers and (self.queue or self.background):
+            if self.queue:
+                source, path, profile = self.queue.popleft()
+            else:
+                source, path, profile = self.background.popleft()
+            self.running += 1
+            d = defer.maybeDeferred(self.render, source, path, profile)
+            d.addCallbacks(self._rendered, self._failed,
+                           errbackArgs=(source, path, profile))
+
+    def render(self, source, path, profile):
+        """ render in a worker process of the pool, returns a Deferred """
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if self.idle:
+            worker = self.idle.pop()
+            if worker.stop_call is not None:
+                worker.stop_call.cancel()
+                worker.stop_call = None
+        else:
+            worker = self._spawn()
+        d = worker.run(source, path, profile)
+        d.addCallback(lambda _: path)
+        return d
+
+    def _spawn(self):
+        worker = ThumbnailWorker(self)
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [PACKAGE_ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+        self.reactor.spawnProcess(worker, sys.executable,
+                [sys.executable, '-m', 'coherence.thumbnails', '--worker'], env=env)
+        self.pool.append(worker)
+        if self.shutdown_trigger is None:
+            self.shutdown_trigger = self.reactor.addSystemEventTrigger(
+                'before', 'shutdown', self.shutdown)
+        return worker
+
+    def _worker_idle(self, worker):
+        self.idle.append(worker)
+        worker.stop_call = self.reactor.callLater(self.idle_timeout, worker.stop)
+
+    def _worker_ended(self, worker):
+        if worker in self.pool:
+            self.pool.remove(worker)
+        if worker in self.idle:
+            self.idle.remove(worker)
+
+    def shutdown(self):
+        """ stop the workers, the renditions being rendered are dropped """
+        for worker in list(self.pool):
+            if worker.stop_call is not None and worker.stop_call.active():
+                worker.stop_call.cancel()
+            worker.stop()
+
+    def _rendered(self, path):
+        self.running -= 1
+        try:
+            self._index()[path] = os.path.getsize(path)
+        except OSError:
+            self._index()[path] = None
+        for d in self.pending.pop(path, []):
+            d.callback(path)
+        self._dispatch()
+
+    def _failed(self, failure, source, path, profile):
+        self.running -= 1
+        self.warning("no %s thumbnail for %r: %s", profile, source,
+                     failure.getErrorMessage())
+        self.failed[path] = True
+        while len(self.failed) > self.max_failed:
+            self.failed.popitem(last=False)
+        for d in self.pending.pop(path, []):
+            d.errback(ThumbnailFailed(source, profile))
+        self._dispatch()
+
+
+class ThumbnailResource(resource.Resource, log.Loggable):
+    """ a rendition, served from the cache once it is rendered """
+    logCategory = 'thumbnails'
+    isLeaf = True
+
+    def __init__(self, service, source, mtime, profile):
+        resource.Resource.__init__(self)
+        log.Loggable.__init__(self)
+        self.service = service
+        self.source = source
+        self.mtime = mtime
+        self.profile = profile
+
+    def render(self, request):
+        try:
+            # the file might have changed since the item was created
+            self.mtime = os.stat(self.source).st_mtime
+        except OSError:
+            pass
+        d = self.service.generate(self.source, self.mtime, self.profile)
+
+        def rendered(path):
+            if request.finished:
+                return
+            result = static.File(path, defaultType=PROFILES[self.profile][0]).render(request)
+            if result != server.NOT_DONE_YET:
+                request.write(result)
+                request.finish()
+
+        def failed(failure):
+            failure.trap(ThumbnailFailed)
+            if request.finished:
+                return
+            request.setResponseCode(http.NOT_FOUND)
+            request.write('<html><p>no thumbnail available</p></html>')
+            request.finish()
+        d.addCallbacks(rendered, failed)
+        return server.NOT_DONE_YET
+
+
+service = ThumbnailService()
+
+
+def render(source, destination, profile):
+    """ render the rendition, in a worker process """
+    Image = image_module()
+    if Image is None:
+        raise ImportError('the Python Imaging Library is missing')
+    _, format, width, height = PROFILES[profile]
+    mimetype, _ = mimetypes.guess_type(source, strict=False)
+    frame = None
+    if mimetype is not None and mimetype.startswith('video/'):
+        frame = destination + '.frame.png'
+        for position in (VIDEO_FRAME_AT, 0):
+            # too short for the first try maybe
+            subprocess.call(['ffmpeg', '-loglevel', 'error', '-y',
+                             '-ss', str(position), '-i', source,
+                             '-frames:v', '1', frame])
+            if os.path.exists(frame):
+                break
+        source = frame
+    try:
+        image = Image.open(source)
+        # JPEGs are decoded at a fraction of their size right away
+        image.draft('RGB', (width, height))
+        image = image.convert('RGB')
+        image.thumbnail((width, height), Image.ANTIALIAS)
+        partial = destination + '.part'
+        image.save(partial, format)
+        os.rename(partial, destination)
+    finally:
+        if frame is not None and os.path.exists(frame):
+            os.unlink(frame)
+
+
+def worker():
+    """ render the renditions read from stdin, one after the other """
+    for line in iter(sys.stdin.readline, ''):
+        try:
+            render(*[field.encode('latin-1') for field in json.loads(line)])
+            error = None
+        except Exception, msg:
+            error = str(msg) or msg.__class__.__name__
+        sys.stdout.write(json.dumps(error, encoding='latin-1') + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--worker']:
+        worker()
+        sys.exit(0)
+    try:
+        render(*sys.argv[1:4])
+    except Exception, msg:
+        sys.stderr.write('%s\n' % msg)
+        sys.exit(1)
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+""" a disk cache for the output of the transcoders
+
+    every transcode of a local file is written to a file in the cache
+    directory, keyed by the source path, its mtime and the transcoder
+    name, and all requests are served from that file - while it is
+    still growing the response follows the transcoder, once it is
+    complete it is served like any other local media file
+
+    so replaying or seeking in a transcoded item doesn't start another
+    transcoder, and byte ranges can be served, of what has been
+    transcoded so far at least
+
+    the cache is limited to maxsize bytes, the least recently used
+    complete files are removed in the background
+"""
+
+import hashlib
+import os
+import re
+import sys
+import urllib
+
+from collections import OrderedDict
+
+from twisted.internet import defer, reactor, task, threads
+from twisted.web import http, server, static
+
+from coherence import log
+from coherence.transcode_pool import pool
+from coherence.upnp.core.streaming import MediaFile
+from coherence.upnp.core.utils import GrowingFile, BufferFileTransfer
+
+
+def source_path(uri):
+    """ the local path of a transcoder source uri, None for remote ones """
+    if uri.startswith('file://'):
+        return urllib.unquote(uri[7:])
+    if '://' in uri:
+        return None
+    return uri
+
+
+class CacheWriter(log.Loggable):
+    """
+    Poses as the request for a transcoder, writing what it gets to the
+    cache file and telling the L{GrowingFile} about it.
+
+    GStreamer transcoders write from their streaming thread, so the
+    readers are woken up in the reactor thread.
+    """
+    logCategory = 'transcode_cache'
+
+    def __init__(self, entry):
+        log.Loggable.__init__(self)
+        self.entry = entry
+        # for transcoders looking at the request arguments
+        self.args = {}
+        self.file = open(entry.path, 'wb')
+        self.finished = False
+        self.producer = None
+        self._notifications = []
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        if not streaming:
+            # the disk takes whatever we get, pull it all at once
+            producer.resumeProducing()
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        if self.finished or not data:
+            return
+        self.file.write(data)
+        self.file.flush()
+        reactor.callFromThread(self.entry.growing_file.written, len(data))
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.file.close()
+        reactor.callFromThread(self._finished, True)
+
+    def abort(self):
+        """ the transcoder failed, what we have so far is of no use """
+        if self.finished:
+            return
+        self.finished = True
+        self.file.close()
+        reactor.callFromThread(self._finished, False)
+
+    def stop(self):
+        """ stop the transcoder, nobody is waiting for its output """
+        if self.finished:
+            return
+        self.finished = True
+        self.file.close()
+        if self.producer is not None:
+            producer, self.producer = self.producer, None
+            producer.stopProducing()
+        # GStreamer transcoders stop on the notifyFinish of their request
+        self._finished(False)
+
+    def _finished(self, complete):
+        self.entry.finished(complete)
+        notifications, self._notifications = self._notifications, []
+        for d in notifications:
+            d.callback(None)
+
+    def notifyFinish(self):
+        d = defer.Deferred()
+        if self.finished:
+            d.callback(None)
+        else:
+            self._notifications.append(d)
+        return d
+
+
+class CacheEntry(object):
+
+    def __init__(self, cache, key, path, content_type):
+        self.cache = cache
+        self.key = key
+        self.path = path
+        self.content_type = content_type
+        self.growing_file = GrowingFile(path)
+        self.complete = False
+        self.failed = False
+        self.readers = 0
+        self.writer = None
+        # stopping the transcoder once the last reader is gone
+        self.abandon_call = None
+
+    @property
+    def size(self):
+        return self.growing_file.size
+
+    def finished(self, complete):
+        self.complete = complete
+        self.failed = not complete
+        self.growing_file.finish()
+        self.cache.entry_finished(self)
+
+
+class TranscodedFile(static.File, log.Loggable):
+    """
+    A transcoded item served from its L{CacheEntry}.
+
+    A complete file is handed to L{MediaFile}. While the transcoder is
+    still at it, a GET without a range follows the file until it is
+    complete, a single range is answered with what is available of it,
+    waiting for its first byte if necessary, with an unknown total size.
+    """
+    logCategory = 'transcode_cache'
+    isLeaf = True
+
+    def __init__(self, entry):
+        static.File.__init__(self, entry.path)
+        log.Loggable.__init__(self)
+        self.entry = entry
+        self.type = entry.content_type
+        self.encoding = None
+
+    def render_GET(self, request):
+        self.entry.readers += 1
+        if self.entry.abandon_call is not None:
+            self.entry.abandon_call.cancel()
+            self.entry.abandon_call = None
+        request.notifyFinish().addBoth(self._reader_done)
+        return self._render_entry(request)
+    render_HEAD = render_GET
+
+    def _render_entry(self, request):
+        entry = self.entry
+        if entry.failed:
+            request.setResponseCode(http.NOT_FOUND)
+            return '<html><p>transcoding failed</p></html>'
+        if entry.complete:
+            media = MediaFile(entry.path)
+            media.type = entry.content_type
+            media.encoding = None
+            return media.render(request)
+        return self._render_growing(request)
+
+    def _reader_done(self, result):
+        self.entry.readers -= 1
+        self.entry.cache.touch(self.entry)
+        if not self.entry.readers:
+            self.entry.cache.reader_gone(self.entry)
+
+    def _render_growing(self, request):
+        growing_file = self.entry.growing_file
+        request.setHeader('content-type', self.type)
+        request.setHeader('accept-ranges', 'bytes')
+        start, end = 0, sys.maxint
+        range = request.getHeader('range')
+        if range is not None:
+            try:
+                ranges = self._parseRangeHeader(range)
+            except ValueError:
+                ranges = []
+            # suffix ranges have to wait for the end, multiple ranges
+            # get all of it
+            if len(ranges) == 1 and ranges[0][0] is not None:
+                start = ranges[0][0]
+                if start >= growing_file.size:
+                    return self._render_when_available(request, start)
+                end = growing_file.size - 1
+                if ranges[0][1] is not None:
+                    end = min(end, ranges[0][1])
+                request.setResponseCode(http.PARTIAL_CONTENT)
+                request.setHeader('content-range', 'bytes %d-%d/*' % (start, end))
+                request.setHeader('content-length', str(end - start + 1))
+        if request.method == 'HEAD':
+            return ''
+        f = open(self.entry.path, 'rb')
+        f.seek(start)
+        BufferFileTransfer(f, end + 1, request, growing_file)
+        return server.NOT_DONE_YET
+
+    def _render_when_available(self, request, offset):
+        d = self.entry.growing_file.wait_for(offset)
+        request.notifyFinish().addErrback(lambda _: d.cancel())
+
+        def render(_):
+            if request.finished:
+                return
+            result = self._render_entry(request)
+            if result != server.NOT_DONE_YET:
+                request.write(result)
+                request.finish()
+
+        d.addCallbacks(render, lambda f: f.trap(defer.CancelledError))
+        return server.NOT_DONE_YET
+
+
+class TranscodeCache(log.Loggable):
+    """ the cache entries by key, least recently used first """
+    logCategory = 'transcode_cache'
+
+    evict_interval = 60
+    # seconds a transcode goes on without readers, for a client coming
+    # back with its next range request
+    abandon_timeout = 10
+    # the names of the files we write, only those are removed of what
+    # a former run left in the directory
+    prefix = 'transcode-'
+    filename_pattern = re.compile(r'^transcode-[0-9a-f]{40}\..+$')
+
+    def __init__(self, directory, maxsize, reactor=reactor):
+        log.Loggable.__init__(self)
+        self.reactor = reactor
+        self.directory = directory
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.evict_loop = None
+        # removing the files of a former run
+        self.cleaning = None
+
+    def _prepare(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        else:
+            # we don't know what the files from a former run are,
+            # the directory may hold other files though
+            self.cleaning = self._remove([os.path.join(self.directory, name)
+                                          for name in os.listdir(self.directory)
+                                          if self.filename_pattern.match(name)])
+        self.evict_loop = task.LoopingCall(self.evict)
+        self.evict_loop.start(self.evict_interval, now=False)
+
+    def key(self, uri, name, transcoder_class):
+        if not getattr(transcoder_class, 'cacheable', True):
+            return None
+        path = source_path(uri)
+        if path is None:
+            return None
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        return (path, mtime, name)
+
+    def resource(self, uri, name, transcoder_class):
+        """ return the resource serving uri transcoded by the
+            transcoder_class named name, None if it can't be cached """
+        key = self.key(uri, name, transcoder_class)
+        if key is None:
+            return None
+        entry = self.entries.get(key)
+        if entry is None or entry.failed:
+            entry = self.transcode(key, uri, transcoder_class)
+        else:
+            self.touch(entry)
+        return TranscodedFile(entry)
+
+    def transcode(self, key, uri, transcoder_class):
+        if self.evict_loop is None:
+            self._prepare()
+        transcoder = transcoder_class(uri)
+        filename = self.prefix + hashlib.sha1(repr(key)).hexdigest() + '.' + key[2]
+        entry = CacheEntry(self, key, os.path.join(self.directory, filename),
+                           getattr(transcoder, 'contentType', None))
+        self.entries[key] = entry
+        self.info("transcoding %r with %r into %s", uri, key[2], entry.path)
+        writer = entry.writer = CacheWriter(entry)
+        try:
+            d = pool.start(key[2], transcoder, writer)
+        except:
+            del self.entries[key]
+            writer.abort()
+            raise
+        d.addCallbacks(lambda _: self.watch(transcoder, writer),
+                       self._start_failed, errbackArgs=(writer,))
+        return entry
+
+    def _start_failed(self, failure, writer):
+        self.warning("starting transcoder for %r failed: %s",
+                     writer.entry.key, failure.getErrorMessage())
+        writer.abort()
+
+    def watch(self, transcoder, writer):
+        """ abort the writer when a GStreamer pipeline fails, it won't
+            see the end of the stream then """
+        pipeline = getattr(transcoder, 'pipeline', None)
+        if not hasattr(pipeline, 'get_bus'):
+            return
+        bus = pipeline.get_bus()
+        bus.add_signal_watch()
+
+        def on_message(bus, message):
+            self.warning("transcoder %r failed: %r", transcoder,
+                         message.parse_error())
+            writer.abort()
+            transcoder.cleanup()
+        bus.connect('message::error', on_message)
+
+    def touch(self, entry):
+        if self.entries.get(entry.key) is entry:
+            self.entries[entry.key] = self.entries.pop(entry.key)
+
+    def reader_gone(self, entry):
+        if entry.complete or entry.failed or entry.abandon_call is not None:
+            return
+        entry.abandon_call = self.reactor.callLater(self.abandon_timeout,
+                                                    self.abandon, entry)
+
+    def abandon(self, entry):
+        """ stop the transcode of entry nobody reads anymore, freeing
+            its transcoder slot """
+        entry.abandon_call = None
+        if entry.readers or entry.complete or entry.failed:
+            return
+        self.info("no readers left for %r, stopping its transcoder", entry.key)
+        entry.writer.stop()
+
+    def entry_finished(self, entry):
+        if entry.abandon_call is not None:
+            entry.abandon_call.cancel()
+            entry.abandon_call = None
+        if entry.failed:
+            if self.entries.get(entry.key) is entry:
+                del self.entries[entry.key]
+            self._remove([entry.path])
+        else:
+            self.info("transcoded %r, %d bytes", entry.key, entry.size)
+            reactor.callLater(0, self.evict)
+
+    def evict(self):
+        """ remove the least recently used complete files until the
+            cache fits into maxsize again """
+        size = sum(entry.size for entry in self.entries.values())
+        remove = []
+        for key, entry in list(self.entries.items()):
+            if size <= self.maxsize:
+                break
+            if not entry.complete or entry.readers:
+                continue
+            del self.entries[key]
+            size -= entry.size
+            remove.append(entry.path)
+        if remove:
+            self.info("evicting %d transcoded files", len(remove))
+            self._remove(remove)
+
+    def _remove(self, paths):
+        def remove():
+            for path in paths:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+        return threads.deferToThread(remove)
+
+    def shutdown(self):
+        if self.evict_loop is not None and self.evict_loop.running:
+            self.evict_loop.stop()
+        for entry in self.entries.values():
+            if entry.abandon_call is not None:
+                entry.abandon_call.cancel()
+                entry.abandon_call = None
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+""" flow control between a transcoder and the requests it feeds
+
+    a transcoder produces at its own pace, a client on a slow link takes
+    less. Every request gets an L{OutputBuffer}, a push producer which
+    keeps what the request's transport can't take right now. Once a
+    buffer holds more than max_buffered bytes the L{FlowControl} either
+    blocks the source until the buffers are down to half of that again,
+    or, with the 'drop' policy, drops the output for that client until
+    it caught up. Dropping keeps the others going and suits streams that
+    resync by themselves, like MPEG-TS or MP3.
+
+    the source is blocked by pausing its producer, an external process,
+    or, for a GStreamer streaming thread, by having it wait in L{wait}.
+"""
+
+import threading
+
+from collections import deque
+
+from twisted.python import threadable
+
+from coherence import log
+from coherence.upnp.core import shaping
+
+
+class OutputBuffer(object):
+    """ the output of a transcoder for one request, see the module
+        docstring """
+
+    def __init__(self, flow, request):
+        self.flow = flow
+        self.request = request
+        self.pending = deque()
+        self.buffered = 0
+        self.dropped = 0
+        self.paused = False
+        self.finishing = False
+        shaping.register_producer(request, self, True)
+
+    def write(self, data):
+        if self.request is None:
+            return
+        if not self.paused and not self.pending:
+            self.request.write(data)
+            return
+        if self.flow.policy == 'drop' and self.buffered >= self.flow.max_buffered:
+            self.dropped += len(data)
+            return
+        self.pending.append(data)
+        self.buffered += len(data)
+
+    def finish(self):
+        """ finish the request once everything buffered is written """
+        self.finishing = True
+        if not self.pending:
+            self._finish()
+
+    def _finish(self):
+        request, self.request = self.request, None
+        if request is not None:
+            request.unregisterProducer()
+            request.finish()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        while self.pending and not self.paused and self.request is not None:
+            data = self.pending.popleft()
+            self.buffered -= len(data)
+            # may pause us again
+            self.request.write(data)
+        if self.finishing and not self.pending:
+            self._finish()
+        self.flow.drained()
+
+    def stopProducing(self):
+        self.request = None
+        self.pending.clear()
+        self.buffered = 0
+        self.flow.drained()
+
+
+class FlowControl(log.Loggable):
+    """
+    The L{OutputBuffer}s of the requests fed by one transcoder, and the
+    gate of its source.
+
+    max_buffered and policy are set from the config, as
+    transcoding_max_buffered and transcoding_slow_clients.
+    """
+    logCategory = 'transcode_flow'
+
+    max_buffered = 4 * 2 ** 20
+    # 'block' or 'drop'
+    policy = 'block'
+
+    def __init__(self):
+        log.Loggable.__init__(self)
+        self.outputs = {}
+        # a push producer we can pause
+        self.source = None
+        self.blocked = False
+        self.writable = threading.Event()
+        self.writable.set()
+
+    def add(self, request):
+        output = OutputBuffer(self, request)
+        self.outputs[request] = output
+        return output
+
+    def remove(self, request):
+        output = self.outputs.pop(request, None)
+        if output is not None:
+            if output.dropped:
+                self.info("dropped %d bytes for the slow %r", output.dropped, request)
+            output.stopProducing()
+
+    def write(self, data):
+        for output in self.outputs.values():
+            output.write(data)
+        if self.policy == 'block' and not self.blocked:
+            if any(output.buffered > self.max_buffered
+                   for output in self.outputs.values()):
+                self.block()
+
+    def drained(self):
+        if not self.blocked:
+            return
+        low = self.max_buffered / 2
+        if all(output.buffered <= low for output in self.outputs.values()):
+            self.unblock()
+
+    def block(self):
+        self.debug("blocking the transcoder, a client is too slow")
+        self.blocked = True
+        self.writable.clear()
+        if self.source is not None:
+            self.source.pauseProducing()
+
+    def unblock(self):
+        self.blocked = False
+        self.writable.set()
+        if self.source is not None:
+            self.source.resumeProducing()
+
+    def wait(self):
+        """ called by a transcoder thread after a write, waits while the
+            source is blocked """
+        if not threadable.isInIOThread():
+            self.writable.wait()
+
+    def finish(self):
+        """ finish all requests, after writing what they have buffered """
+        outputs, self.outputs = self.outputs, {}
+        for output in outputs.values():
+            output.finish()
+        self.close()
+
+    def close(self):
+        """ no more writes, release a waiting transcoder thread """
+        self.source = None
+        self.blocked = False
+        self.writable.set()
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+""" admission control for the transcoders
+
+    every transcoder is started through the L{TranscoderPool}, which runs
+    at most max_running of them at once, and at most the limit configured
+    for a transcoder name of that kind. The others wait in a queue,
+    ordered by priority, playback before thumbnails, then first come
+    first served.
+
+    once queue_size transcoders are waiting new ones are refused with
+    L{TranscoderBusy}, which the MediaServer answers with a 503 and a
+    Retry-After header.
+"""
+
+import bisect
+import itertools
+
+from twisted.internet import defer, reactor
+from twisted.web import http, resource, server
+
+from coherence import log
+
+PRIORITY_PLAYBACK = 0
+PRIORITY_BACKGROUND = 10
+
+
+class TranscoderBusy(Exception):
+    """ too many transcoders waiting already """
+
+    def __init__(self, retry_after):
+        Exception.__init__(self, retry_after)
+        self.retry_after = retry_after
+
+
+class Job(object):
+
+    def __init__(self, name, transcoder, request, priority):
+        self.name = name
+        self.transcoder = transcoder
+        self.request = request
+        self.priority = priority
+        self.queued = reactor.seconds()
+        self.started = None
+        self.deferred = defer.Deferred()
+
+
+class TranscoderPool(log.Loggable):
+    """
+    Starts transcoders as slots become free, see the module docstring.
+
+    A transcoder is started with its request, its slot is taken until
+    the request is finished, as told by its notifyFinish.
+    """
+    logCategory = 'transcode_pool'
+
+    max_running = 2
+    queue_size = 8
+    # seconds a refused client is asked to wait
+    retry_after = 10
+
+    def __init__(self):
+        log.Loggable.__init__(self)
+        # the maximum of running transcoders by name
+        self.limits = {}
+        self.running = {}
+        self.queue = []
+        self._sequence = itertools.count()
+        # finished, total seconds waiting, total seconds running by name
+        self.stats = {}
+        self.rejected = 0
+
+    def start(self, name, transcoder, request, priority=None):
+        """ start transcoder on request as soon as a slot is free
+
+            returns a Deferred firing once it has been started, or
+            failing with the error of its start. Raises L{TranscoderBusy}
+            if the queue is full. """
+        if priority is None:
+            priority = getattr(transcoder, 'priority', PRIORITY_PLAYBACK)
+        job = Job(name, transcoder, request, priority)
+        if self._may_run(name):
+            # anything queued is waiting for a slot of its own kind
+            self._run(job)
+            return job.deferred
+        if len(self.queue) >= self.queue_size:
+            self.rejected += 1
+            self.warning("refusing transcoder %r, %d waiting already, metrics %r",
+                         name, len(self.queue), self.metrics())
+            raise TranscoderBusy(self.retry_after)
+        bisect.insort(self.queue, (priority, self._sequence.next(), job))
+        self.info("transcoder %r queued, %d waiting", name, len(self.queue))
+        request.notifyFinish().addBoth(self._gone, job)
+        return job.deferred
+
+    def _may_run(self, name):
+        if sum(self.running.values()) >= self.max_running:
+            return False
+        limit = self.limits.get(name)
+        return limit is None or self.running.get(name, 0) < limit
+
+    def _run(self, job):
+        job.started = reactor.seconds()
+        self.running[job.name] = self.running.get(job.name, 0) + 1
+        try:
+            job.transcoder.start(job.request)
+        except:
+            self.running[job.name] -= 1
+            job.deferred.errback()
+            self._dispatch()
+            return
+        job.request.notifyFinish().addBoth(self._finished, job)
+        job.deferred.callback(None)
+
+    def _gone(self, result, job):
+        """ the request went away while waiting """
+        for i, (_, _, queued) in enumerate(self.queue):
+            if queued is job:
+                del self.queue[i]
+                self.info("transcoder %r no longer wanted, %d waiting",
+                          job.name, len(self.queue))
+                break
+
+    def _finished(self, result, job):
+        self.running[job.name] -= 1
+        now = reactor.seconds()
+        stats = self.stats.setdefault(job.name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += job.started - job.queued
+        stats[2] += now - job.started
+        self.info("transcoder %r finished after %.1fs, waited %.1fs", job.name,
+                  now - job.started, job.started - job.queued)
+        self._dispatch()
+        self.info("transcoder metrics %r", self.metrics())
+
+    def _dispatch(self):
+        for entry in list(self.queue):
+            if sum(self.running.values()) >= self.max_running:
+                break
+            job = entry[2]
+            if self._may_run(job.name):
+                self.queue.remove(entry)
+                self._run(job)
+
+    def metrics(self):
+        queued = {}
+        for _, _, job in self.queue:
+            queued[job.name] = queued.get(job.name, 0) + 1
+        wait_time = {}
+        wall_time = {}
+        for name, (finished, waited, ran) in self.stats.items():
+            wait_time[name] = waited / finished
+            wall_time[name] = ran / finished
+        return {'running': dict((name, n) for name, n in self.running.items() if n),
+                'queued': queued,
+                'queue_depth': len(self.queue),
+                'rejected': self.rejected,
+                'wait_time': wait_time,
+                'wall_time': wall_time}
+
+
+class Busy(resource.Resource):
+    """ the answer for a refused transcoder """
+    isLeaf = True
+
+    def __init__(self, retry_after):
+        resource.Resource.__init__(self)
+        self.retry_after = retry_after
+
+    def render(self, request):
+        request.setResponseCode(http.SERVICE_UNAVAILABLE)
+        request.setHeader('Retry-After', str(self.retry_after))
+        request.setHeader('Content-Type', 'text/html')
+        return '<html><p>too many transcoders running, try again later</p></html>'
+
+
+class PooledTranscode(resource.Resource, log.Loggable):
+    """ a transcoder that isn't cached or shared, started on its request """
+    logCategory = 'transcode_pool'
+    isLeaf = True
+
+    def __init__(self, name, transcoder):
+        resource.Resource.__init__(self)
+        log.Loggable.__init__(self)
+        self.name = name
+        self.transcoder = transcoder
+
+    def render_GET(self, request):
+        try:
+            d = pool.start(self.name, self.transcoder, request)
+        except TranscoderBusy, busy:
+            return Busy(busy.retry_after).render(request)
+        content_type = getattr(self.transcoder, 'contentType', None)
+        if content_type:
+            request.setHeader('Content-Type', content_type)
+        d.addErrback(request.processingFailed)
+        return server.NOT_DONE_YET
+
+    def render_HEAD(self, request):
+        content_type = getattr(self.transcoder, 'contentType', None)
+        if content_type:
+            request.setHeader('Content-Type', content_type)
+        return ''
+
+pool = TranscoderPool()
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+""" transcoding sessions shared between clients
+
+    a transcode that isn't written to the cache, one from a remote source
+    or with the cache disabled, runs in a L{TranscodeSession} keyed by
+    source uri and transcoder name, so all clients asking for the same
+    stream at the same time get it from one transcoder
+
+    a client joining a running session gets the stream header first,
+    then the output from the current position on. The session is
+    stopped when its last client is gone.
+
+    slow clients are dealt with by the session's L{FlowControl}
+"""
+
+from twisted.internet import defer, error, reactor
+from twisted.web import resource, server
+
+from coherence import log
+from coherence.transcode_flow import FlowControl
+from coherence.transcode_pool import pool, Busy, TranscoderBusy
+
+
+class TranscodeSession(log.Loggable):
+    """
+    One running transcoder and the requests attached to it.
+
+    Poses as the request for the transcoder, like the cache's
+    CacheWriter does, and writes what it gets to all the requests.
+
+    The stream header is what the transcoder hands to set_header,
+    otherwise the first header_size bytes of its output, as given by
+    its header_size attribute.
+    """
+    logCategory = 'transcode_session'
+
+    def __init__(self, registry, key, transcoder):
+        log.Loggable.__init__(self)
+        self.registry = registry
+        self.key = key
+        self.transcoder = transcoder
+        # for transcoders looking at the request arguments
+        self.args = {}
+        self.requests = []
+        self.header = ''
+        self.header_size = getattr(transcoder, 'header_size', 0)
+        self.written = 0
+        self.finished = False
+        self.producer = None
+        self.flow = FlowControl()
+        self._notifications = []
+
+    def attach(self, request):
+        self.requests.append(request)
+        output = self.flow.add(request)
+        if self.header:
+            output.write(self.header)
+        request.notifyFinish().addBoth(self._detach, request)
+
+    def _detach(self, result, request):
+        if request in self.requests:
+            self.requests.remove(request)
+        self.flow.remove(request)
+        if not self.requests and not self.finished:
+            self.info("no clients left for %r", self.key)
+            self.stop()
+
+    def stop(self):
+        """ stop the transcoder, as if its request had gone away """
+        self.finished = True
+        self.registry.remove(self)
+        # a GStreamer thread waiting for the clients can't be stopped
+        self.flow.close()
+        if self.producer is not None:
+            producer, self.producer = self.producer, None
+            producer.stopProducing()
+        self._notify(error.ConnectionDone('no clients left'))
+
+    def _notify(self, result):
+        notifications, self._notifications = self._notifications, []
+        for d in notifications:
+            if isinstance(result, Exception):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    # the request interface for the transcoder, which might call it from
+    # a GStreamer thread
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        if streaming:
+            self.flow.source = producer
+            if self.flow.blocked:
+                producer.pauseProducing()
+        else:
+            # can't be paused, pull it all at once
+            producer.resumeProducing()
+
+    def unregisterProducer(self):
+        self.producer = None
+        self.flow.source = None
+
+    def set_header(self, header):
+        reactor.callFromThread(self._set_header, header)
+
+    def _set_header(self, header):
+        self.header = header
+        # instead of the first bytes of the output
+        self.header_size = 0
+
+    def write(self, data):
+        reactor.callFromThread(self._write, data)
+        self.flow.wait()
+
+    def _write(self, data):
+        if self.finished or not data:
+            return
+        if self.written < self.header_size:
+            self.header += data[:self.header_size - self.written]
+        self.written += len(data)
+        self.flow.write(data)
+
+    def finish(self):
+        reactor.callFromThread(self._finish)
+
+    def _finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.registry.remove(self)
+        self.info("transcoder for %r finished, %d bytes", self.key, self.written)
+        self.requests = []
+        self.flow.finish()
+        self._notify(None)
+
+    def notifyFinish(self):
+        d = defer.Deferred()
+        if self.finished:
+            d.callback(None)
+        else:
+            self._notifications.append(d)
+        return d
+
+
+class SharedTranscode(resource.Resource, log.Loggable):
+    """ a transcoded item, rendered by attaching to its session """
+    logCategory = 'transcode_session'
+    isLeaf = True
+
+    def __init__(self, registry, key, transcoder_class, uri):
+        resource.Resource.__init__(self)
+        log.Loggable.__init__(self)
+        self.registry = registry
+        self.key = key
+        self.transcoder_class = transcoder_class
+        self.uri = uri
+
+    def render_GET(self, request):
+        # a new transcoder only if there is no session to join
+        transcoder = self.registry.transcoder(self.key, self.transcoder_class, self.uri)
+        content_type = getattr(transcoder, 'contentType', None)
+        if content_type:
+            request.setHeader('Content-Type', content_type)
+        try:
+            self.registry.attach(request, self.key, transcoder)
+        except TranscoderBusy, busy:
+            return Busy(busy.retry_after).render(request)
+        return server.NOT_DONE_YET
+
+    def render_HEAD(self, request):
+        session = self.registry.sessions.get(self.key)
+        if session is not None:
+            content_type = getattr(session.transcoder, 'contentType', None)
+        else:
+            content_type = getattr(self.transcoder_class, 'contentType', None)
+        if content_type:
+            request.setHeader('Content-Type', content_type)
+        return ''
+
+
+class TranscodeSessions(log.Loggable):
+    """ the running sessions by (source uri, transcoder name) """
+    logCategory = 'transcode_session'
+
+    def __init__(self):
+        log.Loggable.__init__(self)
+        self.sessions = {}
+
+    def key(self, uri, name, transcoder_class):
+        # nor the transcoders that can't be cached, their output depends
+        # on the request
+        if not getattr(transcoder_class, 'cacheable', True):
+            return None
+        return (uri, name)
+
+    def resource(self, uri, name, transcoder_class):
+        """ return the resource attaching to the session transcoding uri
+            with the transcoder_class named name, None if it can't be
+            shared """
+        key = self.key(uri, name, transcoder_class)
+        if key is None:
+            return None
+        return SharedTranscode(self, key, transcoder_class, uri)
+
+    def transcoder(self, key, transcoder_class, uri):
+        """ the transcoder of the session of key, a new one if there is
+            no session """
+        session = self.sessions.get(key)
+        if session is not None:
+            return session.transcoder
+        return transcoder_class(uri)
+
+    def attach(self, request, key, transcoder):
+        session = self.sessions.get(key)
+        if session is not None:
+            self.info("%r joins the session for %r, %d clients", request,
+                      key, len(session.requests) + 1)
+            session.attach(request)
+            return session
+        session = TranscodeSession(self, key, transcoder)
+        self.sessions[key] = session
+        session.attach(request)
+        try:
+            d = pool.start(key[1], transcoder, session)
+        except:
+            # the request fails, detaching stops the session
+            self.remove(session)
+            raise
+        d.addErrback(self._start_failed, session)
+        return session
+
+    def _start_failed(self, failure, session):
+        self.warning("starting transcoder for %r failed: %s",
+                     session.key, failure.getErrorMessage())
+        session._finish()
+
+    def remove(self, session):
+        if self.sessions.get(session.key) is session:
+            del self.sessions[session.key]
+
+sessions = TranscodeSessions()
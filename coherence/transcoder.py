@@ -22,9 +22,15 @@ import os.path
 import urllib
 
 from twisted.web import resource, server
-from twisted.internet import protocol
+from twisted.internet import protocol, reactor
 
 from coherence import log
+from coherence.transcode_cache import TranscodeCache
+from coherence.transcode_session import sessions
+from coherence.transcode_flow import FlowControl
+from coherence.transcode_pool import pool, Busy, PooledTranscode, \
+     TranscoderBusy, PRIORITY_BACKGROUND
+from coherence.upnp.core import shaping
 
 import struct
 
@@ -131,6 +137,8 @@ class DataSink(gst.Element, log.Loggable):
     def chainfunc(self, pad, buffer):
         if self.closed:
             return gst.FLOW_OK
+        if not self.data_size:
+            self.check_streamheader(buffer)
         if self.destination is not None:
             self.destination.write(buffer.data)
         elif self.request is not None:
@@ -144,6 +152,17 @@ class DataSink(gst.Element, log.Loggable):
         self.data_size += buffer.size
         return gst.FLOW_OK
 
+    def check_streamheader(self, buffer):
+        """ hand the streamheader to a shared session, for the
+            clients joining later """
+        set_header = getattr(self.request, 'set_header', None)
+        caps = buffer.get_caps()
+        if set_header is None or caps is None:
+            return
+        s = caps[0]
+        if s.has_key("streamheader"):
+            set_header(''.join(h.data for h in s["streamheader"]))
+
     def eventfunc(self, pad, event):
         if event.type == gst.EVENT_NEWSEGMENT:
             if not self.got_new_segment:
@@ -170,6 +189,9 @@ class GStreamerPipeline(resource.Resource, log.Loggable):
         self.pipeline_description = pipeline
         self.contentType = content_type
         self.requests = []
+        # the requests are written to by the appsink signals, from the
+        # streaming thread, which waits here for slow clients
+        self.flow = FlowControl()
         # if stream has a streamheader (something that has to be prepended
         # before any data), then it will be a tuple of GstBuffers
         self.streamheader = None
@@ -192,6 +214,7 @@ class GStreamerPipeline(resource.Resource, log.Loggable):
         self.info("GStreamerPipeline start %r %r", request,
                 self.pipeline_description)
         self.requests.append(request)
+        self.flow.add(request)
         self.pipeline.set_state(gst.STATE_PLAYING)
 
         d = request.notifyFinish()
@@ -207,13 +230,9 @@ class GStreamerPipeline(resource.Resource, log.Loggable):
             if s.has_key("streamheader"):
                 self.streamheader = s["streamheader"]
                 self.debug("setting streamheader")
-                for r in self.requests:
-                    self.debug("writing streamheader")
-                    for h in self.streamheader:
-                        r.write(h.data)
-        for r in self.requests:
-            self.debug("writing preroll")
-            r.write(buffer.data)
+                self.write(''.join(h.data for h in self.streamheader))
+        self.debug("writing preroll")
+        self.write(buffer.data)
 
     def new_buffer(self, appsink):
         buffer = appsink.emit('pull-buffer')
@@ -224,17 +243,19 @@ class GStreamerPipeline(resource.Resource, log.Loggable):
             if s.has_key("streamheader"):
                 self.streamheader = s["streamheader"]
                 self.debug("setting streamheader")
-                for r in self.requests:
-                    self.debug("writing streamheader")
-                    for h in self.streamheader:
-                        r.write(h.data)
-        for r in self.requests:
-            r.write(buffer.data)
+                self.write(''.join(h.data for h in self.streamheader))
+        self.write(buffer.data)
+
+    def write(self, data):
+        reactor.callFromThread(self.flow.write, data)
+        self.flow.wait()
 
     def eos(self, appsink):
         self.info("eos")
-        for r in self.requests:
-            r.finish()
+        reactor.callFromThread(self._eos)
+
+    def _eos(self):
+        self.flow.finish()
         self.cleanup()
 
     def getChild(self, name, request):
@@ -253,11 +274,12 @@ class GStreamerPipeline(resource.Resource, log.Loggable):
            headers['connection'] == 'close'):
             pass
         if self.requests:
+            output = self.flow.add(request)
             if self.streamheader:
                 self.debug("writing streamheader")
-                for h in self.streamheader:
-                    request.write(h.data)
+                output.write(''.join(h.data for h in self.streamheader))
             self.requests.append(request)
+            request.notifyFinish().addBoth(self.requestFinished, request)
         else:
             self.parse_pipeline()
             self.start(request)
@@ -275,7 +297,9 @@ class GStreamerPipeline(resource.Resource, log.Loggable):
         """
         #from twisted.internet import reactor
         #reactor.callLater(0, self.pipeline.set_state, gst.STATE_NULL)
-        self.requests.remove(request)
+        if request in self.requests:
+            self.requests.remove(request)
+        self.flow.remove(request)
         if not self.requests:
             self.cleanup()
 
@@ -291,8 +315,11 @@ class GStreamerPipeline(resource.Resource, log.Loggable):
 
     def cleanup(self):
         self.info("pipeline cleanup")
+        # let the streaming thread go before stopping it
+        self.flow.close()
         self.pipeline.set_state(gst.STATE_NULL)
         self.requests = []
+        self.flow = FlowControl()
         self.streamheader = None
 
 
@@ -386,6 +413,8 @@ class WAVTranscoder(BaseTranscoder, InternalTranscoder):
 
     contentType = 'audio/x-wav'
     name = 'wav'
+    # the RIFF header, replayed to clients joining a shared session
+    header_size = 44
 
     def start(self, request=None):
         self.info("start %r", request)
@@ -469,6 +498,11 @@ class ThumbTranscoder(BaseTranscoder, InternalTranscoder):
     """
     contentType = 'image/jpeg'
     name = 'thumb'
+    # the output depends on the request arguments
+    cacheable = False
+    # behind the playback, and not too many of them at once
+    priority = PRIORITY_BACKGROUND
+    max_running = 1
 
     def start(self, request=None):
         self.info("start %r", request)
@@ -568,6 +602,10 @@ class ExternalProcessProtocol(protocol.ProcessProtocol):
 
 
 class ExternalProcessProducer(object):
+    """ runs the pipeline and writes its output to the request
+
+        a push producer, while the request can't take more we stop
+        reading from the process, which then blocks on its stdout """
     logCategory = 'externalprocess'
 
     def __init__(self, pipeline, request):
@@ -577,9 +615,23 @@ class ExternalProcessProducer(object):
         self.written = 0
         self.data = ''
         self.ended = False
-        request.registerProducer(self, 0)
+        self.paused = False
+        shaping.register_producer(request, self, True)
+        if self.request:
+            self.spawn()
+
+    def spawn(self):
+        argv = self.pipeline.split()
+        executable = argv[0]
+        argv[0] = os.path.basename(argv[0])
+        self.process = reactor.spawnProcess(ExternalProcessProtocol(self),
+                executable, argv, {})
+        if self.paused:
+            self.process.pauseProducing()
 
     def write_data(self, data):
+        if not self.request:
+            return
         if data:
             #print "write %d bytes of data" % len(data)
             self.written += len(data)
@@ -594,25 +646,23 @@ class ExternalProcessProducer(object):
 
     def resumeProducing(self):
         #print "resumeProducing", self.request
-        if not self.request:
-            return
-        if self.process is None:
-            argv = self.pipeline.split()
-            executable = argv[0]
-            argv[0] = os.path.basename(argv[0])
-            from twisted.internet import reactor
-            self.process = reactor.spawnProcess(ExternalProcessProtocol(self),
-                    executable, argv, {})
+        self.paused = False
+        if self.process is not None:
+            self.process.resumeProducing()
 
     def pauseProducing(self):
-        pass
+        self.paused = True
+        if self.process is not None:
+            self.process.pauseProducing()
 
     def stopProducing(self):
         print "stopProducing", self.request
-        self.request.unregisterProducer()
+        if not self.request:
+            return
+        request, self.request = self.request, None
+        request.unregisterProducer()
         self.process.loseConnection()
-        self.request.finish()
-        self.request = None
+        request.finish()
 
 
 class ExternalProcessPipeline(resource.Resource, log.Loggable):
@@ -635,9 +685,12 @@ class ExternalProcessPipeline(resource.Resource, log.Loggable):
         except AttributeError:
             pass
 
-        ExternalProcessProducer(self.pipeline_description % self.uri, request)
+        self.start(request)
         return server.NOT_DONE_YET
 
+    def start(self, request):
+        ExternalProcessProducer(self.pipeline_description % self.uri, request)
+
 
 def transcoder_class_wrapper(klass, content_type, pipeline):
     def create_object(uri):
@@ -645,6 +698,8 @@ def transcoder_class_wrapper(klass, content_type, pipeline):
         transcoder.contentType = content_type
         transcoder.pipeline_description = pipeline
         return transcoder
+    # for a HEAD request, without creating a transcoder
+    create_object.contentType = content_type
     return create_object
 
 
@@ -684,6 +739,7 @@ class TranscoderManager(log.Loggable):
 
     logCategory = 'transcoder_manager'
     _instance_ = None  # Singleton
+    cache = None
 
     def __new__(cls, *args, **kwargs):
         """ creates the singleton """
@@ -703,6 +759,9 @@ class TranscoderManager(log.Loggable):
         self.transcoders = {}
         for transcoder in InternalTranscoder.__subclasses__():
             self.transcoders[get_transcoder_name(transcoder)] = transcoder
+            max_running = getattr(transcoder, 'max_running', None)
+            if max_running is not None:
+                pool.limits[get_transcoder_name(transcoder)] = max_running
 
         if coherence is not None:
             self.coherence = coherence
@@ -743,10 +802,60 @@ class TranscoderManager(log.Loggable):
                     continue
 
                 self.transcoders[transcoder_name] = wrapped
+                if 'max_running' in transcoder:
+                    try:
+                        pool.limits[transcoder_name] = int(transcoder['max_running'])
+                    except ValueError:
+                        self.warning("invalid max_running for transcoder %r",
+                                     transcoder_name)
+
+            self.configure_pool()
+            if self.cache is None:
+                self.cache = self.create_cache()
 
         #FIXME reduce that to info later
         self.warning("available transcoders %r", self.transcoders)
 
+    def configure_pool(self):
+        """ how many transcoders may run at once, transcoding_max_running,
+            and may wait for that, transcoding_queue_size
+
+            how many bytes a slow client may lag behind,
+            transcoding_max_buffered, and what then, transcoding_slow_clients:
+            'block' the transcoder or 'drop' the output for that client """
+        config = self.coherence.config
+        try:
+            pool.max_running = int(config.get('transcoding_max_running',
+                                              pool.max_running))
+            pool.queue_size = int(config.get('transcoding_queue_size',
+                                             pool.queue_size))
+            FlowControl.max_buffered = int(config.get('transcoding_max_buffered',
+                                                      FlowControl.max_buffered))
+        except ValueError, msg:
+            self.warning('invalid transcoding pool settings %s', msg)
+        policy = config.get('transcoding_slow_clients', FlowControl.policy)
+        if policy in ('block', 'drop'):
+            FlowControl.policy = policy
+        else:
+            self.warning('invalid transcoding_slow_clients %r', policy)
+
+    def create_cache(self):
+        """ the transcode cache, configured by transcoding_cache_directory,
+            ~/.cache/coherence/transcodes by default, and
+            transcoding_cache_maxsize (bytes, 0 to disable it) """
+        config = self.coherence.config
+        try:
+            maxsize = int(config.get('transcoding_cache_maxsize', 1000000000))
+        except ValueError:
+            self.warning("invalid transcoding_cache_maxsize %r",
+                         config.get('transcoding_cache_maxsize'))
+            return None
+        if maxsize <= 0:
+            return None
+        directory = config.get('transcoding_cache_directory',
+                               os.path.expanduser('~/.cache/coherence/transcodes'))
+        return TranscodeCache(directory, maxsize)
+
     def select(self, name, uri, backend=None):
         # FIXME:why do we specify the name when trying to get it?
 
@@ -758,8 +867,20 @@ class TranscoderManager(log.Loggable):
             """
             pass
 
+        if self.cache is not None:
+            try:
+                transcoded = self.cache.resource(uri, name, self.transcoders[name])
+            except TranscoderBusy, busy:
+                return Busy(busy.retry_after)
+            if transcoded is not None:
+                return transcoded
+
+        shared = sessions.resource(uri, name, self.transcoders[name])
+        if shared is not None:
+            return shared
+
         transcoder = self.transcoders[name](uri)
-        return transcoder
+        return PooledTranscode(name, transcoder)
 
 if __name__ == '__main__':
     t = Transcoder(None)
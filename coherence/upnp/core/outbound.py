@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+The scheduler of the HTTP requests L{utils.getPage} and
+L{utils.downloadPage} make.
+
+A control point discovering a few dozen devices at once, or a backend
+refreshing its listings, would otherwise open a connection for every
+description, SCPD and feed at the same time. The scheduler runs at most
+max_per_host requests to a host and max_total requests overall, the
+others wait in a queue ordered by priority, PRIORITY_PLAYBACK before
+PRIORITY_METADATA, in the order they came in otherwise.
+"""
+
+import heapq
+import itertools
+import time
+
+from urlparse import urlsplit
+
+from twisted.internet import defer
+from twisted.python import failure
+
+from coherence import log
+
+PRIORITY_PLAYBACK = 0
+PRIORITY_METADATA = 10
+
+
+class OutboundScheduler(log.Loggable):
+    """
+    The outbound requests running and waiting, see the module docstring.
+
+    max_per_host, max_total and timeout are set from the config as
+    http_max_per_host, http_max_total and http_timeout.
+    """
+    logCategory = 'outbound'
+
+    max_per_host = 4
+    max_total = 16
+    # seconds a GET or HEAD of utils.getPage may take if the caller
+    # didn't give a timeout
+    timeout = 60
+
+    def __init__(self):
+        log.Loggable.__init__(self)
+        self.queue = []
+        self.running = {}
+        self.total = 0
+        self._counter = itertools.count()
+        self._scheduling = False
+        self._again = False
+        self.started = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.waited = 0.0
+        self.max_queued = 0
+
+    def configure(self, max_per_host=None, max_total=None, timeout=None):
+        if max_per_host is not None:
+            self.max_per_host = int(max_per_host)
+        if max_total is not None:
+            self.max_total = int(max_total)
+        if timeout is not None:
+            self.timeout = int(timeout)
+        self.run()
+
+    def stats(self):
+        wait = 0.0
+        if self.started > 0:
+            wait = self.waited / self.started
+        return {'running': self.total, 'queued': len(self.queue),
+                'max_queued': self.max_queued, 'started': self.started,
+                'failed': self.failed, 'timed_out': self.timed_out,
+                'average_wait': wait}
+
+    def schedule(self, url, start, priority=PRIORITY_METADATA):
+        """ call start, returning a Deferred, once a request to the host of
+            url may run, returns a Deferred firing with its result """
+        d = defer.Deferred()
+        host = urlsplit(url)[1]
+        heapq.heappush(self.queue, (priority, next(self._counter), host, start, d, time.time()))
+        self.max_queued = max(self.max_queued, len(self.queue))
+        self.run()
+        return d
+
+    def available(self, host):
+        return (self.total < self.max_total and
+                self.running.get(host, 0) < self.max_per_host)
+
+    def run(self):
+        if self._scheduling:
+            # a request finished right away, look at the queue again
+            self._again = True
+            return
+        self._scheduling = True
+        try:
+            self._again = True
+            while self._again:
+                self._again = False
+                waiting = []
+                while self.queue and self.total < self.max_total:
+                    entry = heapq.heappop(self.queue)
+                    if not self.available(entry[2]):
+                        waiting.append(entry)
+                        continue
+                    self.begin(*entry[2:])
+                for entry in waiting:
+                    heapq.heappush(self.queue, entry)
+        finally:
+            self._scheduling = False
+
+    def begin(self, host, start, d, queued):
+        self.total += 1
+        self.running[host] = self.running.get(host, 0) + 1
+        self.started += 1
+        self.waited += time.time() - queued
+        r = defer.maybeDeferred(start)
+
+        def done(result):
+            self.total -= 1
+            self.running[host] -= 1
+            if self.running[host] == 0:
+                del self.running[host]
+            if isinstance(result, failure.Failure):
+                self.failed += 1
+                if result.check(defer.TimeoutError):
+                    self.timed_out += 1
+            self.run()
+            return result
+        r.addBoth(done)
+        r.chainDeferred(d)
+
+
+scheduler = OutboundScheduler()
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+A cache for the pages L{utils.getPage} downloads.
+
+The feeds, playlists and genre lists of the internet backends, and the
+device and service descriptions, are asked for again and again, mostly
+unchanged. With the cache enabled a GET is answered from it as long as
+the page is fresh by its Cache-Control max-age or Expires header. After
+that the server is asked with If-None-Match and If-Modified-Since, when
+the page came with an ETag or a Last-Modified header, and a '304 Not
+Modified' answer is served from the cache too. Pages without either and
+without a lifetime aren't kept.
+
+The most recent pages are held in memory, more of them in the cache
+directory, the body in a file named by a hash of the request and its
+headers next to it in a .json file. Requests for a page that is being
+downloaded wait for that download.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+from collections import OrderedDict
+
+from twisted.internet import defer, reactor
+from twisted.web import error, http
+
+from coherence import log
+
+
+class CachedPage(object):
+    """ a page, the headers it came with and until when it is fresh """
+
+    def __init__(self, url, body, headers, expires=0):
+        self.url = url
+        self.body = body
+        self.headers = headers
+        self.expires = expires
+
+    def header(self, name):
+        values = self.headers.get(name)
+        if values:
+            return values[-1]
+        return None
+
+    @property
+    def validators(self):
+        headers = {}
+        etag = self.header('etag')
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        last_modified = self.header('last-modified')
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+
+def lifetime(headers, now):
+    """ until when a response with headers is fresh, None if it mustn't
+        be stored """
+    directives = {}
+    for value in headers.get('cache-control', []):
+        for directive in value.split(','):
+            name, _, argument = directive.strip().partition('=')
+            directives[name.lower()] = argument.strip('"')
+    if 'no-store' in directives:
+        return None
+    if 'no-cache' in directives:
+        return now
+    if 'max-age' in directives:
+        try:
+            return now + int(directives['max-age'])
+        except ValueError:
+            return now
+    expires = headers.get('expires')
+    if expires:
+        try:
+            return http.stringToDatetime(expires[-1])
+        except ValueError:
+            return now
+    return now
+
+
+class PageCache(log.Loggable):
+    """
+    The pages by request, see the module docstring.
+
+    enabled, directory and max_entries are set from the config as
+    page_cache, page_cache_directory and page_cache_entries.
+    """
+    logCategory = 'page_cache'
+
+    enabled = False
+    directory = os.path.expanduser('~/.cache/coherence/pages')
+    # pages kept on disk, the least recently stored are removed beyond
+    max_entries = 2000
+    # pages kept in memory too
+    max_memory_entries = 200
+
+    def __init__(self, reactor=reactor):
+        log.Loggable.__init__(self)
+        self.reactor = reactor
+        self.pages = OrderedDict()
+        # the pages on disk, least recently stored first
+        self.stored = OrderedDict()
+        self.pending = {}
+        self.prepared = False
+        self.requests = 0
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def configure(self, enabled=None, directory=None, max_entries=None):
+        if enabled is not None:
+            self.enabled = enabled
+        if directory is not None:
+            self.directory = directory
+        if max_entries is not None:
+            self.max_entries = int(max_entries)
+
+    def _prepare(self):
+        self.prepared = True
+        self.reactor.addSystemEventTrigger('before', 'shutdown', self.report)
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError, msg:
+                self.warning("page cache disabled, no directory %s: %s",
+                             self.directory, msg)
+                self.enabled = False
+            return
+        stored = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                path = os.path.join(self.directory, name)
+                try:
+                    stored.append((os.path.getmtime(path), name[:-5]))
+                except OSError:
+                    pass
+        stored.sort()
+        for _, name in stored:
+            self.stored[name] = True
+        self.evict()
+
+    def evict(self):
+        """ remove the least recently stored pages beyond max_entries """
+        while len(self.stored) > self.max_entries:
+            name, _ = self.stored.popitem(last=False)
+            self.remove(name)
+
+    def stats(self):
+        """ the counters of the requests, and the share answered
+            without downloading the page """
+        hit_rate = 0.0
+        if self.requests > 0:
+            hit_rate = float(self.hits + self.revalidated) / self.requests
+        return {'requests': self.requests, 'hits': self.hits,
+                'revalidated': self.revalidated, 'misses': self.misses,
+                'coalesced': self.coalesced, 'hit_rate': hit_rate}
+
+    def report(self):
+        self.info("%(requests)d requests, %(hits)d hits, %(revalidated)d revalidated, "
+                  "%(coalesced)d coalesced, hit rate %(hit_rate).2f", self.stats())
+
+    def cacheable(self, kwargs):
+        return (self.enabled and kwargs.get('method', 'GET') == 'GET' and
+                kwargs.get('postdata') is None)
+
+    def key(self, url, headers):
+        if headers:
+            url = '%s\n%r' % (url, sorted(headers.items()))
+        return hashlib.sha1(url).hexdigest()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, name):
+        page = self.pages.get(name)
+        if page is not None:
+            del self.pages[name]
+            self.pages[name] = page
+            return page
+        try:
+            with open(self.path(name) + '.json') as f:
+                url, headers, expires = json.load(f)
+            with open(self.path(name), 'rb') as f:
+                body = f.read()
+        except (IOError, ValueError):
+            return None
+        headers = dict((str(k), [str(v) for v in values]) for k, values in headers)
+        page = CachedPage(str(url), body, headers, expires)
+        self.remember(name, page)
+        return page
+
+    def remember(self, name, page):
+        self.pages[name] = page
+        while len(self.pages) > self.max_memory_entries:
+            self.pages.popitem(last=False)
+
+    def store(self, name, page):
+        self.remember(name, page)
+        path = self.path(name)
+        try:
+            with open(path + '.part', 'wb') as f:
+                f.write(page.body)
+            os.rename(path + '.part', path)
+            with open(path + '.json.part', 'w') as f:
+                json.dump([page.url, page.headers.items(), page.expires], f)
+            os.rename(path + '.json.part', path + '.json')
+        except (IOError, OSError), msg:
+            self.warning("storing %s failed: %s", page.url, msg)
+            return
+        self.stored.pop(name, None)
+        self.stored[name] = True
+        self.evict()
+
+    def remove(self, name):
+        self.pages.pop(name, None)
+        self.stored.pop(name, None)
+        for path in (self.path(name), self.path(name) + '.json'):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def getPage(self, fetch, url, contextFactory=None, *args, **kwargs):
+        """ a Deferred firing with (page, headers), like L{utils.getPage},
+            from the cache or from fetch, called with the arguments to
+            download the page, whose HTTP errors carry the headers of
+            the response as response_headers
+        """
+        if not self.prepared:
+            self._prepare()
+            if not self.enabled:
+                return fetch(url, contextFactory, *args, **kwargs)
+        self.requests += 1
+        name = self.key(url, kwargs.get('headers'))
+        d = defer.Deferred()
+        if name in self.pending:
+            self.coalesced += 1
+            self.pending[name].append(d)
+            return d
+
+        page = self.get(name)
+        if page is not None and page.expires > time.time():
+            self.hits += 1
+            return defer.succeed((page.body, dict(page.headers)))
+
+        self.pending[name] = [d]
+        if page is not None:
+            headers = dict(kwargs.get('headers') or {})
+            headers.update(page.validators)
+            kwargs['headers'] = headers
+        fetched = fetch(url, contextFactory, *args, **kwargs)
+
+        def got_page(result):
+            body, headers = result
+            self.misses += 1
+            expires = lifetime(headers, time.time())
+            if expires is None or (expires <= time.time() and
+                                   'etag' not in headers and 'last-modified' not in headers):
+                self.remove(name)
+            else:
+                self.store(name, CachedPage(url, body, headers, expires))
+            return result
+
+        def got_error(failure):
+            if page is not None and failure.check(error.Error) and \
+               failure.value.status == str(http.NOT_MODIFIED):
+                self.revalidated += 1
+                self.debug("%s not modified", url)
+                headers = getattr(failure.value, 'response_headers', None) or {}
+                expires = lifetime(headers, time.time())
+                if expires is not None and expires > page.expires:
+                    page.expires = expires
+                    self.store(name, page)
+                return page.body, dict(page.headers)
+            self.misses += 1
+            return failure
+
+        def done(result):
+            waiting = self.pending.pop(name)
+            for w in waiting:
+                if isinstance(result, tuple):
+                    w.callback((result[0], dict(result[1])))
+                else:
+                    w.errback(result)
+
+        fetched.addCallbacks(got_page, got_error)
+        fetched.addBoth(done)
+        return d
+
+
+cache = PageCache()
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Reading media files ahead of the streams, off the reactor thread.
+
+A L{ReadAhead} serves the reads of one producer. As long as they are
+random, like those of a client seeking around, it reads just the chunk
+asked for. Once they turn out to be sequential it tells the kernel so
+and keeps a ring of chunks, aligned to chunkSize, read ahead in the
+reactor's thread pool, so concurrent streams from spinning disks read
+large pieces at a time and the reactor doesn't wait for the disk.
+
+Reads answered from the ring return the data, otherwise a Deferred
+which fires once the data is there.
+
+posix_fadvise comes from the os module on Python 3, on Python 2 it is
+looked up in the C library on Linux. Without it the hints are skipped.
+"""
+
+import os
+import sys
+import threading
+
+from collections import deque
+
+from twisted.internet import defer, threads
+
+from coherence import log
+
+try:
+    from os import posix_fadvise, POSIX_FADV_SEQUENTIAL, POSIX_FADV_WILLNEED
+except ImportError:
+    posix_fadvise = None
+    if sys.platform.startswith('linux'):
+        try:
+            import ctypes
+            import ctypes.util
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            _fadvise = _libc.posix_fadvise64
+            _fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+            POSIX_FADV_SEQUENTIAL = 2
+            POSIX_FADV_WILLNEED = 3
+
+            def posix_fadvise(fd, offset, length, advice):
+                error = _fadvise(fd, offset, length, advice)
+                if error:
+                    raise OSError(error, os.strerror(error))
+        except (OSError, AttributeError, TypeError):
+            pass
+    if posix_fadvise is None:
+        POSIX_FADV_SEQUENTIAL = POSIX_FADV_WILLNEED = None
+
+try:
+    from os import pread
+except ImportError:
+    pread = None
+
+
+def advise(fd, offset, length, advice):
+    """ posix_fadvise, if we have it, it is a hint only anyway """
+    if posix_fadvise is None or fd is None:
+        return
+    try:
+        posix_fadvise(fd, offset, length, advice)
+    except (OSError, IOError):
+        pass
+
+
+def positional_reader(fileObject):
+    """ return a function reading size bytes at offset from fileObject,
+        safe to be called from several threads, and the file descriptor """
+    shared = getattr(fileObject, 'shared', None)
+    if shared is not None:
+        # a streaming.FileHandle
+        return shared.pread, shared.fd
+    fd = fileObject.fileno()
+    if pread is not None:
+        return lambda size, offset: pread(fd, size, offset), fd
+    lock = threading.Lock()
+
+    def read(size, offset):
+        with lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, size)
+    return read, fd
+
+
+class Chunk(object):
+
+    def __init__(self, offset, size):
+        self.offset = offset
+        self.end = offset + size
+        self.data = None
+        self.eof = False
+        self.waiters = []
+
+    def loaded(self, data):
+        self.data = data
+        self.eof = len(data) < self.end - self.offset
+        # a short read, we got to the end of the file
+        self.end = self.offset + len(data)
+        waiters, self.waiters = self.waiters, []
+        for d in waiters:
+            if not d.called:
+                d.callback(None)
+
+    def wait(self):
+        d = defer.Deferred()
+        self.waiters.append(d)
+        return d
+
+
+class ReadAhead(log.Loggable):
+    """
+    Reads from fileObject for one producer, see the module docstring.
+
+    The producer gives the end of what it is going to read with every
+    read, no chunk goes past that.
+    """
+    logCategory = 'readahead'
+
+    chunkSize = 2 ** 20
+    depth = 2
+    # contiguous reads before the access is taken as sequential
+    sequentialAfter = 2
+
+    def __init__(self, fileObject):
+        log.Loggable.__init__(self)
+        self.pread, self.fd = positional_reader(fileObject)
+        self.ring = deque()
+        self.reading = set()
+        self.expected = None
+        self.waiting_at = None
+        self.sequential = 0
+        self.advised = False
+        self.advised_until = 0
+
+    def _load(self, offset, limit):
+        if self.ring:
+            offset = self.ring[-1].end
+        size = min(self.chunkSize - offset % self.chunkSize, limit - offset)
+        chunk = Chunk(offset, size)
+        self.ring.append(chunk)
+        d = threads.deferToThread(self.pread, size, offset)
+        self.reading.add(d)
+        d.addErrback(self._failed, chunk)
+        d.addCallback(chunk.loaded)
+        d.addBoth(lambda _: self.reading.discard(d))
+
+    def _failed(self, failure, chunk):
+        self.warning("reading %d bytes at %d failed: %s",
+                     chunk.end - chunk.offset, chunk.offset,
+                     failure.getErrorMessage())
+        # an empty chunk, read() takes that as the end of the file
+        return ''
+
+    def read(self, offset, size, limit):
+        """ return up to size bytes at offset, or a Deferred firing when
+            they have been read """
+        if offset == self.expected:
+            self.sequential += 1
+        elif offset != self.waiting_at:
+            self.sequential = 0
+        while self.ring and self.ring[0].end <= offset and self.ring[0].data is not None:
+            if self.ring[0].eof and self.ring[0].offset <= offset:
+                # nothing was there to read, the end of the file
+                self.expected = offset
+                self.waiting_at = None
+                return ''
+            self.ring.popleft()
+        if self.ring and not (self.ring[0].offset <= offset < self.ring[0].end):
+            # a seek, chunks still being read are left to their threads
+            self.ring.clear()
+        depth = 1
+        if self.sequential >= self.sequentialAfter:
+            depth = self.depth
+            if not self.advised:
+                self.advised = True
+                advise(self.fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+        while len(self.ring) < depth:
+            if self.ring and self.ring[-1].end >= limit:
+                break
+            self._load(offset, limit)
+        chunk = self.ring[0]
+        if chunk.data is None:
+            # asked for again once it is there, that's no seek
+            self.expected = None
+            self.waiting_at = offset
+            return chunk.wait()
+        start = offset - chunk.offset
+        if start == 0 and size >= len(chunk.data):
+            data = chunk.data
+        else:
+            data = chunk.data[start:start + size]
+        self.expected = offset + len(data)
+        self.waiting_at = None
+        return data
+
+    def will_need(self, offset, length):
+        """ for reads not done through us, like sendfile: tell the kernel
+            to read the next window ahead of offset, once per window """
+        window = self.chunkSize * self.depth
+        if offset + window / 2 < self.advised_until:
+            return
+        if not self.advised:
+            self.advised = True
+            advise(self.fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+        start = max(offset, self.advised_until)
+        self.advised_until = min(offset + window, offset + length)
+        if self.advised_until > start:
+            advise(self.fd, start, self.advised_until - start, POSIX_FADV_WILLNEED)
+
+    def stop(self):
+        """ forget the ring, returns a Deferred firing when no thread is
+            reading any longer, only then the file may be closed """
+        self.ring.clear()
+        return defer.DeferredList(list(self.reading))
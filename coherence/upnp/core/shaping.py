@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Sharing the outgoing bandwidth of the MediaServer between its streams.
+
+Every media request MSRoot answers gets a connection id from the
+ConnectionManager and a L{Stream} in the L{StreamScheduler}. Producers
+serving such a request register through L{register_producer}, which puts
+a L{ShapedProducer} between them and the request, so the scheduler can
+hold a stream back once it has used up its credit.
+
+Credit is handed out every tick. A total rate is split max-min fair
+between the streams: a stream which didn't use up its credit during the
+last tick is held back by its client, not by us, and gets a bit more
+than it used, the rest of the rate is divided equally between the
+others. Streams may be capped individually too, MSRoot caps them at a
+multiple of their res@bitrate if configured so. Without a total rate or
+a cap for a stream no credit is counted for it at all.
+"""
+
+import traceback
+
+from twisted.internet import reactor, defer, task
+
+from coherence import log
+
+
+class Stream(object):
+    """ an outgoing stream of the MediaServer and its metrics """
+
+    def __init__(self, scheduler, connection_id, request, rate=0):
+        self.scheduler = scheduler
+        self.connection_id = connection_id
+        self.request = request
+        self.rate = rate
+        try:
+            self.client = request.getClientIP()
+        except AttributeError:
+            self.client = None
+        self.started = reactor.seconds()
+        self.finished = None
+        self.credit = 0
+        # request.sentLength at the last tick
+        self.measured = 0
+        self.throttled = False
+        self.throttled_since = None
+        self.throttled_time = 0.0
+        self.producer = None
+
+    def limited(self):
+        return bool(self.rate or self.scheduler.rate)
+
+    def allowance(self):
+        """ the bytes this stream may still send until the next tick,
+            None if it isn't limited """
+        if not self.limited():
+            return None
+        return self.credit - (self.request.sentLength - self.measured)
+
+    def throttle(self):
+        if not self.throttled:
+            self.throttled = True
+            self.throttled_since = reactor.seconds()
+            if self.producer is not None:
+                self.producer.pause('throttled')
+
+    def release(self):
+        if self.throttled:
+            self.throttled = False
+            self.throttled_time += reactor.seconds() - self.throttled_since
+            if self.producer is not None:
+                self.producer.resume('throttled')
+
+    def metrics(self):
+        end = self.finished or reactor.seconds()
+        duration = end - self.started
+        throttled_time = self.throttled_time
+        if self.throttled:
+            throttled_time += end - self.throttled_since
+        sent = self.request.sentLength
+        return {'connection_id': self.connection_id,
+                'client': self.client,
+                'bytes_sent': sent,
+                'duration': duration,
+                'rate': duration > 0 and sent / duration or 0,
+                'rate_cap': self.rate,
+                'throttled_time': throttled_time}
+
+
+class ShapedProducer(object):
+    """
+    Registered with the request in place of a producer, it pauses that
+    producer while the transport or the scheduler asks for it.
+
+    Pull producers are driven by a cooperative task, like twisted.web does,
+    which checks the stream's allowance before every chunk. They may return
+    a Deferred from resumeProducing if they have to wait for their data,
+    they are asked again once it fired.
+    """
+
+    def __init__(self, request, producer, streaming, stream=None):
+        self.request = request
+        self.producer = producer
+        self.streaming = streaming
+        self.stream = stream
+        self.paused = set()
+        self._task = None
+
+    def start(self):
+        if self.stream is not None:
+            self.stream.producer = self
+        self.request.registerProducer(self, True)
+        if not self.streaming:
+            if self.stream is not None:
+                cooperate = self.stream.scheduler.cooperate
+            else:
+                cooperate = scheduler.cooperate
+            self._task = cooperate(self._pull())
+        if self.stream is not None and self.stream.throttled:
+            self.pause('throttled')
+
+    def _pull(self):
+        request = self.request
+        while request.producer is self:
+            allowance = None
+            if self.stream is not None:
+                allowance = self.stream.allowance()
+            if allowance is not None and allowance <= 0:
+                self.stream.throttle()
+            else:
+                try:
+                    waiting = self.producer.resumeProducing()
+                except:
+                    scheduler.warning("%r failed, producing will be stopped: %s",
+                                      self.producer, traceback.format_exc())
+                    if request.producer is self:
+                        request.unregisterProducer()
+                    break
+                if isinstance(waiting, defer.Deferred):
+                    self.pause('waiting')
+                    waiting.addBoth(lambda _: self.resume('waiting'))
+            yield None
+        self._task = None
+        if self.stream is not None:
+            self.stream.producer = None
+
+    def pause(self, reason):
+        if not self.paused:
+            if self.streaming:
+                self.producer.pauseProducing()
+            elif self._task is not None:
+                self._task.pause()
+        self.paused.add(reason)
+
+    def resume(self, reason):
+        if reason not in self.paused:
+            return
+        self.paused.discard(reason)
+        if not self.paused:
+            if self.streaming:
+                self.producer.resumeProducing()
+            elif self._task is not None:
+                self._task.resume()
+
+    def pauseProducing(self):
+        self.pause('transport')
+
+    def resumeProducing(self):
+        self.resume('transport')
+
+    def stopProducing(self):
+        if self._task is not None:
+            self._task.stop()
+            self._task = None
+            if self.stream is not None:
+                self.stream.producer = None
+        self.producer.stopProducing()
+
+
+def register_producer(request, producer, streaming):
+    """ register producer with the request, shaped if the request is
+        a limited stream of the L{StreamScheduler}
+
+        Pull producers always go through a L{ShapedProducer}, which lets
+        them wait for data they are reading in a thread. """
+    stream = getattr(request, 'stream', None)
+    if stream is not None and not stream.limited():
+        stream = None
+    if stream is None and streaming:
+        request.registerProducer(producer, streaming)
+    else:
+        ShapedProducer(request, producer, streaming, stream).start()
+
+
+class StreamScheduler(log.Loggable):
+    """
+    Hands out credit to the L{Stream}s every interval seconds.
+
+    rate is the total of bytes per second for all streams together, 0 for
+    unlimited, a stream's own rate caps it further.
+    """
+    logCategory = 'shaping'
+
+    interval = 0.05
+    # what a client that took less than its share may take per tick
+    min_demand = 16384
+
+    def __init__(self, rate=0, cooperate=task.cooperate):
+        log.Loggable.__init__(self)
+        self.rate = rate
+        self.cooperate = cooperate
+        self.streams = {}
+        self._ticker = None
+        self._last_tick = None
+
+    def add(self, connection_id, request, rate=0):
+        stream = Stream(self, connection_id, request, rate)
+        self.streams[connection_id] = stream
+        request.stream = stream
+        if stream.limited():
+            shares = [s for s in (self.rate and self.rate / len(self.streams),
+                                  stream.rate) if s]
+            stream.credit = int(min(shares) * self.interval)
+            if self._ticker is None:
+                self._ticker = task.LoopingCall(self.tick)
+                self._ticker.clock = reactor
+                self._last_tick = reactor.seconds()
+                self._ticker.start(self.interval, now=False)
+        return stream
+
+    def remove(self, connection_id):
+        stream = self.streams.pop(connection_id, None)
+        if stream is None:
+            return None
+        stream.release()
+        stream.finished = reactor.seconds()
+        if not self.streams and self._ticker is not None:
+            self._ticker.stop()
+            self._ticker = None
+        return stream
+
+    def metrics(self):
+        return [stream.metrics() for stream in self.streams.values()]
+
+    def fair_shares(self, demands, capacity):
+        """ split capacity max-min fair between the demands,
+            a demand of None takes what it can get """
+        shares = {}
+        left = len(demands)
+        infinity = float('inf')
+        for key, demand in sorted(demands.items(),
+                                  key=lambda d: infinity if d[1] is None else d[1]):
+            if capacity is None:
+                share = demand
+            else:
+                share = capacity / left
+                if demand is not None:
+                    share = min(share, demand)
+                capacity -= share
+            shares[key] = share
+            left -= 1
+        return shares
+
+    def tick(self):
+        now = reactor.seconds()
+        elapsed = now - self._last_tick
+        self._last_tick = now
+        demands = {}
+        for stream in self.streams.values():
+            if not stream.limited() or stream.producer is None:
+                # not (or no longer) streaming through us, a proxied one
+                continue
+            sent = stream.request.sentLength - stream.measured
+            stream.measured += sent
+            stream.credit -= sent
+            demand = None
+            if stream.rate:
+                demand = stream.rate * elapsed
+            if self.rate and not stream.throttled and stream.credit > 0:
+                # the client takes less than it gets
+                used = max(2 * sent, self.min_demand)
+                demand = used if demand is None else min(demand, used)
+            demands[stream] = demand
+        capacity = self.rate * elapsed if self.rate else None
+        for stream, share in self.fair_shares(demands, capacity).items():
+            # debts are carried over, unused credit isn't
+            stream.credit = min(stream.credit, 0) + int(share)
+            if stream.credit > 0:
+                stream.release()
+            else:
+                stream.throttle()
+
+scheduler = StreamScheduler()
@@ -9,8 +9,9 @@
 # Implementation of a SSDP server under Twisted Python.
 #
 
+import heapq
 import random
-import string
+import re
 import time
 import socket
 
@@ -19,12 +20,26 @@ from twisted.internet import reactor, error
 from twisted.internet import task
 from twisted.web.http import datetimeToString
 from coherence import log, SERVER_ID
+from coherence.upnp.core import utils
 import coherence.extern.louie as louie
 
 
 SSDP_PORT = 1900
 SSDP_ADDR = '239.255.255.250'
 
+# seconds a remote entry is kept after its max-age has passed
+EXPIRY_GRACE = 30
+
+MAX_AGE_RE = re.compile(r'max-age\s*=\s*"?(\d+)', re.IGNORECASE)
+
+
+def parse_max_age(cache_control, default=1800):
+    """ return the max-age value of a CACHE-CONTROL header in seconds """
+    match = MAX_AGE_RE.search(cache_control or '')
+    if match is None:
+        return default
+    return int(match.group(1))
+
 
 class SSDPServer(DatagramProtocol, log.Loggable):
     """A class implementing a SSDP server.  The notifyReceived and
@@ -32,10 +47,30 @@ class SSDPServer(DatagramProtocol, log.Loggable):
     datagram is received by the server."""
     logCategory = 'ssdp'
 
+    # global cap for discovery responses, a token bucket refilled with
+    # response_rate tokens per second holding at most response_burst
+    response_rate = 100.0
+    response_burst = 50
+
     def __init__(self, test=False, interface=''):
         # Create SSDP server
         log.Loggable.__init__(self)
         self.known = {}
+        # ST -> set of USNs, only for our local entries
+        self._local_by_st = {}
+        # USN -> prebuilt M-SEARCH response, missing only the DATE value
+        self._responses = {}
+        # (host, port) -> [DelayedCall, list of USNs owed to that requester]
+        self._pending = {}
+        # (host, port, st) -> time until repeated M-SEARCHes are ignored
+        self._recent_searches = {}
+        self._tokens = float(self.response_burst)
+        self._tokens_updated = reactor.seconds()
+        # remote USN -> (max-age, expiry time), and a heap of
+        # (expiry time, USN) with outdated items skipped on pop
+        self._expiry = {}
+        self._expiry_heap = []
+        self._expiry_call = None
         self._callbacks = {}
         self.test = test
         if not self.test:
@@ -46,20 +81,19 @@ class SSDPServer(DatagramProtocol, log.Loggable):
           self.resend_notify_loop = task.LoopingCall(self.resendNotify)
           self.resend_notify_loop.start(777.0, now=False)
 
-          self.check_valid_loop = task.LoopingCall(self.check_valid)
-          self.check_valid_loop.start(333.0, now=False)
-
         self.active_calls = []
 
     def shutdown(self):
-        for call in reactor.getDelayedCalls():
-            if call.func == self.send_it:
+        for call, _ in self._pending.values():
+            if call.active():
                 call.cancel()
+        self._pending = {}
+        if self._expiry_call is not None and self._expiry_call.active():
+            self._expiry_call.cancel()
+        self._expiry_call = None
         if not self.test:
             if self.resend_notify_loop.running:
                 self.resend_notify_loop.stop()
-            if self.check_valid_loop.running:
-                self.check_valid_loop.stop()
             '''Make sure we send out the byebye notifications.'''
             for st in self.known:
                 if self.known[st]['MANIFESTATION'] == 'local':
@@ -68,20 +102,10 @@ class SSDPServer(DatagramProtocol, log.Loggable):
     def datagramReceived(self, data, (host, port)):
         """Handle a received multicast datagram."""
 
-        try:
-            header, payload = data.split('\r\n\r\n')[:2]
-        except ValueError, err:
-            print err
-            print 'Arggg,', data
-            import pdb; pdb.set_trace()
-
-        lines = header.split('\r\n')
-        cmd = string.split(lines[0], ' ')
-        lines = map(lambda x: x.replace(': ', ':', 1), lines[1:])
-        lines = filter(lambda x: len(x) > 0, lines)
-
-        headers = [string.split(x, ':', 1) for x in lines]
-        headers = dict(map(lambda x: (x[0].lower(), x[1]), headers))
+        cmd, headers = utils.parse_http_response(data)
+        if len(cmd) < 2:
+            self.warning('Malformed SSDP datagram from %s:%d', host, port)
+            return
 
         self.msg('SSDP command %s %s - from %s:%d', cmd[0], cmd[1], host, port)
         self.debug('with headers: %s', headers)
@@ -98,6 +122,25 @@ class SSDPServer(DatagramProtocol, log.Loggable):
         # send out the signal after we had a chance to register the device
         louie.send('UPnP.SSDP.datagram_received', None, data, host, port)
 
+    def _build_response(self, entry):
+        """Prepare the static part of a discovery response for a local
+        entry, only the DATE header has to be appended when sending."""
+        response = ['HTTP/1.1 200 OK']
+        for k, v in entry.items():
+            if k not in ('MANIFESTATION', 'SILENT', 'HOST', 'last-seen'):
+                response.append('%s: %s' % (k, v))
+        response.append('DATE: ')
+        return '\r\n'.join(response)
+
+    def _forget_local(self, usn):
+        st = self.known[usn]['ST']
+        usns = self._local_by_st.get(st)
+        if usns is not None:
+            usns.discard(usn)
+            if not usns:
+                del self._local_by_st[st]
+        self._responses.pop(usn, None)
+
     def register(self, manifestation, usn, st, location,
                         server=SERVER_ID,
                         cache_control='max-age=1800',
@@ -108,6 +151,8 @@ class SSDPServer(DatagramProtocol, log.Loggable):
 
         self.info('Registering %s (%s)', st, location)
 
+        if usn in self.known:
+            self._forget_local(usn)
         self.known[usn] = {}
         self.known[usn]['USN'] = usn
         self.known[usn]['LOCATION'] = location
@@ -124,7 +169,11 @@ class SSDPServer(DatagramProtocol, log.Loggable):
         self.msg(self.known[usn])
 
         if manifestation == 'local':
+            self._local_by_st.setdefault(st, set()).add(usn)
+            self._responses[usn] = self._build_response(self.known[usn])
             self.doNotify(usn)
+        else:
+            self._set_expiry(usn, parse_max_age(cache_control))
 
         if st == 'upnp:rootdevice':
             louie.send('Coherence.UPnP.SSDP.new_device', None, device_type=st, infos=self.known[usn])
@@ -137,6 +186,8 @@ class SSDPServer(DatagramProtocol, log.Loggable):
             louie.send('Coherence.UPnP.SSDP.removed_device', None, device_type=st, infos=self.known[usn])
             #self.callback("removed_device", st, self.known[usn])
 
+        self._forget_local(usn)
+        self._expiry.pop(usn, None)
         del self.known[usn]
 
     def isKnown(self, usn):
@@ -150,10 +201,9 @@ class SSDPServer(DatagramProtocol, log.Loggable):
         self.debug('Notification headers: %s', headers)
 
         if headers['nts'] == 'ssdp:alive':
-            try:
-                self.known[headers['usn']]['last-seen'] = time.time()
-                self.debug('updating last-seen for %r', headers['usn'])
-            except KeyError:
+            if self.isKnown(headers['usn']):
+                self.update_last_seen(headers['usn'])
+            else:
                 self.register('remote', headers['usn'], headers['nt'], headers['location'],
                               headers['server'], headers['cache-control'], host=host)
         elif headers['nts'] == 'ssdp:byebye':
@@ -164,46 +214,90 @@ class SSDPServer(DatagramProtocol, log.Loggable):
                     headers['nts'], headers['nt'])
         louie.send('Coherence.UPnP.Log', None, 'SSDP', host, 'Notify %s for %s' % (headers['nts'], headers['usn']))
 
-    def send_it(self, response, destination, delay, usn):
-        self.info('send discovery response delayed by %ds for %s to %r', delay, usn, destination)
+    def send_it(self, response, destination, usn):
+        self.debug('send discovery response for %s to %r', usn, destination)
         try:
             self.transport.write(response, destination)
         except (AttributeError, socket.error), msg:
-            self.info("failure sending out byebye notification: %r", msg)
+            self.info("failure sending out discovery response: %r", msg)
+
+    def _take_tokens(self, wanted):
+        """Return how many of the wanted responses may go out now without
+        exceeding the global response rate."""
+        now = reactor.seconds()
+        self._tokens = min(float(self.response_burst),
+                           self._tokens + (now - self._tokens_updated) * self.response_rate)
+        self._tokens_updated = now
+        granted = min(wanted, int(self._tokens))
+        self._tokens -= granted
+        return granted
+
+    def _send_pending(self, destination):
+        _, usns = self._pending.pop(destination)
+        granted = self._take_tokens(len(usns))
+        date = datetimeToString() + '\r\n\r\n'
+        self.info('send %d discovery responses to %r', granted, destination)
+        for usn in usns[:granted]:
+            try:
+                response = self._responses[usn]
+            except KeyError:
+                # unregistered in the meantime
+                continue
+            self.send_it(response + date, destination, usn)
+        if granted < len(usns):
+            delay = (1.0 - self._tokens) / self.response_rate
+            self._pending[destination] = [
+                reactor.callLater(delay, self._send_pending, destination),
+                usns[granted:]]
+
+    def _is_repeated_search(self, host, port, st, mx):
+        """ by requester, control points on the same host search from
+            ports of their own """
+        now = reactor.seconds()
+        if len(self._recent_searches) > 256:
+            for key, until in self._recent_searches.items():
+                if until <= now:
+                    del self._recent_searches[key]
+        if self._recent_searches.get((host, port, st), 0) > now:
+            return True
+        self._recent_searches[(host, port, st)] = now + max(mx, 1)
+        return False
 
     def discoveryRequest(self, headers, (host, port)):
         """Process a discovery request.  The response must be sent to
-        the address specified by (host, port)."""
+        the address specified by (host, port).
+
+        All responses owed to one requester are sent together from a single
+        timer, repeated searches for the same ST from a requester are
+        ignored within the MX window."""
 
         self.info('Discovery request from (%s,%d) for %s', host, port, headers['st'])
-        self.info('Discovery request for %s', headers['st'])
 
         louie.send('Coherence.UPnP.Log', None, 'SSDP', host, 'M-Search for %s' % headers['st'])
 
-        # Do we know about this service?
-        for i in self.known.values():
-            if i['MANIFESTATION'] == 'remote':
-                continue
-            if(headers['st'] == 'ssdp:all' and
-               i['SILENT'] == True):
-                continue
-            if(i['ST'] == headers['st'] or
-                headers['st'] == 'ssdp:all'):
-                response = []
-                response.append('HTTP/1.1 200 OK')
-
-                for k, v in i.items():
-                    if k == 'USN':
-                        usn = v
-                    if k not in ('MANIFESTATION', 'SILENT', 'HOST'):
-                        response.append('%s: %s' % (k, v))
-                response.append('DATE: %s' % datetimeToString())
+        if headers['st'] == 'ssdp:all':
+            usns = [usn for usn in self._responses
+                    if not self.known[usn]['SILENT']]
+        else:
+            usns = list(self._local_by_st.get(headers['st'], ()))
+        if not usns:
+            return
 
-                response.extend(('', ''))
-                delay = random.randint(0, int(headers['mx']))
+        mx = int(headers['mx'])
+        if self._is_repeated_search(host, port, headers['st'], mx):
+            self.info('Ignoring repeated discovery request from (%s,%d) for %s', host, port, headers['st'])
+            return
 
-                reactor.callLater(delay, self.send_it,
-                                '\r\n'.join(response), (host, port), delay, usn)
+        destination = (host, port)
+        try:
+            pending = self._pending[destination][1]
+        except KeyError:
+            delay = random.randint(0, mx)
+            self._pending[destination] = [
+                reactor.callLater(delay, self._send_pending, destination),
+                usns]
+        else:
+            pending.extend([usn for usn in usns if usn not in pending])
 
     def doNotify(self, usn):
         """Do notification"""
@@ -266,27 +360,66 @@ class SSDPServer(DatagramProtocol, log.Loggable):
             if self.known[usn]['MANIFESTATION'] == 'local':
                 self.doNotify(usn)
 
+    def update_last_seen(self, usn):
+        """ remember that we just heard from a known device or service,
+            pushing its expiry forward """
+        self.known[usn]['last-seen'] = time.time()
+        self.debug('updating last-seen for %r', usn)
+        try:
+            max_age, _ = self._expiry[usn]
+        except KeyError:
+            return
+        self._set_expiry(usn, max_age)
+
+    def _set_expiry(self, usn, max_age):
+        expires = reactor.seconds() + max_age + EXPIRY_GRACE
+        self._expiry[usn] = (max_age, expires)
+        heapq.heappush(self._expiry_heap, (expires, usn))
+        self._schedule_expiry()
+
+    def _schedule_expiry(self):
+        if self.test:
+            return
+        heap = self._expiry_heap
+        # drop outdated heap items so the next timer is the real one
+        while heap and self._expiry.get(heap[0][1], (None, None))[1] != heap[0][0]:
+            heapq.heappop(heap)
+        if not heap:
+            if self._expiry_call is not None and self._expiry_call.active():
+                self._expiry_call.cancel()
+            self._expiry_call = None
+            return
+        delay = max(0, heap[0][0] - reactor.seconds())
+        if self._expiry_call is not None and self._expiry_call.active():
+            if self._expiry_call.getTime() <= heap[0][0]:
+                return
+            self._expiry_call.reset(delay)
+        else:
+            self._expiry_call = reactor.callLater(delay, self.check_valid)
+
     def check_valid(self):
-        """ check if the discovered devices are still ok, or
-            if we haven't received a new discovery response
+        """ expire the discovered devices and services we haven't
+            received a new announcement or discovery response from
+            within their max-age
         """
         self.debug("Checking devices/services are still valid")
-        removable = []
-        for usn in self.known:
-            if self.known[usn]['MANIFESTATION'] != 'local':
-                _, expiry = self.known[usn]['CACHE-CONTROL'].split('=')
-                expiry = int(expiry)
-                now = time.time()
-                last_seen = self.known[usn]['last-seen']
-                self.debug("Checking if %r is still valid - last seen %d (+%d), now %d", self.known[usn]['USN'], last_seen, expiry, now)
-                if last_seen + expiry + 30 < now:
-                    self.debug("Expiring: %r", self.known[usn])
-                    if self.known[usn]['ST'] == 'upnp:rootdevice':
-                        louie.send('Coherence.UPnP.SSDP.removed_device', None, device_type=self.known[usn]['ST'], infos=self.known[usn])
-                    removable.append(usn)
-        while len(removable) > 0:
-            usn = removable.pop(0)
+        now = reactor.seconds()
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            expires, usn = heapq.heappop(heap)
+            try:
+                if self._expiry[usn][1] != expires:
+                    # seen again after this item was pushed
+                    continue
+            except KeyError:
+                # already gone
+                continue
+            self.debug("Expiring: %r", self.known[usn])
+            del self._expiry[usn]
+            if self.known[usn]['ST'] == 'upnp:rootdevice':
+                louie.send('Coherence.UPnP.SSDP.removed_device', None, device_type=self.known[usn]['ST'], infos=self.known[usn])
             del self.known[usn]
+        self._schedule_expiry()
 
     def subscribe(self, name, callback):
         self._callbacks.setdefault(name, []).append(callback)
@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Resources for streaming local media files from the MediaServer.
+
+L{MediaFile} behaves like twisted.web.static.File, but sends full and
+single range responses with sendfile(2) while the connection is a plain
+TCP one and sendfile is available (os.sendfile, or the pysendfile module
+on Python 2). Otherwise, and whenever the socket isn't ready, the data
+goes the usual read()/write() way through the transport.
+
+Seek-heavy clients fire lots of small range requests at the same item,
+so requests for a path share one open file and its stat result, which
+are kept around for a while after the last request (L{OpenFiles}), and
+conditional requests are answered by ETag and Last-Modified before any
+data is produced.
+"""
+
+import errno
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+from twisted.internet import defer, tcp
+from twisted.web import http, static
+
+from coherence import log
+from coherence.upnp.core import readahead, shaping
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+try:
+    from os import pread
+except ImportError:
+    pread = None
+
+
+def get_socket_fileno(request):
+    """ return the file descriptor of the socket the request came in on,
+        or None when sendfile can't be used with that connection
+    """
+    if sendfile is None:
+        return None
+    transport = getattr(request, 'transport', None)
+    if not isinstance(transport, tcp.Connection) or getattr(transport, 'TLS', False):
+        return None
+    try:
+        return transport.fileno()
+    except Exception:
+        return None
+
+
+def transport_is_idle(transport):
+    """ True if the transport has no data of its own left to send,
+        only then we may write to its socket directly
+    """
+    try:
+        return (transport.offset == len(transport.dataBuffer) and
+                not transport._tempDataLen)
+    except AttributeError:
+        return False
+
+
+class SharedFile(object):
+    """
+    A file descriptor opened once for all requests of a path, together
+    with the stat result it was opened with.
+
+    Reads are positional (pread), so the handles sharing it don't need to
+    agree on a file position.
+    """
+
+    def __init__(self, path, registry):
+        self.path = path
+        self.registry = registry
+        try:
+            self.fd = os.open(path, os.O_RDONLY)
+        except OSError, e:
+            # static.File expects IOError from openForReading
+            raise IOError(e.errno, e.strerror, path)
+        self.stat = os.fstat(self.fd)
+        self.checked = registry.clock()
+        self.refs = 0
+        self.lock = threading.Lock()
+
+    def pread(self, size, offset):
+        if pread is not None:
+            return pread(self.fd, size, offset)
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, size)
+
+    def release(self):
+        self.refs -= 1
+        if self.refs == 0:
+            self.registry.idle(self)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class FileHandle(object):
+    """ a file-like view on a L{SharedFile} with a position of its own """
+
+    def __init__(self, shared):
+        self.shared = shared
+        self.position = 0
+        self.closed = False
+
+    def fileno(self):
+        return self.shared.fd
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += os.fstat(self.fileno()).st_size
+        self.position = offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if size < 0:
+            size = max(os.fstat(self.fileno()).st_size - self.position, 0)
+        data = self.shared.pread(size, self.position)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.shared.release()
+
+
+class OpenFiles(object):
+    """
+    The files open for streaming, by path, together with their stat results.
+
+    Files stay open after their last request is done, up to max_idle of
+    them, the least recently used one is closed first. A cached stat
+    result is trusted for stat_lifetime seconds, after that the path is
+    stat'ed again and its file reopened if it was replaced or modified.
+    Backends that learn about changes earlier (inotify) call L{invalidate}.
+    """
+
+    def __init__(self, max_idle=32, stat_lifetime=2.0, clock=time.time):
+        self.max_idle = max_idle
+        self.stat_lifetime = stat_lifetime
+        self.clock = clock
+        self.files = {}
+        self._idle = OrderedDict()
+
+    def _lookup(self, path):
+        shared = self.files.get(path)
+        if shared is None:
+            return None
+        now = self.clock()
+        if now - shared.checked > self.stat_lifetime:
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            old = shared.stat
+            if(st is None or (st.st_ino, st.st_dev, st.st_size, st.st_mtime) !=
+               (old.st_ino, old.st_dev, old.st_size, old.st_mtime)):
+                self._forget(shared)
+                return None
+            shared.checked = now
+        if path in self._idle:
+            # most recently used ones go to the end
+            self._idle[path] = self._idle.pop(path)
+        return shared
+
+    def stat(self, path):
+        """ like os.stat, but answered from the open file if there is one """
+        shared = self._lookup(path)
+        if shared is not None:
+            return shared.stat
+        return os.stat(path)
+
+    def exists(self, path):
+        try:
+            self.stat(path)
+        except OSError:
+            return False
+        return True
+
+    def open(self, path):
+        shared = self._lookup(path)
+        if shared is None:
+            shared = self.files[path] = SharedFile(path, self)
+        self._idle.pop(path, None)
+        shared.refs += 1
+        return FileHandle(shared)
+
+    def idle(self, shared):
+        if self.files.get(shared.path) is not shared:
+            # invalidated while it was in use
+            shared.close()
+            return
+        self._idle[shared.path] = shared
+        while len(self._idle) > self.max_idle:
+            path, old = self._idle.popitem(last=False)
+            del self.files[path]
+            old.close()
+
+    def invalidate(self, path):
+        """ drop what we know about path, requests still reading from it
+            keep their file until they are done """
+        shared = self.files.get(path)
+        if shared is not None:
+            self._forget(shared)
+
+    def _forget(self, shared):
+        del self.files[shared.path]
+        if self._idle.pop(shared.path, None) is not None:
+            shared.close()
+
+    def clear(self):
+        for path in self.files.keys():
+            self.invalidate(path)
+
+open_files = OpenFiles()
+
+
+class SendfileProducer(static.StaticProducer, log.Loggable):
+    """
+    A pull producer writing size bytes of a file, starting at offset, to
+    the request.
+
+    The first chunk, which carries the response headers, goes through
+    request.write(), later ones are sent with sendfile whenever the
+    transport's buffer is empty. Once the socket is full we write to the
+    transport again until Twisted's flow control pauses us, we are resumed
+    when its buffer is flushed. The kernel is asked to read ahead of
+    sendfile.
+
+    Without sendfile the data is read through a L{readahead.ReadAhead},
+    and we wait for it whenever it isn't there yet.
+    """
+    logCategory = 'streaming'
+
+    sendfileSize = 2 ** 20
+
+    def __init__(self, request, fileObject, offset, size):
+        static.StaticProducer.__init__(self, request, fileObject)
+        log.Loggable.__init__(self)
+        self.offset = offset
+        self.size = size
+        self.bytesWritten = 0
+        self.socket_fd = None
+        self.readahead = readahead.ReadAhead(fileObject)
+
+    def start(self):
+        self.socket_fd = get_socket_fileno(self.request)
+        shaping.register_producer(self.request, self, False)
+
+    def _sendfile(self, count):
+        try:
+            return sendfile(self.socket_fd, self.fileObject.fileno(),
+                            self.offset + self.bytesWritten, count)
+        except (OSError, IOError), e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                # EINVAL/ENOSYS: not supported for this file, anything
+                # else the transport will notice soon enough
+                self.info("sendfile failed with %r, falling back to read/write", e)
+                self.socket_fd = None
+            return 0
+
+    def _write(self, wanted):
+        position = self.offset + self.bytesWritten
+        if self.socket_fd is None:
+            # what's left of the chunk read ahead, in one go
+            data = self.readahead.read(position, wanted, self.offset + self.size)
+            if isinstance(data, defer.Deferred):
+                return data
+        else:
+            # just a chunk between sendfile calls, the kernel has
+            # been told to read it already
+            self.fileObject.seek(position)
+            data = self.fileObject.read(min(self.bufferSize, wanted))
+        if not data:
+            # the file got truncated underneath us
+            self.size = self.bytesWritten
+        self.bytesWritten += len(data)
+        # this .write will spin the reactor, calling .doWrite and then
+        # .resumeProducing again, so be prepared for a re-entrant call
+        self.request.write(data)
+
+    def resumeProducing(self):
+        if not self.request:
+            return
+        wanted = self.size - self.bytesWritten
+        if wanted > 0:
+            count = 0
+            if(self.socket_fd is not None and
+               self.request.startedWriting and
+               transport_is_idle(self.request.transport)):
+                limit = self.sendfileSize
+                stream = getattr(self.request, 'stream', None)
+                if stream is not None and stream.limited():
+                    # keep shaped streams smooth
+                    limit = max(min(limit, stream.allowance()), self.bufferSize)
+                self.readahead.will_need(self.offset + self.bytesWritten, wanted)
+                count = self._sendfile(min(limit, wanted))
+            if count:
+                self.bytesWritten += count
+                self.request.sentLength += count
+            else:
+                # socket is full or the transport has still data buffered,
+                # a buffered write gets us paused until all of it is sent
+                waiting = self._write(wanted)
+                if waiting is not None:
+                    return waiting
+        if self.request and self.bytesWritten >= self.size:
+            self.request.unregisterProducer()
+            self.request.finish()
+            self.stopProducing()
+
+    def stopProducing(self):
+        fileObject = self.fileObject
+        self.readahead.stop().addCallback(lambda _: fileObject.close())
+        self.request = None
+
+
+class MediaFile(static.File):
+    """
+    A static.File for local media items.
+
+    Full and single range GETs are served through a L{SendfileProducer},
+    multiple (multipart/byteranges) and suffix ranges are handled by
+    static.File. The file is opened and stat'ed through L{open_files}, and
+    ETag, If-Match, If-None-Match, If-Unmodified-Since and If-Range are
+    honoured in addition to the If-Modified-Since handling of static.File.
+    """
+
+    def restat(self, reraise=True):
+        try:
+            self._statinfo = open_files.stat(self.path)
+        except OSError:
+            self._statinfo = 0
+            if reraise:
+                raise
+
+    def openForReading(self):
+        return open_files.open(self.path)
+
+    def getETag(self):
+        return '"%x-%x"' % (int(self.getModificationTime()), self.getsize())
+
+    def _check_preconditions(self, request, etag):
+        """ return True if the request may go on with the full or partial
+            content, otherwise the response code has been set """
+        if_match = request.getHeader('if-match')
+        if if_match and etag not in if_match.split() and if_match.strip() != '*':
+            request.setResponseCode(http.PRECONDITION_FAILED)
+            return False
+        unmodified_since = request.getHeader('if-unmodified-since')
+        if unmodified_since:
+            try:
+                since = http.stringToDatetime(unmodified_since.split(';', 1)[0])
+            except ValueError:
+                since = None
+            if since is not None and int(self.getModificationTime()) > since:
+                request.setResponseCode(http.PRECONDITION_FAILED)
+                return False
+        if request.setETag(etag) is http.CACHED:
+            return False
+        if_range = request.getHeader('if-range')
+        if if_range and request.getHeader('range'):
+            if if_range.startswith('"') or if_range.startswith('W/'):
+                valid = if_range == etag
+            else:
+                try:
+                    valid = http.stringToDatetime(if_range) >= int(self.getModificationTime())
+                except ValueError:
+                    valid = False
+            if not valid:
+                # the client's copy is outdated, send all of it
+                request.requestHeaders.removeHeader('range')
+        return True
+
+    def render_GET(self, request):
+        self.restat(False)
+        if self.exists() and not self.isdir():
+            if not self._check_preconditions(request, self.getETag()):
+                return ''
+        return static.File.render_GET(self, request)
+    render_HEAD = render_GET
+
+    def makeProducer(self, request, fileForReading):
+        producer = static.File.makeProducer(self, request, fileForReading)
+        if isinstance(producer, static.NoRangeStaticProducer):
+            return SendfileProducer(request, fileForReading, 0, self.getsize())
+        if isinstance(producer, static.SingleRangeStaticProducer):
+            return SendfileProducer(request, fileForReading,
+                                    producer.offset, producer.size)
+        return producer
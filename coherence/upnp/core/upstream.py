@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Persistent connections to the servers behind the proxy resources.
+
+L{UpstreamPool.forward} relays a request through an L{Agent} on a
+shared L{HTTPConnectionPool}, so the streams and the seeks of a client
+reuse the connections to the same host instead of connecting for each
+of them. The response body is passed through as it arrives, paused
+whenever the client's transport is full.
+
+SHOUTcast style servers answer with an 'ICY 200 OK' status line the
+Agent refuses. L{forward} fails with L{LegacyServer} then, before
+anything is written to the request, and remembers the server, so it
+is asked the old way, one connection per request, from then on.
+"""
+
+from StringIO import StringIO
+
+from twisted.internet import defer, protocol, reactor
+from twisted.web import client, http
+from twisted.web._newclient import ParseError, ResponseFailed
+from twisted.web.http_headers import Headers
+
+from coherence import log
+from coherence.upnp.core import shaping
+
+# RFC 2616 13.5.1, these are for one connection only
+HOP_BY_HOP = frozenset(['connection', 'keep-alive', 'proxy-authenticate',
+                        'proxy-authorization', 'proxy-connection', 'te',
+                        'trailers', 'transfer-encoding', 'upgrade'])
+
+
+class LegacyServer(Exception):
+    """ the server doesn't speak HTTP/1.x, use a connection of its own """
+
+
+class ProxyStream(protocol.Protocol):
+    """ writes a response body to the request, a push producer for it """
+
+    def __init__(self, request, finished):
+        self.request = request
+        self.finished = finished
+
+    def connectionMade(self):
+        shaping.register_producer(self.request, self, True)
+
+    def dataReceived(self, data):
+        if self.request is not None:
+            self.request.write(data)
+
+    def connectionLost(self, reason):
+        request, self.request = self.request, None
+        if request is not None:
+            request.unregisterProducer()
+            request.finish()
+        self.finished.callback(None)
+
+    def pauseProducing(self):
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.transport.resumeProducing()
+
+    def stopProducing(self):
+        if self.request is not None:
+            self.request = None
+            self.transport.stopProducing()
+
+
+class UpstreamPool(log.Loggable):
+    """
+    The connections to the upstream servers, see the module docstring.
+
+    max_persistent_per_host and idle_timeout are set from the config as
+    proxy_max_per_host and proxy_idle_timeout.
+    """
+    logCategory = 'upstream'
+
+    max_persistent_per_host = 4
+    # seconds an idle connection is kept open
+    idle_timeout = 60
+
+    def __init__(self, reactor=reactor):
+        log.Loggable.__init__(self)
+        self.reactor = reactor
+        self.pool = None
+        self.agent = None
+        # (host, port) of the servers answering with ICY
+        self.legacy = set()
+
+    def configure(self, max_persistent_per_host=None, idle_timeout=None):
+        if max_persistent_per_host is not None:
+            self.max_persistent_per_host = max_persistent_per_host
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+        if self.pool is not None:
+            self.pool.maxPersistentPerHost = self.max_persistent_per_host
+            self.pool.cachedConnectionTimeout = self.idle_timeout
+
+    def _prepare(self):
+        self.pool = client.HTTPConnectionPool(self.reactor, persistent=True)
+        self.pool.maxPersistentPerHost = self.max_persistent_per_host
+        self.pool.cachedConnectionTimeout = self.idle_timeout
+        self.agent = client.Agent(self.reactor, pool=self.pool)
+        self.reactor.addSystemEventTrigger('before', 'shutdown', self.shutdown)
+
+    def shutdown(self):
+        """ close the idle connections """
+        if self.pool is None:
+            return defer.succeed(None)
+        return self.pool.closeCachedConnections()
+
+    def is_legacy(self, host, port):
+        return (host, port) in self.legacy
+
+    def request(self, method, uri, headers=None, producer=None):
+        """ an L{Agent.request} on the pooled connections """
+        if self.agent is None:
+            self._prepare()
+        return self.agent.request(method, uri, headers, producer)
+
+    def forward(self, request, host, port, rest, body=''):
+        """ relay request to http://host:port/rest, returns a Deferred
+            firing once the response is written """
+        if port == 80:
+            uri = 'http://%s%s' % (host, rest)
+        else:
+            uri = 'http://%s:%d%s' % (host, port, rest)
+        headers = Headers()
+        for name, values in request.requestHeaders.getAllRawHeaders():
+            if name.lower() not in HOP_BY_HOP and name.lower() != 'host':
+                headers.setRawHeaders(name, values)
+        producer = None
+        if body:
+            producer = client.FileBodyProducer(StringIO(body))
+        self.debug("forwarding %s %s", request.method, uri)
+        d = self.request(request.method, uri, headers, producer)
+        gone = []
+        responded = []
+
+        def client_gone(failure):
+            gone.append(failure)
+            if not responded:
+                # once the response is there, the ProxyStream stops it
+                d.cancel()
+        request.notifyFinish().addErrback(client_gone)
+
+        def respond(response):
+            responded.append(response)
+            if gone:
+                response.deliverBody(protocol.Protocol())
+                return
+            request.setResponseCode(response.code, response.phrase)
+            for name, values in response.headers.getAllRawHeaders():
+                if name.lower() in HOP_BY_HOP or name.lower().startswith('icy-'):
+                    continue
+                request.responseHeaders.setRawHeaders(name, values)
+            finished = defer.Deferred()
+            stream = ProxyStream(request, finished)
+            request.notifyFinish().addErrback(lambda _: stream.stopProducing())
+            response.deliverBody(stream)
+            return finished
+
+        def failed(failure):
+            if gone:
+                return
+            if failure.check(ResponseFailed):
+                for reason in failure.value.reasons:
+                    if reason.check(ParseError):
+                        self.info("%s:%d isn't speaking HTTP/1.x, no keep-alive for it",
+                                  host, port)
+                        self.legacy.add((host, port))
+                        raise LegacyServer(host, port)
+            self.warning("forwarding to %s failed: %s", uri, failure.getErrorMessage())
+            request.setResponseCode(http.BAD_GATEWAY)
+            request.setHeader('content-type', 'text/html')
+            request.write('<html><p>the server behind this resource failed</p></html>')
+            request.finish()
+        d.addCallbacks(respond, failed)
+        return d
+
+
+pool = UpstreamPool()
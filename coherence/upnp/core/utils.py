@@ -3,17 +3,21 @@
 
 # Copyright (C) 2006 Fluendo, S.A. (www.fluendo.com).
 # Copyright 2006, Frank Scholz <coherence@beebits.net>
+import heapq
+import itertools
+import os
 import urlparse
 from io import StringIO
 from urlparse import urlsplit
 
 from lxml import etree
-from coherence import SERVER_ID
+from coherence import SERVER_ID, log
 from twisted.web import http, static
 from twisted.web import client, error
 from twisted.web import proxy, resource, server
 from twisted.internet import reactor, defer, abstract
 from twisted.python import failure
+from coherence.upnp.core import outbound, page_cache, readahead, shaping, upstream
 
 
 try:
@@ -50,15 +54,16 @@ generalize_boolean = generalise_boolean
 def parse_http_response(data):
 
     """ don't try to get the body, there are reponses without """
-    header = data.split('\r\n\r\n')[0]
+    header = data.partition('\r\n\r\n')[0]
 
     lines = header.split('\r\n')
     cmd = lines[0].split(' ')
-    lines = map(lambda x: x.replace(': ', ':', 1), lines[1:])
-    lines = filter(lambda x: len(x) > 0, lines)
 
-    headers = [x.split(':', 1) for x in lines]
-    headers = dict(map(lambda x: (x[0].lower(), x[1]), headers))
+    headers = {}
+    for line in lines[1:]:
+        key, sep, value = line.partition(':')
+        if sep:
+            headers[key.strip().lower()] = value.strip()
 
     return cmd, headers
 
@@ -258,14 +263,16 @@ class Site(server.Site):
         #http._logDateTimeStart()
 
 
-class ProxyClient(proxy.ProxyClient):
+class ProxyClient(proxy.ProxyClient, log.Loggable):
+    """ the client of the servers the pooled L{upstream} connections
+        can't talk to, SHOUTcast ones answering with ICY """
 
     def __init__(self, command, rest, version, headers, data, father):
         log.Loggable.__init__(self)
         #headers["connection"] = "close"
         self.send_data = 0
-        web.ProxyClient.__init__(self, command, rest, version,
-                                 headers, data, father)
+        proxy.ProxyClient.__init__(self, command, rest, version,
+                                   headers, data, father)
 
     def handleStatus(self, version, code, message):
         if message:
@@ -274,22 +281,20 @@ class ProxyClient(proxy.ProxyClient):
             message = " %s" % (message, )
         if version == 'ICY':
             version = 'HTTP/1.1'
-        web.ProxyClient.handleStatus(self, version, code, message)
+        proxy.ProxyClient.handleStatus(self, version, code, message)
 
     def handleHeader(self, key, value):
         if not key.startswith('icy-'):
-            web.ProxyClient.handleHeader(self, key, value)
+            proxy.ProxyClient.handleHeader(self, key, value)
 
     def handleResponsePart(self, buffer):
         self.send_data += len(buffer)
-        web.ProxyClient.handleResponsePart(self, buffer)
+        proxy.ProxyClient.handleResponsePart(self, buffer)
 
 
 class ProxyClientFactory(proxy.ProxyClientFactory):
 
-    # :fixme: Why here proxy.ProxyClient is used instad of our own
-    # ProxyClent? Is out ProxyClient used at all?
-    protocol = proxy.ProxyClient
+    protocol = ProxyClient
 
 
 class ReverseProxyResource(proxy.ReverseProxyResource):
@@ -299,6 +304,9 @@ class ReverseProxyResource(proxy.ReverseProxyResource):
     Put this resource in the tree to cause everything below it to be relayed
     to a different server.
 
+    Requests go over the persistent connections of L{upstream.pool},
+    servers it can't talk to get a new connection for each request.
+
     @ivar proxyClientFactoryClass: a proxy client factory class, used to create
         new connections.
     @type proxyClientFactoryClass: L{ClientFactory}
@@ -338,12 +346,6 @@ class ReverseProxyResource(proxy.ReverseProxyResource):
         """
         Render a request by forwarding it to the proxied server.
         """
-        # RFC 2616 tells us that we can omit the port if it's the default port,
-        # but we have to provide it otherwise
-        if self.port == 80:
-            request.received_headers['host'] = self.host
-        else:
-            request.received_headers['host'] = "%s:%d" % (self.host, self.port)
         request.content.seek(0, 0)
         qs = urlparse.urlparse(request.uri)[4]
         if qs == '':
@@ -352,11 +354,30 @@ class ReverseProxyResource(proxy.ReverseProxyResource):
             rest = self.path + '?' + qs
         else:
             rest = self.path
+        data = request.content.read()
+        if upstream.pool.is_legacy(self.host, self.port):
+            self.connect(request, rest, data)
+        else:
+            d = upstream.pool.forward(request, self.host, self.port, rest, data)
+            d.addErrback(self._legacy, request, rest, data)
+        return server.NOT_DONE_YET
+
+    def _legacy(self, failure, request, rest, data):
+        failure.trap(upstream.LegacyServer)
+        self.connect(request, rest, data)
+
+    def connect(self, request, rest, data):
+        """ forward the request on a connection of its own """
+        # RFC 2616 tells us that we can omit the port if it's the default port,
+        # but we have to provide it otherwise
+        if self.port == 80:
+            request.requestHeaders.setRawHeaders('host', [self.host])
+        else:
+            request.requestHeaders.setRawHeaders('host', ["%s:%d" % (self.host, self.port)])
         clientFactory = self.proxyClientFactoryClass(
             request.method, rest, request.clientproto,
-            request.getAllHeaders(), request.content.read(), request)
+            request.getAllHeaders(), data, request)
         self.reactor.connectTCP(self.host, self.port, clientFactory)
-        return server.NOT_DONE_YET
 
     def resetTarget(self, host, port, path, qs=''):
         self.host = host
@@ -433,6 +454,12 @@ def getPage(url, contextFactory=None, *args, **kwargs):
     page (as a string) or errback with a description of the error.
 
     See HTTPClientFactory to see what extra args can be passed.
+
+    GET requests are answered from the L{page_cache} if it is enabled,
+    the others wait for their turn in the L{outbound} scheduler, by the
+    priority keyword argument, PRIORITY_METADATA if not given. GET and
+    HEAD requests time out after the scheduler's timeout unless they
+    give one, timeout=0 for none, for downloads of whole media files.
     """
     # This function is like twisted.web.client.getPage, except it uses
     # our HeaderAwareHTTPClientFactory instead of HTTPClientFactory
@@ -441,11 +468,39 @@ def getPage(url, contextFactory=None, *args, **kwargs):
         kwargs['agent'] = kwargs['headers']['user-agent']
     elif not 'agent' in kwargs:
         kwargs['agent'] = "Coherence PageGetter"
-    return client._makeGetterFactory(
-        url,
-        HeaderAwareHTTPClientFactory,
-        contextFactory=contextFactory,
-        *args, **kwargs).deferred
+    if page_cache.cache.cacheable(kwargs):
+        return page_cache.cache.getPage(_fetchPage, url, contextFactory, *args, **kwargs)
+    return _fetchPage(url, contextFactory, *args, **kwargs)
+
+
+def _default_timeout(args, kwargs):
+    """ the scheduler's timeout for the GET and HEAD requests of metadata
+        which don't give one, uploads don't get one """
+    if args or kwargs.get('postdata') is not None:
+        return
+    if kwargs.get('method', 'GET') in ('GET', 'HEAD'):
+        kwargs.setdefault('timeout', outbound.scheduler.timeout)
+
+
+def _fetchPage(url, contextFactory=None, *args, **kwargs):
+    """ download url through the outbound scheduler, the HTTP errors
+        carry the response headers as response_headers """
+    priority = kwargs.pop('priority', outbound.PRIORITY_METADATA)
+    _default_timeout(args, kwargs)
+
+    def start():
+        factory = client._makeGetterFactory(
+            url,
+            HeaderAwareHTTPClientFactory,
+            contextFactory=contextFactory,
+            *args, **kwargs)
+
+        def failed(f):
+            if f.check(error.Error):
+                f.value.response_headers = factory.response_headers
+            return f
+        return factory.deferred.addErrback(failed)
+    return outbound.scheduler.schedule(url, start, priority)
 
 
 def downloadPage(url, file, contextFactory=None, *args, **kwargs):
@@ -453,6 +508,96 @@ def downloadPage(url, file, contextFactory=None, *args, **kwargs):
 
     @param file: path to file on filesystem, or file-like object.
 
+    See twisted.web.client.HTTPDownloader to see what extra args can
+    be passed, and getPage for the priority. There is no timeout unless
+    one is given, the downloads are media files usually.
+    """
+    if 'headers' in kwargs and 'user-agent' in kwargs['headers']:
+        kwargs['agent'] = kwargs['headers']['user-agent']
+    elif not 'agent' in kwargs:
+        kwargs['agent'] = "Coherence PageGetter"
+    priority = kwargs.pop('priority', outbound.PRIORITY_METADATA)
+    return outbound.scheduler.schedule(url, lambda: client.downloadPage(
+        url, file, contextFactory=contextFactory, *args, **kwargs), priority)
+
+
+class GrowingFile(object):
+    """
+    Book-keeping for a file that is still being written to, usually by a
+    L{GrowingFileDownloader}.
+
+    Readers don't poll the file size, they get a Deferred from L{wait_for}
+    which fires with the available size as soon as the byte at the given
+    offset has arrived, or the file is complete.
+    """
+
+    def __init__(self, path, target_size=0):
+        self.path = path
+        self.target_size = int(target_size)
+        try:
+            self.size = os.path.getsize(path)
+        except OSError:
+            self.size = 0
+        self.finished = False
+        self._waiters = []
+        self._counter = itertools.count()
+
+    def wait_for(self, offset):
+        if self.finished or offset < self.size:
+            return defer.succeed(self.size)
+        d = defer.Deferred()
+        heapq.heappush(self._waiters, (offset, next(self._counter), d))
+        return d
+
+    def written(self, count):
+        self.size += count
+        self._wake()
+
+    def restarted(self):
+        self.size = 0
+
+    def finish(self):
+        self.finished = True
+        self._wake()
+
+    def _wake(self):
+        waiters = self._waiters
+        while waiters and (self.finished or waiters[0][0] < self.size):
+            _, _, d = heapq.heappop(waiters)
+            # cancelled waiters ignore this
+            d.callback(self.size)
+
+
+class GrowingFileDownloader(client.HTTPDownloader):
+    """ an HTTPDownloader telling its L{GrowingFile} about every
+        piece of data written """
+
+    def __init__(self, url, growing_file, *args, **kwargs):
+        self.growing_file = growing_file
+        client.HTTPDownloader.__init__(self, url, growing_file.path, *args, **kwargs)
+        self.deferred.addBoth(self._finished)
+
+    def openFile(self, partialContent):
+        file = client.HTTPDownloader.openFile(self, partialContent)
+        if not partialContent:
+            self.growing_file.restarted()
+        return file
+
+    def pagePart(self, data):
+        client.HTTPDownloader.pagePart(self, data)
+        if self.file:
+            self.file.flush()
+            self.growing_file.written(len(data))
+
+    def _finished(self, result):
+        self.growing_file.finish()
+        return result
+
+
+def downloadGrowingFile(url, growing_file, contextFactory=None, *args, **kwargs):
+    """Download a web page to the file of a L{GrowingFile}, which
+    wakes up the readers of that file as data arrives.
+
     See twisted.web.client.HTTPDownloader to see what extra args can
     be passed.
     """
@@ -460,8 +605,12 @@ def downloadPage(url, file, contextFactory=None, *args, **kwargs):
         kwargs['agent'] = kwargs['headers']['user-agent']
     elif not 'agent' in kwargs:
         kwargs['agent'] = "Coherence PageGetter"
-    return client.downloadPage(url, file, contextFactory=contextFactory,
-                        *args, **kwargs)
+    return client._makeGetterFactory(
+        url,
+        GrowingFileDownloader,
+        contextFactory,
+        growing_file,
+        *args, **kwargs).deferred
 
 
 # StaticFile used to be a patched version of static.File. The later
@@ -476,10 +625,30 @@ class BufferFile(static.File):
         http://resnet.uoregon.edu/~gurney_j/jmpc/dist/twisted.web.static.patch
     """
 
-    def __init__(self, path, target_size=0, *args):
-        static.File.__init__(self, path, *args)
+    def __init__(self, path, target_size=0, *args, **kwargs):
+        growing_file = kwargs.pop('growing_file', None)
+        static.File.__init__(self, path, *args, **kwargs)
         self.target_size = target_size
-        self.upnp_retry = None
+        if growing_file is None:
+            # nobody is writing to this file
+            growing_file = GrowingFile(path, target_size)
+            growing_file.finish()
+        self.growing_file = growing_file
+
+    def _render_when_available(self, request, offset):
+        d = self.growing_file.wait_for(offset)
+        request.notifyFinish().addErrback(lambda _: d.cancel())
+
+        def render(_):
+            if request.finished:
+                return
+            result = self.render(request)
+            if result != server.NOT_DONE_YET:
+                request.write(result)
+                request.finish()
+
+        d.addCallbacks(render, lambda f: f.trap(defer.CancelledError))
+        return server.NOT_DONE_YET
 
     def render(self, request):
         #print ""
@@ -530,57 +699,50 @@ class BufferFile(static.File):
             else:
                 raise
         if request.setLastModified(self.getmtime()) is http.CACHED:
+            f.close()
             return ''
         trans = True
 
         range = request.getHeader('range')
-        #print "StaticFile", range
 
         tsize = size
         if range is not None:
-            # This is a request for partial data...
-            bytesrange = range.split('=')
-            assert bytesrange[0] == 'bytes', \
-                   "Syntactically invalid http range header!"
-            start, end = bytesrange[1].split('-', 1)
-            if start:
-                start = int(start)
+            # This is a request for partial data, parsed like static.File
+            # does, but multiple ranges of a growing file get all of it
+            try:
+                ranges = self._parseRangeHeader(range)
+            except ValueError:
+                ranges = []
+            if len(ranges) == 1:
+                start, end = ranges[0]
+                if start is None:
+                    # the last end bytes
+                    start = max(0, size - end)
+                    end = size - 1
+                elif end is None or end >= size:
+                    end = size - 1
                 # Are we requesting something beyond the current size of the file?
-                if (start >= self.getFileSize()):
-                    # Retry later!
-                    print bytesrange
-                    print "Requesting data beyond current scope -> postpone rendering!"
-                    self.upnp_retry = reactor.callLater(1.0, self.render, request)
-                    return server.NOT_DONE_YET
-
-                f.seek(start)
-                if end:
-                    #print ":%s" % end
-                    end = int(end)
+                if(start < size and
+                   start >= self.growing_file.size and
+                   not self.growing_file.finished):
+                    # render once the download got there
+                    f.close()
+                    return self._render_when_available(request, start)
+                # start is the byte offset to begin, and end is the byte offset
+                # to end..  fsize is size to send, tsize is the real size of
+                # the file, and size is the byte position to stop sending.
+                fsize = end - start + 1
+                if start >= size or fsize <= 0:
+                    request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+                    request.setHeader('content-range', 'bytes */%d' % tsize)
+                    fsize = 0
+                    trans = False
                 else:
-                    end = size - 1
-            else:
-                lastbytes = int(end)
-                if size < lastbytes:
-                    lastbytes = size
-                start = size - lastbytes
-                f.seek(start)
-                fsize = lastbytes
-                end = size - 1
-            size = end + 1
-            fsize = end - int(start) + 1
-            # start is the byte offset to begin, and end is the byte offset
-            # to end..  fsize is size to send, tsize is the real size of
-            # the file, and size is the byte position to stop sending.
-            if fsize <= 0:
-                request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
-                fsize = tsize
-                trans = False
-            else:
-                request.setResponseCode(http.PARTIAL_CONTENT)
-                request.setHeader('content-range', "bytes %s-%s/%s " % (
-                    str(start), str(end), str(tsize)))
-                #print "StaticFile", start, end, tsize
+                    f.seek(start)
+                    size = end + 1
+                    request.setResponseCode(http.PARTIAL_CONTENT)
+                    request.setHeader('content-range', 'bytes %d-%d/%d' % (
+                        start, end, tsize))
 
         request.setHeader('content-length', str(fsize))
 
@@ -594,47 +756,75 @@ class BufferFile(static.File):
         # return data
         # size is the byte position to stop sending, not how many bytes to send
 
-        BufferFileTransfer(f, size - f.tell(), request)
+        BufferFileTransfer(f, size, request, self.growing_file)
         # and make sure the connection doesn't get closed
         return server.NOT_DONE_YET
 
 
 class BufferFileTransfer(object):
     """
-    A class to represent the transfer of a file over the network.
+    A push producer sending a file, which may still be growing, up to the
+    byte position end. When it catches up with the download it waits for
+    the L{GrowingFile} to report more data.
     """
     request = None
 
-    def __init__(self, file, size, request):
+    def __init__(self, file, end, request, growing_file):
         self.file = file
-        self.size = size
+        self.end = end
         self.request = request
-        self.written = self.file.tell()
-        request.registerProducer(self, 0)
+        self.growing_file = growing_file
+        self.position = file.tell()
+        self.paused = False
+        self.waiting = None
+        self.readahead = readahead.ReadAhead(file)
+        shaping.register_producer(request, self, True)
+        self.produce()
+
+    def produce(self):
+        while self.request and not self.paused and self.waiting is None:
+            available = min(self.end, self.growing_file.size) - self.position
+            if available <= 0:
+                if self.position >= self.end or self.growing_file.finished:
+                    self.request.unregisterProducer()
+                    self.request.finish()
+                    self.stopProducing()
+                    return
+                self.waiting = self.growing_file.wait_for(self.position)
+                self.waiting.addCallbacks(self._data_available,
+                                          lambda f: f.trap(defer.CancelledError))
+                return
+            data = self.readahead.read(self.position,
+                                       min(abstract.FileDescriptor.bufferSize, available),
+                                       self.position + available)
+            if isinstance(data, defer.Deferred):
+                self.waiting = data
+                self.waiting.addCallbacks(self._data_available,
+                                          lambda f: f.trap(defer.CancelledError))
+                return
+            if not data:
+                self.end = self.position
+                continue
+            self.position += len(data)
+            # this .write may call pauseProducing
+            self.request.write(data)
+
+    def _data_available(self, size):
+        self.waiting = None
+        self.produce()
 
     def resumeProducing(self):
-        #print "resumeProducing", self.request,self.size,self.written
-        if not self.request:
-            return
-        data = self.file.read(min(abstract.FileDescriptor.bufferSize, self.size - self.written))
-        if data:
-            self.written += len(data)
-            # this .write will spin the reactor, calling .doWrite and then
-            # .resumeProducing again, so be prepared for a re-entrant call
-            self.request.write(data)
-        if self.request and self.file.tell() == self.size:
-            self.request.unregisterProducer()
-            self.request.finish()
-            self.request = None
+        self.paused = False
+        self.produce()
 
     def pauseProducing(self):
-        pass
+        self.paused = True
 
     def stopProducing(self):
-        #print "stopProducing",self.request
-        self.request.unregisterProducer()
-        self.file.close()
-        self.request.finish()
+        if self.waiting is not None:
+            self.waiting.cancel()
+            self.waiting = None
+        self.readahead.stop().addCallback(lambda _: self.file.close())
         self.request = None
 
 from datetime import datetime, tzinfo, timedelta
@@ -27,7 +27,8 @@ class DeviceHttpRoot(resource.Resource, log.Loggable):
     def getChildWithDefault(self, path, request):
         self.info('DeviceHttpRoot %s getChildWithDefault %s %s %s',
                   self.server.device_type, path, request.uri, request.client)
-        self.info(request.getAllHeaders())
+        if self.isEnabledFor(log.INFO):
+            self.info(request.getAllHeaders())
         if self.children.has_key(path):
             return self.children[path]
         if request.uri == '/':
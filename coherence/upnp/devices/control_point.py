@@ -6,9 +6,9 @@
 import traceback
 
 from twisted.internet import reactor
-from twisted.web import xmlrpc, client
+from twisted.web import xmlrpc
 
-from coherence.upnp.core import service
+from coherence.upnp.core import service, utils
 from coherence.upnp.core.event import EventServer
 
 from coherence.upnp.devices.media_server_client import MediaServerClient
@@ -104,10 +104,10 @@ class ControlPoint(log.Loggable):
         else:
             self.queries.append(query)
 
-    def connect(self, receiver, signal=louie.signal.All, sender=louie.sender.Any, weak=True):
+    def connect(self, receiver, signal=louie.signal.All, sender=louie.sender.Any, weak=True, priority=0):
         """ wrapper method around louie.connect
         """
-        louie.connect(receiver, signal=signal, sender=sender, weak=weak)
+        louie.connect(receiver, signal=signal, sender=sender, weak=weak, priority=priority)
 
     def disconnect(self, receiver, signal=louie.signal.All, sender=louie.sender.Any, weak=True):
         """ wrapper method around louie.disconnect
@@ -178,8 +178,9 @@ class ControlPoint(log.Loggable):
                 "Content-Type": "application/octet-stream",
                 "Content-Length": str(len(data))
             }
-            df = client.getPage(url, method="POST",
-                                headers=headers, postdata=data)
+            df = utils.getPage(url, method="POST",
+                               headers=headers, postdata=data)
+            df.addCallback(lambda result: result[0])
             df.addCallback(got_result)
             df.addErrback(got_error)
             return df
@@ -20,6 +20,8 @@ from coherence import log, __version__, __url__, __service_name__
 from coherence.upnp.core import xml_constants
 from coherence.upnp.core.utils import StaticFile
 from coherence.upnp.core.utils import ReverseProxyResource
+from coherence.upnp.core.streaming import MediaFile, open_files
+from coherence.upnp.core import shaping, upstream
 from coherence.upnp.services.servers.connection_manager_server import ConnectionManagerServer
 from coherence.upnp.services.servers.content_directory_server import ContentDirectoryServer
 from coherence.upnp.services.servers.scheduled_recording_server import ScheduledRecordingServer
@@ -46,7 +48,7 @@ class MSRoot(resource.Resource, log.Loggable):
         self.info('%s getChildWithDefault, %s, %s, %s %s', self.server.device_type, request.method,
                   path, request.uri, request.client)
         headers = request.getAllHeaders()
-        self.msg(request.getAllHeaders())
+        self.msg(headers)
 
         try:
             if headers['getcontentfeatures.dlna.org'] != '1':
@@ -246,6 +248,9 @@ class MSRoot(resource.Resource, log.Loggable):
         self.info("finished, sentLength: %d chunked: %d code: %d", request.sentLength, request.chunked, request.code)
         #self.info("finished %r", request.headers)
         self.server.connection_manager_server.remove_connection(id)
+        stream = shaping.scheduler.remove(id)
+        if stream is not None:
+            self.info("finished, stream metrics %r", stream.metrics())
 
     def import_file(self, name, request):
         self.info("import file, id %s", name)
@@ -266,12 +271,24 @@ class MSRoot(resource.Resource, log.Loggable):
         dfr.addCallback(got_file)
         return dfr
 
-    def prepare_connection(self, request):
+    def prepare_connection(self, request, ch=None):
         new_id, _, _ = self.server.connection_manager_server.add_connection('', 'Output', -1, '')
         self.info("startup, add %d to connection table", new_id)
+        shaping.scheduler.add(new_id, request, self.stream_rate(ch))
         d = request.notifyFinish()
         d.addBoth(self.requestFinished, new_id, request)
 
+    def stream_rate(self, ch):
+        """ the rate cap for streaming ch, stream_rate_headroom times
+            the bitrate of its first res, 0 for none """
+        headroom = self.server.stream_rate_headroom
+        if not headroom:
+            return 0
+        try:
+            return int(int(ch.item.res[0].bitrate) * headroom)
+        except (AttributeError, IndexError, TypeError, ValueError):
+            return 0
+
     def prepare_headers(self, ch, request):
         request.setHeader('transferMode.dlna.org', request._dlna_transfermode)
         if hasattr(ch, 'item') and hasattr(ch.item, 'res'):
@@ -308,7 +325,7 @@ class MSRoot(resource.Resource, log.Loggable):
                 if(isinstance(ch.location, ReverseProxyResource) or
                    isinstance(ch.location, resource.Resource)):
                     #self.info('getChild proxy %s to %s' % (name, ch.location.uri))
-                    self.prepare_connection(request)
+                    self.prepare_connection(request, ch)
                     self.prepare_headers(ch, request)
                     return ch.location
             try:
@@ -319,11 +336,11 @@ class MSRoot(resource.Resource, log.Loggable):
                 self.debug("error accessing items path %r", msg)
                 self.debug(traceback.format_exc())
                 return self.list_content(name, ch, request)
-            if p != None and os.path.exists(p):
+            if p != None and open_files.exists(p):
                 self.info("accessing path %r", p)
-                self.prepare_connection(request)
+                self.prepare_connection(request, ch)
                 self.prepare_headers(ch, request)
-                ch = StaticFile(p)
+                ch = MediaFile(p)
             else:
                 self.debug("accessing path %r failed", p)
                 return self.list_content(name, ch, request)
@@ -552,6 +569,9 @@ class MediaServer(log.Loggable, BasicDeviceMixin):
 
     presentationURL = None
 
+    # cap streams at that many times their res@bitrate, 0 for no caps
+    stream_rate_headroom = 0
+
     def __init__(self, coherence, backend, **kwargs):
         BasicDeviceMixin.__init__(self, coherence, backend, **kwargs)
         log.Loggable.__init__(self)
@@ -616,6 +636,22 @@ class MediaServer(log.Loggable, BasicDeviceMixin):
         except LookupError, msg:
             self.info('ScheduledRecordingServer %s', msg)
 
+        try:
+            # kbit/s for all streams together
+            max_bandwidth = int(self.coherence.config.get('max_bandwidth', 0))
+            if max_bandwidth:
+                shaping.scheduler.rate = max_bandwidth * 1000 / 8
+            self.stream_rate_headroom = float(self.coherence.config.get('stream_rate_headroom', 0))
+        except (TypeError, ValueError), msg:
+            self.warning('invalid bandwidth settings %s', msg)
+
+        try:
+            upstream.pool.configure(
+                int(self.coherence.config.get('proxy_max_per_host', upstream.pool.max_persistent_per_host)),
+                int(self.coherence.config.get('proxy_idle_timeout', upstream.pool.idle_timeout)))
+        except (TypeError, ValueError), msg:
+            self.warning('invalid proxy settings %s', msg)
+
         upnp_init = getattr(self.backend, "upnp_init", None)
         if upnp_init:
             upnp_init()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+# browse-benchmark.py
+#
+# browses a container of music tracks through the ContentDirectory
+# Browse action, with logging at WARN unless another level is given,
+# and reports the Browse actions handled per second
+#
+# usage: browse-benchmark.py [rounds] [tracks] [loglevel]
+#
+
+import sys
+import time
+
+from coherence import log
+from coherence.backend import AbstractBackendStore, BackendItem, Container
+from coherence.upnp.core import DIDLLite
+from coherence.upnp.services.servers.content_directory_server import ContentDirectoryServer
+
+
+class Track(BackendItem):
+
+    def __init__(self, title):
+        BackendItem.__init__(self)
+        self.name = title
+        self.mimetype = 'audio/mpeg'
+        self.item = None
+
+    def get_item(self):
+        if self.item is None:
+            self.item = DIDLLite.MusicTrack(self.storage_id, self.parent.get_id(), self.name)
+            self.item.res.append(DIDLLite.Resource(self.url, 'http-get:*:%s:*' % self.mimetype))
+        return self.item
+
+
+def server(tracks):
+    store = AbstractBackendStore(None, urlbase='http://192.168.1.10:30020/content/')
+    root = Container(None, 'root')
+    store.set_root_item(root)
+    for n in range(tracks):
+        root.add_child(Track('track %04d' % n))
+
+    # the Browse action only needs the backend, not a device
+    cds = ContentDirectoryServer.__new__(ContentDirectoryServer)
+    log.Loggable.__init__(cds)
+    cds.backend = store
+    cds.transcoding = False
+    return cds, root
+
+
+def main(rounds=500, tracks=50, loglevel='WARN'):
+    log.init(loglevel=loglevel)
+    cds, root = server(tracks)
+    results = []
+
+    start = time.time()
+    for _ in range(rounds):
+        d = cds.upnp_Browse(ObjectID=str(root.get_id()), BrowseFlag='BrowseDirectChildren',
+                            Filter='*', StartingIndex='0', RequestedCount='0',
+                            SortCriteria='')
+        d.addCallback(results.append)
+    elapsed = time.time() - start
+
+    print '%d Browse actions of %d tracks, %d answered, in %.3fs, %.0f Browse/s' % (
+        rounds, tracks, len(results), elapsed, rounds / elapsed)
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:3]] + sys.argv[3:4]
+    main(*args)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+# sendfile-benchmark.py
+#
+# compares the throughput of serving a local file through
+# twisted.web.static.File (the former MSRoot path) and through
+# coherence.upnp.core.streaming.MediaFile, with several clients
+# downloading concurrently over the loopback interface
+#
+# usage: sendfile-benchmark.py [size in MB] [clients]
+#
+
+import os
+import sys
+import tempfile
+import time
+
+from twisted.internet import reactor, defer, protocol
+from twisted.web import server, resource, static
+
+from coherence.upnp.core import streaming
+
+
+class Download(protocol.Protocol):
+
+    def connectionMade(self):
+        self.received = 0
+        self.transport.write('GET /media HTTP/1.0\r\n\r\n')
+
+    def dataReceived(self, data):
+        self.received += len(data)
+
+    def connectionLost(self, reason):
+        self.factory.done.callback(self.received)
+
+
+def download(port):
+    factory = protocol.ClientFactory()
+    factory.protocol = Download
+    factory.done = defer.Deferred()
+    reactor.connectTCP('127.0.0.1', port, factory)
+    return factory.done
+
+
+@defer.inlineCallbacks
+def run(name, resource_class, path, size, clients):
+    root = resource.Resource()
+    root.putChild('media', resource_class(path))
+    port = reactor.listenTCP(0, server.Site(root), interface='127.0.0.1')
+    cpu = os.times()
+    start = time.time()
+    received = yield defer.gatherResults(
+        [download(port.getHost().port) for _ in range(clients)])
+    elapsed = time.time() - start
+    cpu = sum(os.times()[:2]) - sum(cpu[:2])
+    yield port.stopListening()
+    print '%-10s %d clients, %.1f MB/s, %.2fs CPU for %d MB' % (
+        name, clients, sum(received) / elapsed / 2 ** 20, cpu,
+        sum(received) / 2 ** 20)
+
+
+@defer.inlineCallbacks
+def main(size, clients):
+    if streaming.sendfile is None:
+        print 'sendfile not available, MediaFile will fall back to read/write'
+    fd, path = tempfile.mkstemp()
+    try:
+        chunk = os.urandom(2 ** 20)
+        for _ in range(size):
+            os.write(fd, chunk)
+        os.close(fd)
+        yield run('StaticFile', static.File, path, size, clients)
+        yield run('MediaFile', streaming.MediaFile, path, size, clients)
+    finally:
+        os.unlink(path)
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    reactor.callWhenRunning(main, size, clients)
+    reactor.run()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+# signal-benchmark.py
+#
+# sends louie signals the way StateVariable.notify and the SSDP server
+# do, most of them without a receiver, and reports the signals handled
+# per second
+#
+# usage: signal-benchmark.py [rounds] [signals per round]
+#
+
+import sys
+import time
+
+from twisted.internet import reactor
+
+import coherence.extern.louie as louie
+
+SIGNALS = ('Coherence.UPnP.StateVariable.changed',
+           'Coherence.UPnP.StateVariable.SystemUpdateID.changed',
+           'Coherence.UPnP.SSDP.new_device',
+           'Coherence.UPnP.SSDP.removed_device')
+
+
+def main(rounds=200, per_round=1000):
+    louie.reset()
+    received = []
+
+    def receiver(*args, **kwargs):
+        received.append(args)
+    # one signal out of four has a receiver
+    louie.connect(receiver, SIGNALS[0])
+
+    count = 0
+    start = time.time()
+    for _ in range(rounds):
+        for n in range(per_round):
+            louie.send(SIGNALS[n % len(SIGNALS)], None, n)
+        count += per_round
+        # deliver what was saved during this round
+        while len(received) < count / len(SIGNALS):
+            reactor.runUntilCurrent()
+    elapsed = time.time() - start
+
+    print '%d signals, %d received, in %.3fs, %.0f signals/s' % (
+        count, len(received), elapsed, count / elapsed)
+    for receiver in louie.timings():
+        print '%r: %d calls, %.3fs, at most %.6fs' % (
+            receiver.callback, receiver.calls, receiver.time, receiver.max_time)
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:3]]
+    main(*args)
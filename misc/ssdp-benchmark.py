@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+# ssdp-benchmark.py
+#
+# replays a synthetic capture of M-SEARCH and NOTIFY traffic, like it is
+# seen on a busy LAN, against an SSDPServer and reports the datagrams
+# handled per second
+#
+# usage: ssdp-benchmark.py [rounds]
+#
+
+import sys
+import time
+
+from twisted.internet import reactor, task
+from twisted.test import proto_helpers
+
+from coherence.upnp.core import ssdp
+
+UUID = 'uuid:4e7c5d38-6f35-4c2a-9a17-0f0b5c5e1c01'
+LOCATION = 'http://192.168.1.10:30020/4e7c5d38/'
+
+LOCAL = (
+    ('upnp:rootdevice', UUID + '::upnp:rootdevice'),
+    (UUID, UUID),
+    ('urn:schemas-upnp-org:device:MediaServer:1',
+     UUID + '::urn:schemas-upnp-org:device:MediaServer:1'),
+    ('urn:schemas-upnp-org:service:ContentDirectory:1',
+     UUID + '::urn:schemas-upnp-org:service:ContentDirectory:1'),
+    ('urn:schemas-upnp-org:service:ConnectionManager:1',
+     UUID + '::urn:schemas-upnp-org:service:ConnectionManager:1'),
+    ('urn:microsoft.com:service:X_MS_MediaReceiverRegistrar:1',
+     UUID + '::urn:microsoft.com:service:X_MS_MediaReceiverRegistrar:1'),
+    )
+
+MSEARCH = '\r\n'.join((
+    'M-SEARCH * HTTP/1.1',
+    'HOST: 239.255.255.250:1900',
+    'MAN: "ssdp:discover"',
+    'MX: 3',
+    'ST: %s',
+    '', ''))
+
+NOTIFY = '\r\n'.join((
+    'NOTIFY * HTTP/1.1',
+    'Host:239.255.255.250:1900',
+    'NT:%s',
+    'NTS:ssdp:alive',
+    'Location:http://192.168.1.%d:2869/upnp?content=uuid:%08x',
+    'USN: uuid:%08x::%s',
+    'Cache-Control: max-age=1800',
+    'Server:Microsoft-Windows-NT/5.1 UPnP/1.0 UPnP-Device-Host/1.0',
+    '', ''))
+
+
+def capture(devices=40):
+    """ one discovery campaign: every device announces itself and its
+        services, a few control points search for everything and for
+        MediaServers """
+    packets = []
+    for n in range(devices):
+        for nt in ('upnp:rootdevice',
+                   'urn:schemas-upnp-org:device:MediaRenderer:1',
+                   'urn:schemas-upnp-org:service:AVTransport:1',
+                   'urn:schemas-upnp-org:service:RenderingControl:1'):
+            packets.append((NOTIFY % (nt, 100 + n, n, n, nt),
+                            ('192.168.1.%d' % (100 + n), 1900)))
+        if n % 4 == 0:
+            packets.append((MSEARCH % 'ssdp:all',
+                            ('192.168.1.%d' % (100 + n), 50000 + n)))
+        if n % 2 == 0:
+            packets.append((MSEARCH % 'urn:schemas-upnp-org:device:MediaServer:1',
+                            ('192.168.1.%d' % (100 + n), 50000 + n)))
+    return packets
+
+
+def main(rounds=200):
+    clock = task.Clock()
+    ssdp.reactor = clock
+    server = ssdp.SSDPServer(test=True)
+    transport = proto_helpers.FakeDatagramTransport()
+    server.makeConnection(transport)
+    for st, usn in LOCAL:
+        server.register('local', usn, st, LOCATION)
+
+    packets = capture()
+    count = 0
+    start = time.time()
+    for _ in range(rounds):
+        for data, address in packets:
+            server.datagramReceived(data, address)
+        count += len(packets)
+        # fire the delayed responses and the queued signals
+        clock.advance(10)
+        reactor.runUntilCurrent()
+        del transport.written[:]
+    elapsed = time.time() - start
+
+    print '%d datagrams in %.3fs, %.0f datagrams/s' % (
+        count, elapsed, count / elapsed)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
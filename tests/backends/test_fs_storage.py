@@ -9,9 +9,13 @@
 Test cases for L{upnp.backends.fs_storage}
 """
 
+import os
+
 from twisted.trial import unittest
 from twisted.python.filepath import FilePath
+from twisted.internet import defer
 
+from coherence import thumbnails
 from coherence.backends import fs_storage
 
 import coherence.log
@@ -120,3 +124,100 @@ class TestFSStorage(unittest.TestCase):
                          'audio')
         self.assertEqual(self.storage.get_by_id('1005').get_name(),
                          'album-1')
+
+
+class TestFSStorageThumbnails(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_content = FilePath(self.mktemp())
+        self.tmp_content.makedirs()
+        self.tmp_content.child('photo.jpg').setContent('a photo')
+        self.rendered = []
+        service = thumbnails.ThumbnailService()
+        service.directory = self.mktemp()
+        service.render = lambda *job: self.rendered.append(job) or defer.Deferred()
+        self.patch(thumbnails, 'service', service)
+        self.patch(thumbnails, 'renderer_available', lambda: True)
+        self.storage = fs_storage.FSStore(None, name='my media',
+                                          content=self.tmp_content.path,
+                                          urlbase='http://fsstore-host/xyz',
+                                          enable_inotify=False)
+
+    def tearDown(self):
+        self.tmp_content.remove()
+
+    def test_renditions(self):
+        photo = self.storage.get_by_id('1001.jpg')
+        self.assertEqual(photo.get_name(), 'photo.jpg')
+        protocols = [res.protocolInfo for res in photo.item.res]
+        for profile in ('JPEG_TN', 'JPEG_SM'):
+            self.assertTrue([p for p in protocols if 'DLNA.ORG_PN=%s;' % profile in p])
+            self.assertIsInstance(photo.item.attachments[profile],
+                                  thumbnails.ThumbnailResource)
+        # prepared in the background
+        self.assertEqual([job[2] for job in self.rendered], ['JPEG_TN', 'JPEG_SM'])
+
+
+class TestFSStorageSidecars(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_content = FilePath(self.mktemp())
+        movies = self.tmp_content.child('movies')
+        movies.makedirs()
+        movies.child('poster.png').touch()
+        movies.child('folder.jpg').touch()
+        movies.child('movie.mp4').touch()
+        movies.child('movie.srt').setContent('1\n')
+        movies.child('.thumbs').makedirs()
+        movies.child('.thumbs').child('movie.jpg').setContent('thumb')
+        self.listed = []
+        listdir = os.listdir
+
+        def counting(path):
+            self.listed.append(path)
+            return listdir(path)
+        self.patch(os, 'listdir', counting)
+        self.storage = fs_storage.FSStore(None, name='my media',
+                                          content=self.tmp_content.path,
+                                          urlbase='http://fsstore-host/xyz',
+                                          enable_inotify=False)
+
+    def tearDown(self):
+        self.tmp_content.remove()
+
+    def test_listed_once(self):
+        movies = self.tmp_content.child('movies')
+        self.assertEqual(sorted(self.listed),
+                         sorted([self.tmp_content.path, movies.path,
+                                 movies.child('.thumbs').path]))
+
+    def test_sidecars(self):
+        movies = self.tmp_content.child('movies')
+        folder = self.storage.get_by_id('1001')
+        self.assertEqual(folder.cover, movies.child('folder.jpg').path)
+        self.assertEqual(folder.item.albumArtURI, 'http://fsstore-host/xyz/1001?cover.jpg')
+        movie = [c for c in folder.get_children() if c.get_name() == 'movie.mp4'][0]
+        protocols = [res.protocolInfo for res in movie.item.res]
+        self.assertIn('http-get:*:smi/caption:*', protocols)
+        self.assertTrue([p for p in protocols if 'DLNA.ORG_PN=JPEG_TN' in p])
+
+    def test_invalidate(self):
+        movies = self.tmp_content.child('movies')
+        folder = self.storage.get_by_id('1001')
+        movies.child('folder.jpg').remove()
+        self.storage.sidecars.invalidate(movies.path)
+        folder.check_for_cover_art()
+        self.assertEqual(folder.cover, movies.child('poster.png').path)
+        self.assertEqual(folder.item.albumArtURI, 'http://fsstore-host/xyz/1001?cover.png')
+
+    def test_changed_without_inotify(self):
+        movies = self.tmp_content.child('movies')
+        thumbs = movies.child('.thumbs')
+        self.assertRaises(fs_storage.NoThumbnailFound,
+                          self.storage.sidecars.thumbnail, movies.child('other.mp4').path)
+        thumbs.child('other.png').setContent('thumb')
+        os.utime(thumbs.path, (0, 0))
+        filename, mimetype, dlna_pn = self.storage.sidecars.thumbnail(
+            movies.child('other.mp4').path)
+        self.assertEqual(filename, thumbs.child('other.png').path)
+        self.assertEqual(mimetype, 'image/png')
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{backend}
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from coherence import backend
+
+
+class Station(backend.BackendItem):
+
+    def __init__(self, title, url):
+        backend.BackendItem.__init__(self)
+        self.name = title
+        self.stream_url = url
+
+    def get_cache_data(self):
+        return (self.name, self.stream_url), {}
+
+
+class Retriever(object):
+    """ adds the children it was given when told to """
+
+    def __init__(self):
+        self.calls = []
+        self.names = ['a', 'b']
+
+    def __call__(self, parent=None, **kwargs):
+        d = defer.Deferred()
+        self.calls.append(d)
+        return d
+
+    def complete(self, container, fail=False):
+        d = self.calls.pop(0)
+        if fail:
+            d.errback(IOError('unreachable'))
+            return
+        for name in self.names:
+            container.add_child(backend.BackendItem(), external_id=name)
+        d.callback(None)
+
+
+class TestLazyContainer(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = [1000.0]
+        self.patch(backend.time, 'time', lambda: self.clock[0])
+        self.store = backend.AbstractBackendStore(None)
+        self.retriever = Retriever()
+        self.container = backend.LazyContainer(None, 'lazy', refresh=60,
+                                               childrenRetriever=self.retriever)
+        self.store.set_root_item(self.container)
+
+    def external_ids(self, children):
+        return sorted(child.external_id for child in children)
+
+    def test_single_flight(self):
+        results = []
+        self.container.get_children().addCallback(results.append)
+        self.container.get_children().addCallback(results.append)
+        self.assertEqual(len(self.retriever.calls), 1)
+        self.retriever.complete(self.container)
+        self.assertEqual([self.external_ids(r) for r in results], [['a', 'b'], ['a', 'b']])
+        # fresh, no retrieval
+        self.assertEqual(self.external_ids(self.container.get_children()), ['a', 'b'])
+        self.assertEqual(self.retriever.calls, [])
+
+    def test_stale_while_revalidate(self):
+        self.container.get_children()
+        self.retriever.complete(self.container)
+        self.clock[0] += 61
+        self.retriever.names = ['a', 'c']
+        # the previous children, while refreshing once in the background
+        self.assertEqual(self.external_ids(self.container.get_children()), ['a', 'b'])
+        self.assertEqual(self.external_ids(self.container.get_children()), ['a', 'b'])
+        self.assertEqual(len(self.retriever.calls), 1)
+        self.retriever.complete(self.container)
+        self.assertEqual(self.external_ids(self.container.get_children()), ['a', 'c'])
+
+    def test_backoff(self):
+        self.container.get_children()
+        self.retriever.complete(self.container, fail=True)
+        self.assertEqual(self.container.get_children(), [])
+        self.assertEqual(self.retriever.calls, [])
+        self.clock[0] += self.container.retry_backoff
+        d = self.container.get_children()
+        self.retriever.complete(self.container, fail=True)
+        # the second failure waits twice as long
+        self.clock[0] += self.container.retry_backoff
+        self.container.get_children()
+        self.assertEqual(self.retriever.calls, [])
+        self.clock[0] += self.container.retry_backoff
+        d = self.container.get_children()
+        self.retriever.complete(self.container)
+        d.addCallback(lambda children: self.assertEqual(self.external_ids(children),
+                                                        ['a', 'b']))
+        self.assertEqual(self.container.retry_at, 0)
+        return d
+
+    def test_failing_update(self):
+        def cache_children():
+            raise RuntimeError('broken child')
+        self.patch(self.container, 'cache_children', cache_children)
+        results = []
+        self.container.get_children().addCallback(results.append)
+        self.container.get_children().addCallback(results.append)
+        self.retriever.complete(self.container)
+        self.assertEqual([self.external_ids(r) for r in results], [['a', 'b'], ['a', 'b']])
+        self.assertIdentical(self.container.childrenRetrievingDeferred, None)
+        self.assertEqual(self.container.retrieval_failures, 1)
+        # tried again after the backoff
+        self.clock[0] += self.container.retry_backoff
+        self.container.get_children()
+        self.assertEqual(len(self.retriever.calls), 1)
+
+
+class PagedRetriever(object):
+    """ a listing of total items, in pages of per_page """
+
+    def __init__(self, total):
+        self.total = total
+        self.calls = {}
+
+    def __call__(self, parent=None, per_page=0, page=0, offset=0):
+        d = defer.Deferred()
+
+        def got_page(result):
+            for i in range(offset, min(offset + per_page, self.total)):
+                parent.add_child(backend.BackendItem(), external_id=i)
+            if offset + per_page < self.total:
+                parent.childrenRetrievingNeeded = True
+        d.addCallback(got_page)
+        self.calls[page] = (offset, d)
+        return d
+
+    def complete(self, page):
+        offset, d = self.calls.pop(page)
+        d.callback(None)
+
+
+class TestPagedRetrieval(unittest.TestCase):
+
+    def setUp(self):
+        self.store = backend.AbstractBackendStore(None, prefetch_pages=2, max_page_requests=2)
+        self.retriever = PagedRetriever(7)
+        self.container = backend.LazyContainer(None, 'paged', childrenRetriever=self.retriever,
+                                               per_page=2)
+        self.store.set_root_item(self.container)
+
+    def test_prefetch(self):
+        first = []
+        self.container.get_children(0, 2).addCallback(first.append)
+        everything = []
+        self.container.get_children().addCallback(everything.append)
+        self.assertEqual(self.retriever.calls.keys(), [0])
+        self.retriever.complete(0)
+        # the first page answers the first Browse
+        self.assertEqual([c.external_id for c in first[0]], [0, 1])
+        # the next pages ahead, but no more than max_page_requests at once
+        self.assertEqual(sorted(self.retriever.calls.keys()), [1, 2])
+        self.assertEqual(self.retriever.calls[2][0], 4)
+        self.retriever.complete(2)
+        self.assertEqual(sorted(self.retriever.calls.keys()), [1, 3])
+        self.retriever.complete(1)
+        self.retriever.complete(3)
+        # page 3 is the last, the pages asked ahead are waited for
+        self.assertEqual(sorted(self.retriever.calls.keys()), [4, 5])
+        self.assertEqual(everything, [])
+        self.retriever.complete(4)
+        self.retriever.complete(5)
+        self.assertEqual(self.retriever.calls, {})
+        self.assertEqual(sorted(c.external_id for c in everything[0]), range(7))
+
+    def test_failed_page(self):
+        results = []
+        self.container.get_children().addCallback(results.append)
+        self.retriever.complete(0)
+        self.retriever.calls[1][1].errback(IOError('unreachable'))
+        self.retriever.complete(2)
+        self.retriever.complete(3)
+        self.assertEqual(sorted(c.external_id for c in results[0]), [0, 1, 4, 5, 6])
+        self.assertFalse(self.container.children_retrieved)
+        self.assertTrue(self.container.retry_at > 0)
+
+
+class TestChildrenCache(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(backend.ChildrenCache, 'directory', self.mktemp())
+        self.retriever = Retriever()
+
+    def start(self):
+        store = backend.AbstractBackendStore(None, children_cache='yes', uuid='uuid:test')
+        container = backend.LazyContainer(None, 'lazy', childrenRetriever=self.retriever)
+        container.cache_key = 'stations'
+        store.set_root_item(container)
+        return store, container
+
+    def test_restored(self):
+        store, container = self.start()
+        container.get_children()
+        d = self.retriever.calls.pop(0)
+        for name in ['a', 'b']:
+            container.add_child(Station(name, 'http://%s/' % name), external_id=name)
+        d.callback(None)
+        store.children_cache.save()
+
+        store, container = self.start()
+        children = container.get_children()
+        # served from the cache while the network is asked again
+        self.assertEqual([(c.__class__, c.name, c.stream_url) for c in children],
+                         [(Station, 'a', 'http://a/'), (Station, 'b', 'http://b/')])
+        self.assertEqual(container.get_child_count(), 2)
+        self.assertEqual(len(self.retriever.calls), 1)
+        self.retriever.names = ['c']
+        self.retriever.complete(container)
+        self.assertEqual(self.external_ids(container.get_children()), ['c'])
+
+    def test_not_cacheable(self):
+        store, container = self.start()
+        container.get_children()
+        self.retriever.complete(container)
+        store.children_cache.save()
+        store, container = self.start()
+        self.assertEqual(store.children_cache.get('stations'), None)
+        self.assertEqual(container.get_child_count(), 0)
+
+    def external_ids(self, children):
+        return sorted(child.external_id for child in children)
@@ -1,4 +1,6 @@
 
+import time
+
 from twisted.trial import unittest
 from twisted.internet import defer
 from coherence.dispatcher import Dispatcher, UnknownSignal, Receiver, \
@@ -86,6 +88,66 @@ class TestDispatching(unittest.TestCase):
         dfr.addCallback(test, 2)
         return dfr
 
+    def test_save_emit_without_receivers(self):
+        from twisted.internet import reactor
+        calls = len(reactor.getDelayedCalls())
+        results = []
+        self.dispatcher.save_emit('test').addCallback(results.append)
+        self.assertEquals(results, [[]])
+        self.assertEquals(len(reactor.getDelayedCalls()), calls)
+
+    def test_save_emit_batched(self):
+        from twisted.internet import reactor
+        self.dispatcher.connect('test', self.target.plus, variable='called')
+        calls = len(reactor.getDelayedCalls())
+        dfrs = [self.dispatcher.save_emit('test', plus) for plus in (1, 2, 3)]
+        self.assertEquals(self.target.called, 0)
+        self.assertEquals(len(reactor.getDelayedCalls()), calls + 1)
+        dfr = defer.gatherResults(dfrs)
+        dfr.addCallback(lambda _: self.assertEquals(self.target.called, 6))
+        return dfr
+
+    def test_priority(self):
+        calls = []
+        self.dispatcher.connect('test', calls.append, 'b')
+        self.dispatcher.connect_priority('test', 10, calls.append, 'c')
+        self.dispatcher.connect_priority('test', -10, calls.append, 'a')
+        self.dispatcher.connect('test', calls.append, 'b2')
+        self.dispatcher.emit('test')
+        self.assertEquals(calls, ['a', 'b', 'b2', 'c'])
+
+    def test_timings(self):
+        slow = self.dispatcher.connect('test', time.sleep, 0.01)
+        fast = self.dispatcher.connect('test', self.target.callback)
+        self.dispatcher.emit('test')
+        self.dispatcher.emit('test')
+        self.assertEquals(self.dispatcher.timings(), [slow, fast])
+        self.assertEquals(slow.calls, 2)
+        self.assertTrue(slow.max_time >= 0.01)
+
+    def test_cooperative_emit(self):
+        self.dispatcher.emit_budget = 0
+        self.dispatcher.connect('test', self.target.plus, variable='called')
+        self.dispatcher.connect('test', self.target.plus, variable='called')
+        dfr = self.dispatcher.cooperative_emit('test', 1)
+        self.assertEquals(self.target.called, 0)
+
+        def check(result):
+            self.assertEquals(self.target.called, 2)
+            self.assertEquals([r for _, (ok, r) in result], [None, None])
+        dfr.addCallback(check)
+        return dfr
+
+    def test_cooperative_save_emit(self):
+        self.dispatcher.cooperative = True
+        calls = []
+        self.dispatcher.connect('test', calls.append)
+        self.dispatcher.connect('test', lambda value: calls.append(value.upper()))
+        dfrs = [self.dispatcher.save_emit('test', value) for value in ('a', 'b')]
+        dfr = defer.gatherResults(dfrs)
+        dfr.addCallback(lambda _: self.assertEquals(calls, ['a', 'A', 'b', 'B']))
+        return dfr
+
     def test_connect_typo(self):
         self.assertRaises(UnknownSignal, self.dispatcher.connect, 'Test', None)
 
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{log}
+"""
+
+import logging
+
+from twisted.trial import unittest
+
+from coherence import log
+
+
+class Records(logging.Handler):
+
+    def __init__(self, fmt):
+        logging.Handler.__init__(self)
+        self.setFormatter(logging.Formatter(fmt))
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class Thing(log.Loggable):
+    logCategory = 'test_log'
+
+
+class TestLoggable(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger('test_log')
+        self.logger.propagate = False
+        self.handler = Records('%(levelname)s %(message)s')
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.WARNING)
+        self.thing = Thing()
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(logging.NOTSET)
+        self.logger.propagate = True
+
+    def test_level_change(self):
+        self.assertFalse(self.thing.isEnabledFor(log.INFO))
+        self.thing.info('not %s', 'logged')
+        self.logger.setLevel(logging.INFO)
+        self.assertTrue(self.thing.isEnabledFor(log.INFO))
+        self.thing.info('logged %s', 'now')
+        self.assertEqual([r.getMessage() for r in self.handler.records], ['logged now'])
+
+    def test_root_level_change(self):
+        self.logger.setLevel(logging.NOTSET)
+        level = logging.root.level
+        self.addCleanup(logging.root.setLevel, level)
+        logging.root.setLevel(logging.ERROR)
+        self.assertFalse(self.thing.isEnabledFor(log.WARNING))
+        logging.root.setLevel(logging.DEBUG)
+        self.assertTrue(self.thing.isEnabledFor(log.DEBUG))
+
+    def test_caller_skipped(self):
+        self.thing.warning('no caller')
+        self.assertEqual(self.handler.records[-1].lineno, 0)
+
+    def test_caller_formatted(self):
+        self.thing.warning('no caller')
+        self.handler.setFormatter(logging.Formatter('%(message)s (%(filename)s:%(lineno)s)'))
+        self.thing.warning('caller')
+        record = self.handler.records[-1]
+        self.assertEqual(record.filename, 'test_log.py')
+        self.assertNotEqual(record.lineno, 0)
+
+    def test_caller_formatted_by_parent(self):
+        self.thing.warning('no caller')
+        parent = Records('%(message)s (%(lineno)s)')
+        logging.root.addHandler(parent)
+        self.addCleanup(logging.root.removeHandler, parent)
+        self.logger.propagate = True
+        self.thing.warning('caller')
+        self.assertNotEqual(self.handler.records[-1].lineno, 0)
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{proxy_cache}
+"""
+
+from twisted.trial import unittest
+from twisted.python.filepath import FilePath
+from twisted.internet import reactor, defer, task
+from twisted.web import server, resource, static
+from twisted.web.client import Agent, readBody
+from twisted.web.http_headers import Headers
+
+from coherence import proxy_cache
+from coherence.upnp.core import upstream
+
+MEDIA = 'abcdefghijklmnopqrstuvwxyz0123456789'
+
+
+class CountingFile(static.File):
+
+    requests = 0
+
+    def render_GET(self, request):
+        CountingFile.requests += 1
+        return static.File.render_GET(self, request)
+
+
+class Root(resource.Resource):
+    """ proxies its children through the cache of the test """
+
+    def __init__(self, test):
+        resource.Resource.__init__(self)
+        self.test = test
+
+    def getChild(self, name, request):
+        url = 'http://127.0.0.1:%d/%s' % (self.test.upstream_port.getHost().port, name)
+        return self.test.cache.resource(url, mimetype='video/mp4')
+
+
+class TestProxyCache(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(proxy_cache, 'CHUNK_SIZE', 4)
+        self.pool = upstream.UpstreamPool()
+        self.patch(upstream, 'pool', self.pool)
+        self.patch(CountingFile, 'requests', 0)
+        media = FilePath(self.mktemp())
+        media.setContent(MEDIA)
+        files = resource.Resource()
+        files.putChild('media', CountingFile(media.path))
+        files.putChild('other', CountingFile(media.path))
+        self.upstream_port = reactor.listenTCP(0, server.Site(files, timeout=None),
+                                               interface="127.0.0.1")
+        self.directory = self.mktemp()
+        self.cache = self.new_cache()
+        self.port = reactor.listenTCP(0, server.Site(Root(self), timeout=None),
+                                      interface="127.0.0.1")
+
+    def new_cache(self):
+        cache = proxy_cache.ProxyCache()
+        cache.directory = self.directory
+        return cache
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        self.cache.save()
+        # connections go back to the pool after the body is delivered
+        yield task.deferLater(reactor, 0, lambda: None)
+        yield self.pool.shutdown()
+        yield self.port.stopListening()
+        yield self.upstream_port.stopListening()
+
+    @defer.inlineCallbacks
+    def fetch(self, path='media', range=None):
+        headers = Headers()
+        if range is not None:
+            headers.setRawHeaders('range', [range])
+        url = "http://127.0.0.1:%d/%s" % (self.port.getHost().port, path)
+        response = yield Agent(reactor).request('GET', url, headers)
+        body = yield readBody(response)
+        defer.returnValue((response, body))
+
+    def entry(self, name='media'):
+        for entry in self.cache.entries.values():
+            if entry.key.endswith('/' + name):
+                return entry
+
+    @defer.inlineCallbacks
+    def test_fetch(self):
+        response, body = yield self.fetch()
+        self.assertEqual(body, MEDIA)
+        self.assertEqual(response.headers.getRawHeaders('content-type'), ['video/mp4'])
+        entry = self.entry()
+        self.assertTrue(entry.complete)
+        self.assertEqual(self.cache.size, len(MEDIA))
+        response, body = yield self.fetch()
+        self.assertEqual(body, MEDIA)
+        self.assertEqual(CountingFile.requests, 1)
+
+    @defer.inlineCallbacks
+    def test_coalesced(self):
+        results = yield defer.gatherResults([self.fetch(), self.fetch()])
+        self.assertEqual([body for _, body in results], [MEDIA, MEDIA])
+        self.assertEqual(CountingFile.requests, 1)
+
+    @defer.inlineCallbacks
+    def test_range_ahead(self):
+        response, body = yield self.fetch(range='bytes=20-23')
+        self.assertEqual(response.code, 206)
+        self.assertEqual(body, MEDIA[20:24])
+        self.assertEqual(response.headers.getRawHeaders('content-range'),
+                         ['bytes 20-23/%d' % len(MEDIA)])
+        # the download from 20 on ran to the end
+        while self.entry().downloads:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(sorted(self.entry().chunks), range(5, 9))
+        response, body = yield self.fetch()
+        self.assertEqual(body, MEDIA)
+        self.assertEqual(CountingFile.requests, 2)
+        self.assertEqual(self.cache.size, len(MEDIA))
+
+    @defer.inlineCallbacks
+    def test_index_persisted(self):
+        yield self.fetch(range='bytes=0-3')
+        while self.entry().downloads:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.cache.save()
+        self.cache = self.new_cache()
+        self.cache._prepare()
+        self.assertTrue(self.entry().complete)
+        self.assertEqual(self.cache.size, len(MEDIA))
+        response, body = yield self.fetch(range='bytes=8-11')
+        self.assertEqual(body, MEDIA[8:12])
+        self.assertEqual(CountingFile.requests, 1)
+
+    def test_unknown_files(self):
+        directory = FilePath(self.directory)
+        directory.makedirs()
+        directory.child('a' * 40).setContent('stale')
+        directory.child('video.mp4').setContent('not ours')
+        cache = self.new_cache()
+        cache._prepare()
+        self.assertFalse(directory.child('a' * 40).exists())
+        self.assertTrue(directory.child('video.mp4').exists())
+
+    @defer.inlineCallbacks
+    def test_evict(self):
+        self.cache.maxsize = len(MEDIA) + 10
+        yield self.fetch('media')
+        yield self.fetch('other')
+        yield task.deferLater(reactor, 0, lambda: None)
+        self.assertIdentical(self.entry('media'), None)
+        self.assertTrue(self.entry('other').complete)
+        self.assertEqual(self.cache.size, len(MEDIA))
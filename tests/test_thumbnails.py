@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{thumbnails}
+"""
+
+import os
+
+from twisted.trial import unittest
+from twisted.python.filepath import FilePath
+from twisted.internet import reactor, defer, task
+from twisted.web import server, resource
+from twisted.web.client import Agent, readBody
+
+from coherence import thumbnails
+
+
+class FakeRenderer(object):
+    """ renders when told to """
+
+    def __init__(self):
+        self.jobs = []
+
+    def __call__(self, source, path, profile):
+        d = defer.Deferred()
+        self.jobs.append((source, path, profile, d))
+        return d
+
+    def complete(self, index=0, fail=False):
+        source, path, profile, d = self.jobs.pop(index)
+        if fail:
+            d.errback(thumbnails.ThumbnailFailed(source))
+            return
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        FilePath(path).setContent('%s of %s' % (profile, source))
+        d.callback(path)
+
+
+class TestThumbnailService(unittest.TestCase):
+
+    def setUp(self):
+        self.service = thumbnails.ThumbnailService()
+        self.service.directory = self.mktemp()
+        self.service.workers = 1
+        self.renderer = self.service.render = FakeRenderer()
+
+    def test_rendition_by_mtime(self):
+        first = self.service.rendition('/photo.jpg', 1.0, 'JPEG_TN')
+        self.assertTrue(first.startswith(self.service.directory))
+        self.assertTrue(first.endswith('.jpg'))
+        self.assertNotEqual(first, self.service.rendition('/photo.jpg', 2.0, 'JPEG_TN'))
+        self.assertNotEqual(first, self.service.rendition('/photo.jpg', 1.0, 'JPEG_SM'))
+
+    def test_rendition_unicode(self):
+        self.patch(thumbnails.sys, 'getfilesystemencoding', lambda: 'utf-8')
+        self.assertEqual(self.service.rendition(u'/m\xf6we.jpg', 1.0, 'JPEG_TN'),
+                         self.service.rendition('/m\xc3\xb6we.jpg', 1.0, 'JPEG_TN'))
+
+    def test_generate(self):
+        results = []
+        self.service.generate('/photo.jpg', 1.0, 'JPEG_TN').addCallback(results.append)
+        # asked twice, rendered once
+        self.service.generate('/photo.jpg', 1.0, 'JPEG_TN').addCallback(results.append)
+        self.assertEqual(len(self.renderer.jobs), 1)
+        self.renderer.complete()
+        path = self.service.rendition('/photo.jpg', 1.0, 'JPEG_TN')
+        self.assertEqual(results, [path, path])
+        self.assertEqual(self.service.cached('/photo.jpg', 1.0, 'JPEG_TN'),
+                         (path, len('JPEG_TN of /photo.jpg')))
+        return self.service.generate('/photo.jpg', 1.0, 'JPEG_TN').addCallback(
+            self.assertEqual, path)
+
+    def test_client_before_background(self):
+        self.service.prefetch('/a.jpg', 1.0, 'image/jpeg')
+        self.service.prefetch('/b.jpg', 1.0, 'image/jpeg')
+        self.service.generate('/c.jpg', 1.0, 'JPEG_SM')
+        self.service.generate('/b.jpg', 1.0, 'JPEG_SM')
+        order = []
+        while self.renderer.jobs:
+            order.append(self.renderer.jobs[0][:3:2])
+            self.renderer.complete()
+        self.assertEqual(order, [('/a.jpg', 'JPEG_TN'), ('/c.jpg', 'JPEG_SM'),
+                                 ('/b.jpg', 'JPEG_SM'), ('/a.jpg', 'JPEG_SM'),
+                                 ('/b.jpg', 'JPEG_TN')])
+
+    def test_cache_listed_once(self):
+        path = self.service.rendition('/photo.jpg', 1.0, 'JPEG_TN')
+        os.makedirs(os.path.dirname(path))
+        FilePath(path).setContent('from a former run')
+        self.assertEqual(self.service.cached('/photo.jpg', 1.0, 'JPEG_TN'), (path, None))
+        self.assertEqual(self.service.cached('/photo.jpg', 1.0, 'JPEG_SM'), None)
+        # not looked for on the disk again
+        os.unlink(path)
+        self.assertEqual(self.service.cached('/photo.jpg', 1.0, 'JPEG_TN'), (path, None))
+
+    def test_failed_not_tried_again(self):
+        d = self.service.generate('/broken.jpg', 1.0, 'JPEG_TN')
+        self.renderer.complete(fail=True)
+        self.assertFailure(d, thumbnails.ThumbnailFailed)
+        again = self.service.generate('/broken.jpg', 1.0, 'JPEG_TN')
+        self.assertEqual(self.renderer.jobs, [])
+        self.assertEqual(self.service.running, 0)
+        return self.assertFailure(again, thumbnails.ThumbnailFailed)
+
+    def test_failed_bounded(self):
+        self.service.max_failed = 2
+        for name in ('/a.jpg', '/b.jpg', '/c.jpg'):
+            self.assertFailure(self.service.generate(name, 1.0, 'JPEG_TN'),
+                               thumbnails.ThumbnailFailed)
+            self.renderer.complete(fail=True)
+        self.assertEqual(self.service.failed.keys(),
+                         [self.service.rendition(name, 1.0, 'JPEG_TN')
+                          for name in ('/b.jpg', '/c.jpg')])
+
+
+class TestWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.service = thumbnails.ThumbnailService()
+        self.service.directory = self.mktemp()
+        self.service.workers = 1
+
+    def tearDown(self):
+        ended = [defer.Deferred() for worker in self.service.pool]
+        for worker, d in zip(self.service.pool, ended):
+            worker.processEnded = lambda reason, d=d: d.callback(None)
+        self.service.shutdown()
+        return defer.DeferredList(ended)
+
+    @defer.inlineCallbacks
+    def test_pool(self):
+        source = FilePath(self.mktemp())
+        source.setContent('not an image')
+        first = self.service.generate(source.path, 1.0, 'JPEG_TN')
+        second = self.service.generate(source.path, 1.0, 'JPEG_SM')
+        # one worker renders both
+        yield self.assertFailure(first, thumbnails.ThumbnailFailed)
+        yield self.assertFailure(second, thumbnails.ThumbnailFailed)
+        self.assertEqual(len(self.service.pool), 1)
+        self.assertEqual(self.service.idle, self.service.pool)
+
+    @defer.inlineCallbacks
+    def test_stopped_not_reused(self):
+        source = FilePath(self.mktemp())
+        source.setContent('not an image')
+        yield self.assertFailure(self.service.generate(source.path, 1.0, 'JPEG_TN'),
+                                 thumbnails.ThumbnailFailed)
+        stopped, = self.service.idle
+        # the idle timeout
+        stopped.stop_call.cancel()
+        stopped.stop()
+        self.assertEqual(self.service.idle, [])
+        d = self.service.generate(source.path, 1.0, 'JPEG_SM')
+        self.assertIdentical(stopped.job, None)
+        yield self.assertFailure(d, thumbnails.ThumbnailFailed)
+
+
+class TestThumbnailResource(unittest.TestCase):
+
+    def setUp(self):
+        self.service = thumbnails.ThumbnailService()
+        self.service.directory = self.mktemp()
+        self.renderer = self.service.render = FakeRenderer()
+        self.source = FilePath(self.mktemp())
+        self.source.setContent('a photo')
+        mtime = os.stat(self.source.path).st_mtime
+        root = resource.Resource()
+        root.putChild('thumb', thumbnails.ThumbnailResource(
+            self.service, self.source.path, mtime, 'JPEG_TN'))
+        root.putChild('missing', thumbnails.ThumbnailResource(
+            self.service, '/missing.jpg', 1.0, 'JPEG_TN'))
+        self.port = reactor.listenTCP(0, server.Site(root, timeout=None),
+                                      interface="127.0.0.1")
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    def fetch(self, path):
+        url = "http://127.0.0.1:%d/%s" % (self.port.getHost().port, path)
+        d = Agent(reactor).request('GET', url)
+        d.addCallback(lambda response: readBody(response).addCallback(
+            lambda body: (body, response)))
+        return d
+
+    @defer.inlineCallbacks
+    def test_rendered_on_request(self):
+        d = self.fetch('thumb')
+        while not self.renderer.jobs:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.renderer.complete()
+        body, response = yield d
+        self.assertEqual(response.code, 200)
+        self.assertEqual(body, 'JPEG_TN of %s' % self.source.path)
+        self.assertEqual(response.headers.getRawHeaders('content-type'), ['image/jpeg'])
+
+    @defer.inlineCallbacks
+    def test_failed(self):
+        d = self.fetch('missing')
+        while not self.renderer.jobs:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.renderer.complete(fail=True)
+        body, response = yield d
+        self.assertEqual(response.code, 404)
+
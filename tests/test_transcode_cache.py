@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{transcode_cache}
+"""
+
+import os
+
+from twisted.trial import unittest
+from twisted.python.filepath import FilePath
+from twisted.internet import reactor, defer, task
+from twisted.web import server, resource
+from twisted.web.client import Agent, readBody
+from twisted.web.http_headers import Headers
+
+from coherence import transcode_cache, transcode_pool
+from coherence.upnp.core import streaming
+
+CONTENT = ''.join(chr(i % 251) for i in range(100000))
+
+
+class FakeTranscoder(object):
+    """ writes what it is told to, keeps track of its instances """
+
+    contentType = 'video/mpeg'
+    instances = []
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.writer = None
+        self.instances.append(self)
+
+    def start(self, writer):
+        self.writer = writer
+
+    def produce(self, data):
+        self.writer.write(data)
+        return deferLater()
+
+    def finish(self):
+        self.writer.finish()
+        return deferLater()
+
+
+class ThumbTranscoder(FakeTranscoder):
+    cacheable = False
+
+
+def deferLater():
+    # the writer tells the readers from the next reactor iteration
+    return task.deferLater(reactor, 0, lambda: None)
+
+
+class TestTranscodeCache(unittest.TestCase):
+
+    def setUp(self):
+        FakeTranscoder.instances = []
+        self.patch(transcode_cache, 'pool', transcode_pool.TranscoderPool())
+        transcode_cache.pool.max_running = 10
+        name = self.mktemp()
+        os.mkdir(name)
+        self.source = FilePath(name).child('source')
+        self.source.setContent('original')
+        self.cache = transcode_cache.TranscodeCache(FilePath(name).child('cache').path, 10 ** 6)
+        self.resources = {}
+        root = resource.Resource()
+        root.getChild = lambda path, request: self.resources[path]
+        self.site = server.Site(root, timeout=None)
+        self.port = reactor.listenTCP(0, self.site, interface="127.0.0.1")
+        self.portno = self.port.getHost().port
+
+    def tearDown(self):
+        self.cache.shutdown()
+        streaming.open_files.clear()
+        return self.port.stopListening()
+
+    def resource(self, name='mpeg', transcoder=FakeTranscoder):
+        transcoded = self.cache.resource(self.source.path, name, transcoder)
+        self.resources[name] = transcoded
+        return transcoded
+
+    def fetch(self, path, **headers):
+        headers = Headers(dict((k, [v]) for k, v in headers.items()))
+        url = "http://127.0.0.1:%d/%s" % (self.portno, path)
+        d = Agent(reactor).request('GET', url, headers)
+
+        def got_response(response):
+            d = readBody(response)
+            d.addCallback(lambda body: (body, response))
+            return d
+        d.addCallback(got_response)
+        return d
+
+    @defer.inlineCallbacks
+    def test_following_transcoder(self):
+        self.resource()
+        transcoder, = FakeTranscoder.instances
+        yield transcoder.produce(CONTENT[:50000])
+        d = self.fetch('mpeg')
+        yield deferLater()
+        yield transcoder.produce(CONTENT[50000:])
+        yield transcoder.finish()
+        body, response = yield d
+        self.assertEqual(response.code, 200)
+        self.assertEqual(body, CONTENT)
+        self.assertEqual(response.headers.getRawHeaders('content-type'), ['video/mpeg'])
+
+    @defer.inlineCallbacks
+    def test_range_while_transcoding(self):
+        self.resource()
+        transcoder, = FakeTranscoder.instances
+        yield transcoder.produce(CONTENT[:50000])
+        body, response = yield self.fetch('mpeg', range='bytes=1000-')
+        self.assertEqual(response.code, 206)
+        self.assertEqual(body, CONTENT[1000:50000])
+        self.assertEqual(response.headers.getRawHeaders('content-range'),
+                         ['bytes 1000-49999/*'])
+
+    @defer.inlineCallbacks
+    def test_range_waits_for_data(self):
+        self.resource()
+        transcoder, = FakeTranscoder.instances
+        d = self.fetch('mpeg', range='bytes=60000-60999')
+        yield transcoder.produce(CONTENT[:50000])
+        self.assertFalse(d.called)
+        yield transcoder.produce(CONTENT[50000:])
+        body, response = yield d
+        self.assertEqual(response.code, 206)
+        self.assertEqual(body, CONTENT[60000:61000])
+
+    @defer.inlineCallbacks
+    def test_complete(self):
+        self.resource()
+        transcoder, = FakeTranscoder.instances
+        yield transcoder.produce(CONTENT)
+        yield transcoder.finish()
+        self.resource()
+        # no second transcoder
+        self.assertEqual(len(FakeTranscoder.instances), 1)
+        body, response = yield self.fetch('mpeg', range='bytes=1000-1999')
+        self.assertEqual(response.code, 206)
+        self.assertEqual(body, CONTENT[1000:2000])
+        self.assertEqual(response.headers.getRawHeaders('content-range'),
+                         ['bytes 1000-1999/%d' % len(CONTENT)])
+        self.assertEqual(response.headers.getRawHeaders('content-type'), ['video/mpeg'])
+
+    @defer.inlineCallbacks
+    def test_modified_source(self):
+        self.resource()
+        yield FakeTranscoder.instances[0].finish()
+        os.utime(self.source.path, (0, 0))
+        self.resource()
+        self.assertEqual(len(FakeTranscoder.instances), 2)
+        self.assertEqual(len(self.cache.entries), 2)
+
+    def test_not_cacheable(self):
+        self.assertIdentical(self.resource(transcoder=ThumbTranscoder), None)
+        self.assertIdentical(
+            self.cache.resource('http://example.com/video', 'mpeg', FakeTranscoder), None)
+        self.assertEqual(FakeTranscoder.instances, [])
+
+    @defer.inlineCallbacks
+    def test_eviction(self):
+        self.cache.maxsize = 150000
+        for name in ('mpeg', 'ogg'):
+            self.resource(name)
+            yield FakeTranscoder.instances[-1].produce(CONTENT)
+            yield FakeTranscoder.instances[-1].finish()
+        # evicted in the next iteration
+        yield deferLater()
+        # the least recently used one went
+        self.assertEqual([key[2] for key in self.cache.entries], ['ogg'])
+
+    @defer.inlineCallbacks
+    def test_former_files(self):
+        directory = FilePath(self.cache.directory)
+        directory.makedirs()
+        directory.child('transcode-%s.mpeg' % ('0' * 40)).setContent('former')
+        directory.child('holiday.avi').setContent('not ours')
+        self.resource()
+        # removed in a thread
+        yield self.cache.cleaning
+        self.assertFalse(directory.child('transcode-%s.mpeg' % ('0' * 40)).exists())
+        self.assertTrue(directory.child('holiday.avi').exists())
+
+    @defer.inlineCallbacks
+    def test_failed(self):
+        transcoded = self.resource()
+        transcoder, = FakeTranscoder.instances
+        yield transcoder.produce(CONTENT[:1000])
+        transcoder.writer.abort()
+        yield deferLater()
+        self.assertEqual(self.cache.entries, {})
+        self.assertTrue(transcoded.entry.failed)
+        # tried again
+        self.resource()
+        self.assertEqual(len(FakeTranscoder.instances), 2)
+
+    @defer.inlineCallbacks
+    def test_abandoned(self):
+        transcode_cache.pool.max_running = 2
+        clock = self.cache.reactor = task.Clock()
+        for name in ('mpeg', 'ogg'):
+            self.resource(name)
+            yield FakeTranscoder.instances[-1].produce(CONTENT[:1000])
+            body, response = yield self.fetch(name, range='bytes=0-99')
+            self.assertEqual(body, CONTENT[:100])
+        # both slots are taken, the next one waits
+        self.resource('avi')
+        self.assertIdentical(FakeTranscoder.instances[2].writer, None)
+        clock.advance(self.cache.abandon_timeout)
+        self.assertTrue(FakeTranscoder.instances[2].writer is not None)
+        self.assertEqual([key[2] for key in self.cache.entries], ['avi'])
+
+    @defer.inlineCallbacks
+    def test_reader_returns(self):
+        clock = self.cache.reactor = task.Clock()
+        self.resource()
+        transcoder, = FakeTranscoder.instances
+        yield transcoder.produce(CONTENT[:1000])
+        yield self.fetch('mpeg', range='bytes=0-99')
+        clock.advance(self.cache.abandon_timeout - 1)
+        body, response = yield self.fetch('mpeg', range='bytes=100-199')
+        self.assertEqual(body, CONTENT[100:200])
+        clock.advance(1)
+        self.assertFalse(transcoder.writer.finished)
+        clock.advance(self.cache.abandon_timeout)
+        self.assertTrue(transcoder.writer.finished)
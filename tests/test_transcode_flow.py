@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{transcode_flow}
+"""
+
+from twisted.trial import unittest
+from twisted.internet import threads
+from twisted.web.test.requesthelper import DummyRequest
+
+from coherence.transcode_flow import FlowControl
+
+
+class Request(DummyRequest):
+    """ takes push producers """
+    producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+class Source(object):
+
+    paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class TestFlowControl(unittest.TestCase):
+
+    def setUp(self):
+        self.flow = FlowControl()
+        self.flow.max_buffered = 100
+        self.flow.source = Source()
+        self.fast = Request([''])
+        self.slow = Request([''])
+        self.flow.add(self.fast)
+        self.flow.add(self.slow)
+
+    def test_block(self):
+        self.slow.producer.pauseProducing()
+        while not self.flow.source.paused:
+            self.flow.write('x' * 20)
+        self.assertEqual(self.flow.outputs[self.slow].buffered, 120)
+        self.assertEqual(len(''.join(self.fast.written)), 120)
+        self.slow.producer.resumeProducing()
+        self.assertFalse(self.flow.source.paused)
+        self.assertEqual(len(''.join(self.slow.written)), 120)
+
+    def test_drop(self):
+        self.flow.policy = 'drop'
+        self.slow.producer.pauseProducing()
+        for i in range(10):
+            self.flow.write('x' * 20)
+        self.assertFalse(self.flow.source.paused)
+        self.assertEqual(len(''.join(self.fast.written)), 200)
+        output = self.flow.outputs[self.slow]
+        self.assertEqual((output.buffered, output.dropped), (100, 100))
+        self.slow.producer.resumeProducing()
+        self.assertEqual(len(''.join(self.slow.written)), 100)
+
+    def test_finish_after_buffered(self):
+        self.slow.producer.pauseProducing()
+        self.flow.write('data')
+        self.flow.finish()
+        self.assertEqual(self.fast.finished, 1)
+        self.assertEqual(self.slow.finished, 0)
+        self.slow.producer.resumeProducing()
+        self.assertEqual(self.slow.written, ['data'])
+        self.assertEqual(self.slow.finished, 1)
+
+    def test_slow_client_gone(self):
+        self.slow.producer.pauseProducing()
+        self.flow.write('x' * 120)
+        self.assertTrue(self.flow.source.paused)
+        self.flow.remove(self.slow)
+        self.assertFalse(self.flow.source.paused)
+
+    def test_thread_waits(self):
+        self.flow.block()
+        d = threads.deferToThread(self.flow.wait)
+        self.assertFalse(d.called)
+        self.flow.unblock()
+        return d
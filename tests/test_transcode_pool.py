@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{transcode_pool}
+"""
+
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.web.test.requesthelper import DummyRequest
+
+from coherence import transcode_pool
+
+
+class FakeTranscoder(object):
+
+    def __init__(self, fail=False):
+        self.request = None
+        self.fail = fail
+
+    def start(self, request):
+        if self.fail:
+            raise ValueError('no such element')
+        self.request = request
+
+
+class TestTranscoderPool(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(transcode_pool, 'reactor', self.clock)
+        self.pool = transcode_pool.TranscoderPool()
+        self.pool.max_running = 2
+        self.pool.queue_size = 2
+
+    def start(self, name='mp3', priority=None, **kwargs):
+        transcoder = FakeTranscoder(**kwargs)
+        request = DummyRequest([''])
+        self.pool.start(name, transcoder, request, priority)
+        return transcoder, request
+
+    def test_max_running(self):
+        first, request = self.start()
+        second, _ = self.start()
+        third, _ = self.start()
+        self.assertNotIdentical(second.request, None)
+        self.assertIdentical(third.request, None)
+        self.assertEqual(self.pool.running, {'mp3': 2})
+        request.finish()
+        self.assertNotIdentical(third.request, None)
+        self.assertEqual(self.pool.queue, [])
+
+    def test_limit_by_name(self):
+        self.pool.limits['thumb'] = 1
+        self.start('thumb')
+        thumb, _ = self.start('thumb')
+        mp3, _ = self.start('mp3')
+        # a waiting thumbnail doesn't keep the mp3 from its slot
+        self.assertIdentical(thumb.request, None)
+        self.assertNotIdentical(mp3.request, None)
+
+    def test_priority(self):
+        _, request = self.start()
+        self.start()
+        thumb, _ = self.start('thumb', transcode_pool.PRIORITY_BACKGROUND)
+        playback, _ = self.start()
+        request.finish()
+        self.assertIdentical(thumb.request, None)
+        self.assertNotIdentical(playback.request, None)
+
+    def test_queue_full(self):
+        for i in range(4):
+            self.start()
+        self.assertRaises(transcode_pool.TranscoderBusy, self.start)
+        self.assertEqual(self.pool.rejected, 1)
+
+    def test_busy(self):
+        request = DummyRequest([''])
+        body = transcode_pool.Busy(10).render(request)
+        self.assertEqual(request.responseCode, 503)
+        self.assertEqual(request.responseHeaders.getRawHeaders('retry-after'), ['10'])
+        self.assertIn('try again later', body)
+
+    def test_gone_while_waiting(self):
+        self.start()
+        self.start()
+        waiting, request = self.start()
+        request.processingFailed(Exception('gone'))
+        self.assertEqual(self.pool.queue, [])
+
+    def test_start_failed(self):
+        transcoder = FakeTranscoder(fail=True)
+        d = self.pool.start('mp3', transcoder, DummyRequest(['']))
+        self.assertFailure(d, ValueError)
+        self.assertEqual(self.pool.running, {'mp3': 0})
+        return d
+
+    def test_metrics(self):
+        _, first = self.start()
+        self.start()
+        self.start('thumb')
+        self.clock.advance(3)
+        first.finish()
+        self.clock.advance(5)
+        metrics = self.pool.metrics()
+        self.assertEqual(metrics['running'], {'mp3': 1, 'thumb': 1})
+        self.assertEqual(metrics['queue_depth'], 0)
+        self.assertEqual(metrics['wall_time'], {'mp3': 3.0})
+        self.assertEqual(metrics['wait_time'], {'mp3': 0.0})
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{transcode_session}
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+from twisted.web.test.requesthelper import DummyRequest
+
+from coherence import transcode_session, transcode_pool
+from coherence.transcode_flow import FlowControl
+
+
+class FakeTranscoder(object):
+    """ writes what it is told to, keeps track of its instances """
+
+    contentType = 'audio/x-wav'
+    header_size = 4
+    instances = []
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.request = None
+        self.stopped = False
+        self.instances.append(self)
+
+    def start(self, request):
+        self.request = request
+        request.notifyFinish().addBoth(self.requestFinished)
+
+    def requestFinished(self, result):
+        self.stopped = True
+
+    def produce(self, data):
+        self.request.write(data)
+        return deferLater()
+
+    def finish(self):
+        self.request.finish()
+        return deferLater()
+
+
+class ThumbTranscoder(FakeTranscoder):
+    cacheable = False
+
+
+class Request(DummyRequest):
+    """ takes push producers """
+    producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+def deferLater():
+    # the session writes from the next reactor iteration
+    return task.deferLater(reactor, 0, lambda: None)
+
+
+class TestTranscodeSessions(unittest.TestCase):
+
+    def setUp(self):
+        FakeTranscoder.instances = []
+        self.patch(transcode_session, 'pool', transcode_pool.TranscoderPool())
+        self.sessions = transcode_session.TranscodeSessions()
+
+    def render(self, name='wav', transcoder=FakeTranscoder):
+        request = Request([''])
+        shared = self.sessions.resource('http://example.com/song.flac', name, transcoder)
+        shared.render(request)
+        return request
+
+    @defer.inlineCallbacks
+    def test_shared(self):
+        first = self.render()
+        transcoder, = FakeTranscoder.instances
+        yield transcoder.produce('RIFFdata1')
+        second = self.render()
+        yield transcoder.produce('data2')
+        # one transcoder, the header replayed to the second client
+        self.assertEqual(len(FakeTranscoder.instances), 1)
+        self.assertEqual(first.written, ['RIFFdata1', 'data2'])
+        self.assertEqual(second.written, ['RIFF', 'data2'])
+        self.assertEqual(second.responseHeaders.getRawHeaders('content-type'),
+                         ['audio/x-wav'])
+        yield transcoder.finish()
+        self.assertEqual((first.finished, second.finished), (1, 1))
+        self.assertEqual(self.sessions.sessions, {})
+
+    @defer.inlineCallbacks
+    def test_set_header(self):
+        self.render()
+        transcoder, = FakeTranscoder.instances
+        transcoder.request.set_header('OggS')
+        yield transcoder.produce('OggSdata1')
+        request = self.render()
+        self.assertEqual(request.written, ['OggS'])
+
+    @defer.inlineCallbacks
+    def test_last_client_stops(self):
+        first = self.render()
+        second = self.render()
+        transcoder = FakeTranscoder.instances[0]
+        first.processingFailed(Exception('gone'))
+        self.assertFalse(transcoder.stopped)
+        second.processingFailed(Exception('gone'))
+        self.assertTrue(transcoder.stopped)
+        self.assertEqual(self.sessions.sessions, {})
+        # late output of the transcoder goes nowhere
+        yield transcoder.produce('data')
+        self.assertEqual(second.written, [])
+        # the next client starts a new one
+        self.render()
+        self.assertEqual(len(self.sessions.sessions), 1)
+        self.assertNotIdentical(FakeTranscoder.instances[-1].request, None)
+
+    def test_pull_producer_stopped(self):
+        request = self.render()
+        session, = self.sessions.sessions.values()
+        producer = ProcessProducer(session)
+        request.processingFailed(Exception('gone'))
+        self.assertTrue(producer.stopped)
+        self.assertIdentical(session.producer, None)
+
+    @defer.inlineCallbacks
+    def test_slow_client_blocks(self):
+        self.patch(FlowControl, 'max_buffered', 10)
+        fast = self.render()
+        slow = self.render()
+        session, = self.sessions.sessions.values()
+        producer = ProcessProducer(session)
+        transcoder = FakeTranscoder.instances[0]
+        slow.producer.pauseProducing()
+        yield transcoder.produce('RIFF' + 'x' * 8)
+        self.assertTrue(producer.paused)
+        self.assertEqual(''.join(fast.written), 'RIFF' + 'x' * 8)
+        self.assertEqual(slow.written, [])
+        slow.producer.resumeProducing()
+        self.assertFalse(producer.paused)
+        self.assertEqual(''.join(slow.written), 'RIFF' + 'x' * 8)
+
+    def test_not_shared(self):
+        self.assertIdentical(
+            self.sessions.resource('file:///song.flac', 'thumb', ThumbTranscoder), None)
+
+
+class ProcessProducer(object):
+    """ like the ExternalProcessProducer """
+
+    def __init__(self, request):
+        self.paused = False
+        self.stopped = False
+        request.registerProducer(self, True)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def stopProducing(self):
+        self.stopped = True
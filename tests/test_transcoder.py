@@ -71,7 +71,7 @@ class TestTranscoderAutoloading(TranscoderTestMixin, TestCase):
     coherence = self.CoherenceStump(transcoder=self.gst_config)
     self.manager = tc.TranscoderManager(coherence)
     self._check_for_transcoders(known_transcoders)
-    my_pipe = self.manager.select('supertest', 'http://my_uri')
+    my_pipe = self.manager.select('supertest', 'http://my_uri').transcoder
     self.assertTrue(isinstance(my_pipe, tc.GStreamerTranscoder))
     self._check_transcoder_attrs(my_pipe,
                                  pipeline='pp%spppl', uri="http://my_uri")
@@ -85,7 +85,7 @@ class TestTranscoderAutoloading(TranscoderTestMixin, TestCase):
     coherence = self.CoherenceStump(transcoder=self.process_config)
     self.manager = tc.TranscoderManager(coherence)
     self._check_for_transcoders(known_transcoders)
-    transcoder = self.manager.select('megaprocess', 'http://another/uri')
+    transcoder = self.manager.select('megaprocess', 'http://another/uri').transcoder
     self.assertTrue(isinstance(transcoder, tc.ExternalProcessPipeline))
 
     self._check_transcoder_attrs(transcoder, 'uiui%suiui',
@@ -118,13 +118,13 @@ class TestTranscoderAutoloading(TranscoderTestMixin, TestCase):
     self._check_for_transcoders(known_transcoders)
 
     # check the megaprocess
-    transcoder = self.manager.select('megaprocess', 'http://another/uri')
+    transcoder = self.manager.select('megaprocess', 'http://another/uri').transcoder
     self.assertTrue(isinstance(transcoder, tc.ExternalProcessPipeline))
 
     self._check_transcoder_attrs(transcoder, 'uiui%suiui', 'http://another/uri')
 
     # check the gstreamer transcoder
-    transcoder = self.manager.select('supertest', 'http://another/uri2')
+    transcoder = self.manager.select('supertest', 'http://another/uri2').transcoder
     self.assertTrue(isinstance(transcoder, tc.GStreamerTranscoder))
 
     self._check_transcoder_attrs(transcoder, 'pp%spppl', 'http://another/uri2')
@@ -133,11 +133,11 @@ class TestTranscoderAutoloading(TranscoderTestMixin, TestCase):
     coherence = self.CoherenceStump(transcoder=self.gst_config)
     self.manager = tc.TranscoderManager(coherence)
     self._check_for_transcoders(known_transcoders)
-    transcoder_a = self.manager.select('supertest', 'http://my_uri')
+    transcoder_a = self.manager.select('supertest', 'http://my_uri').transcoder
     self.assertTrue(isinstance(transcoder_a, tc.GStreamerTranscoder))
     self._check_transcoder_attrs(transcoder_a, pipeline='pp%spppl', uri="http://my_uri")
 
-    transcoder_b = self.manager.select('supertest', 'http://another/uri')
+    transcoder_b = self.manager.select('supertest', 'http://another/uri').transcoder
     self.assertTrue(isinstance(transcoder_b, tc.GStreamerTranscoder))
     self._check_transcoder_attrs(transcoder_b, pipeline='pp%spppl', uri="http://another/uri")
 
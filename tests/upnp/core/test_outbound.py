@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{upnp.core.outbound}
+"""
+
+from twisted.trial import unittest
+from twisted.internet import reactor, defer
+from twisted.web import server, resource, static
+
+from coherence.upnp.core import outbound, utils
+
+
+class TestOutboundScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = outbound.OutboundScheduler()
+        self.scheduler.configure(max_per_host=2, max_total=3)
+        self.started = []
+
+    def schedule(self, url, priority=outbound.PRIORITY_METADATA):
+        def start():
+            d = defer.Deferred()
+            self.started.append((url, d))
+            return d
+        return self.scheduler.schedule(url, start, priority)
+
+    def finish(self, url, result=None):
+        for entry in self.started:
+            if entry[0] == url:
+                self.started.remove(entry)
+                entry[1].callback(result)
+                return
+
+    def test_caps(self):
+        for i in range(3):
+            self.schedule('http://a/%d' % i)
+        self.schedule('http://b/')
+        self.schedule('http://c/')
+        # two for a, the third slot taken by b
+        self.assertEqual([url for url, d in self.started],
+                         ['http://a/0', 'http://a/1', 'http://b/'])
+        self.finish('http://a/0')
+        self.assertEqual([url for url, d in self.started],
+                         ['http://a/1', 'http://b/', 'http://a/2'])
+        self.finish('http://b/')
+        self.assertEqual(self.started[-1][0], 'http://c/')
+        stats = self.scheduler.stats()
+        self.assertEqual((stats['running'], stats['queued'], stats['max_queued']), (3, 0, 2))
+
+    def test_priority(self):
+        for i in range(3):
+            self.schedule('http://a/%d' % i)
+        self.schedule('http://b/metadata')
+        self.schedule('http://b/playlist', outbound.PRIORITY_PLAYBACK)
+        self.finish('http://a/0')
+        self.assertEqual(self.started[-1][0], 'http://b/playlist')
+
+    def test_result(self):
+        results = []
+        self.schedule('http://a/').addCallback(results.append)
+        failures = []
+        self.schedule('http://a/').addErrback(failures.append)
+        self.finish('http://a/', 'page')
+        self.started.pop()[1].errback(defer.TimeoutError())
+        self.assertEqual(results, ['page'])
+        self.assertEqual(len(failures), 1)
+        stats = self.scheduler.stats()
+        self.assertEqual((stats['started'], stats['failed'], stats['timed_out']), (2, 1, 1))
+
+
+class TestGetPage(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = outbound.OutboundScheduler()
+        self.scheduler.configure(max_per_host=1)
+        self.patch(outbound, 'scheduler', self.scheduler)
+        root = resource.Resource()
+        root.putChild('page', static.Data('page', 'text/plain'))
+        self.port = reactor.listenTCP(0, server.Site(root, timeout=None),
+                                      interface="127.0.0.1")
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def test_scheduled(self):
+        url = "http://127.0.0.1:%d/page" % self.port.getHost().port
+        pages = [utils.getPage(url), utils.getPage(url, priority=outbound.PRIORITY_PLAYBACK)]
+        self.assertEqual(self.scheduler.stats()['queued'], 1)
+        results = yield defer.gatherResults(pages)
+        self.assertEqual([page for page, headers in results], ['page', 'page'])
+        self.assertEqual(self.scheduler.stats()['started'], 2)
+
+    def test_timeout(self):
+        factories = []
+
+        class Factory(object):
+            response_headers = {}
+
+            def __init__(self, url, factoryClass, contextFactory=None, **kwargs):
+                self.kwargs = kwargs
+                self.deferred = defer.succeed(('page', {}))
+                factories.append(self)
+        self.patch(utils.client, '_makeGetterFactory', Factory)
+        downloads = []
+        self.patch(utils.client, 'downloadPage',
+                   lambda url, file, **kwargs: downloads.append(kwargs) or defer.succeed(None))
+        utils.getPage('http://a/description.xml')
+        utils.getPage('http://a/media', timeout=0)
+        utils.getPage('http://a/upload', method='POST', postdata='data')
+        utils.downloadPage('http://a/media', 'media')
+        self.assertEqual([f.kwargs.get('timeout') for f in factories],
+                         [self.scheduler.timeout, 0, None])
+        self.assertFalse('timeout' in downloads[0])
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{upnp.core.page_cache}
+"""
+
+import os
+
+from twisted.trial import unittest
+from twisted.python.filepath import FilePath
+from twisted.internet import reactor, defer
+from twisted.web import server, resource, http, error
+
+from coherence.upnp.core import page_cache, utils
+
+
+class Feed(resource.Resource):
+
+    isLeaf = True
+
+    def __init__(self, body, etag=None, cache_control=None):
+        resource.Resource.__init__(self)
+        self.body = body
+        self.etag = etag
+        self.cache_control = cache_control
+        self.requests = 0
+
+    def render_GET(self, request):
+        self.requests += 1
+        if self.cache_control is not None:
+            request.setHeader('cache-control', self.cache_control)
+        if self.etag is not None and request.setETag(self.etag) == http.CACHED:
+            return ''
+        return self.body
+
+
+class TestPageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = page_cache.PageCache()
+        self.cache.configure(enabled=True, directory=self.mktemp())
+        self.patch(page_cache, 'cache', self.cache)
+        self.feed = Feed('<rss/>', etag='v1')
+        self.fresh = Feed('<genres/>', cache_control='max-age=600')
+        self.private = Feed('<me/>', cache_control='no-store')
+        root = resource.Resource()
+        root.putChild('feed', self.feed)
+        root.putChild('fresh', self.fresh)
+        root.putChild('private', self.private)
+        self.port = reactor.listenTCP(0, server.Site(root, timeout=None),
+                                      interface="127.0.0.1")
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    def url(self, path):
+        return "http://127.0.0.1:%d/%s" % (self.port.getHost().port, path)
+
+    @defer.inlineCallbacks
+    def test_fresh(self):
+        page, headers = yield utils.getPage(self.url('fresh'))
+        page, headers = yield utils.getPage(self.url('fresh'))
+        self.assertEqual(page, '<genres/>')
+        self.assertEqual(self.fresh.requests, 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    @defer.inlineCallbacks
+    def test_revalidated(self):
+        page, headers = yield utils.getPage(self.url('feed'))
+        page, headers = yield utils.getPage(self.url('feed'))
+        self.assertEqual(page, '<rss/>')
+        self.assertEqual(headers['etag'], ['v1'])
+        self.assertEqual(self.feed.requests, 2)
+        self.feed.body, self.feed.etag = '<rss>new</rss>', 'v2'
+        page, headers = yield utils.getPage(self.url('feed'))
+        self.assertEqual(page, '<rss>new</rss>')
+        stats = self.cache.stats()
+        self.assertEqual((stats['requests'], stats['revalidated'], stats['misses']), (3, 1, 2))
+
+    @defer.inlineCallbacks
+    def test_persisted(self):
+        yield utils.getPage(self.url('fresh'))
+        cache = page_cache.PageCache()
+        cache.configure(enabled=True, directory=self.cache.directory)
+        self.patch(page_cache, 'cache', cache)
+        page, headers = yield utils.getPage(self.url('fresh'))
+        self.assertEqual(page, '<genres/>')
+        self.assertEqual(self.fresh.requests, 1)
+
+    @defer.inlineCallbacks
+    def test_coalesced(self):
+        results = yield defer.gatherResults([utils.getPage(self.url('feed')),
+                                             utils.getPage(self.url('feed'))])
+        self.assertEqual([page for page, headers in results], ['<rss/>', '<rss/>'])
+        self.assertEqual(self.feed.requests, 1)
+        self.assertEqual(self.cache.stats()['coalesced'], 1)
+
+    @defer.inlineCallbacks
+    def test_no_store(self):
+        yield utils.getPage(self.url('private'))
+        yield utils.getPage(self.url('private'))
+        self.assertEqual(self.private.requests, 2)
+
+    def test_post_not_cached(self):
+        d = utils.getPage(self.url('fresh'), method='POST', postdata='x')
+        self.assertEqual(self.cache.stats()['requests'], 0)
+        return self.assertFailure(d, error.Error)
+
+    @defer.inlineCallbacks
+    def test_entries_bounded(self):
+        self.cache.max_entries = 1
+        yield utils.getPage(self.url('fresh'))
+        yield utils.getPage(self.url('feed'))
+        self.assertEqual(sorted(os.listdir(self.cache.directory)),
+                         sorted([self.cache.key(self.url('feed'), None),
+                                 self.cache.key(self.url('feed'), None) + '.json']))
+
+    @defer.inlineCallbacks
+    def test_no_directory(self):
+        blocking = FilePath(self.mktemp())
+        blocking.setContent('a file')
+        self.cache.configure(directory=blocking.child('pages').path)
+        page, headers = yield utils.getPage(self.url('fresh'))
+        self.assertEqual(page, '<genres/>')
+        self.assertFalse(self.cache.enabled)
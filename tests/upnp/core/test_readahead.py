@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{upnp.core.readahead}
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.python.filepath import FilePath
+
+from coherence.upnp.core import readahead
+
+CONTENT = ''.join(chr(i % 251) for i in range(100000))
+
+
+class TestReadAhead(unittest.TestCase):
+
+    def setUp(self):
+        path = self.mktemp()
+        FilePath(path).setContent(CONTENT)
+        self.file = open(path, 'rb')
+        self.addCleanup(self.file.close)
+        self.advice = []
+        self.patch(readahead, 'advise',
+                   lambda fd, offset, length, advice: self.advice.append((offset, length, advice)))
+        self.readahead = readahead.ReadAhead(self.file)
+        self.readahead.chunkSize = 4096
+
+    @defer.inlineCallbacks
+    def read(self, offset, size, limit=len(CONTENT)):
+        data = self.readahead.read(offset, size, limit)
+        while isinstance(data, defer.Deferred):
+            yield data
+            data = self.readahead.read(offset, size, limit)
+        defer.returnValue(data)
+
+    @defer.inlineCallbacks
+    def test_random(self):
+        data = yield self.read(50000, 100, 50100)
+        self.assertEqual(data, CONTENT[50000:50100])
+        self.assertEqual([(c.offset, c.end) for c in self.readahead.ring],
+                         [(50000, 50100)])
+        data = yield self.read(10, 10)
+        self.assertEqual(data, CONTENT[10:20])
+        # up to the next chunk boundary
+        self.assertEqual([(c.offset, c.end) for c in self.readahead.ring],
+                         [(10, 4096)])
+        self.assertEqual(self.advice, [])
+
+    @defer.inlineCallbacks
+    def test_sequential(self):
+        position = 0
+        while position < len(CONTENT):
+            data = yield self.read(position, 1000)
+            self.assertEqual(data, CONTENT[position:position + len(data)])
+            position += len(data)
+            if position == 3000:
+                # sequential by now, reading ahead
+                self.assertEqual(len(self.readahead.ring), self.readahead.depth)
+        self.assertEqual(position, len(CONTENT))
+        self.assertEqual(self.advice, [(0, 0, readahead.POSIX_FADV_SEQUENTIAL)])
+
+    @defer.inlineCallbacks
+    def test_short_read(self):
+        data = yield self.read(len(CONTENT) - 10, 100, len(CONTENT) + 100)
+        self.assertEqual(data, CONTENT[-10:])
+        data = yield self.read(len(CONTENT), 100, len(CONTENT) + 100)
+        self.assertEqual(data, '')
+        # the end is remembered, not read again
+        self.assertEqual(self.readahead.read(len(CONTENT), 100, len(CONTENT) + 100), '')
+
+    @defer.inlineCallbacks
+    def test_failed_read(self):
+        def pread(size, offset):
+            raise IOError(5, 'Input/output error')
+        self.readahead.pread = pread
+        data = yield self.read(0, 100, 1000)
+        self.assertEqual(data, '')
+        self.assertEqual(self.readahead.read(0, 100, 1000), '')
+
+    def test_will_need(self):
+        window = self.readahead.chunkSize * self.readahead.depth
+        self.readahead.will_need(0, len(CONTENT))
+        self.readahead.will_need(1000, len(CONTENT))
+        self.readahead.will_need(window / 2 + 1, len(CONTENT))
+        self.assertEqual(self.advice, [
+            (0, 0, readahead.POSIX_FADV_SEQUENTIAL),
+            (0, window, readahead.POSIX_FADV_WILLNEED),
+            (window, window / 2 + 1, readahead.POSIX_FADV_WILLNEED)])
+
+    def test_stop_waits_for_reads(self):
+        self.readahead.read(0, 100, 100)
+        d = self.readahead.stop()
+        self.assertEqual(self.readahead.ring, readahead.deque())
+        return d
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{upnp.core.shaping}
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from coherence.upnp.core import shaping
+
+
+class FakeRequest(object):
+    """ a request whose client takes at most bandwidth bytes per window """
+
+    window = 0.05
+
+    def __init__(self, clock, bandwidth=None):
+        self.clock = clock
+        self.bandwidth = bandwidth
+        self.producer = None
+        self.sentLength = 0
+        self.taken = 0
+        self.finished = False
+
+    def getClientIP(self):
+        return '192.168.1.20'
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.sentLength += len(data)
+        if self.bandwidth is None:
+            return
+        self.taken += len(data)
+        if self.taken >= self.bandwidth:
+            self.taken = 0
+            self.producer.pauseProducing()
+            self.clock.callLater(self.window, self.producer.resumeProducing)
+
+    def finish(self):
+        self.finished = True
+
+
+class PullProducer(object):
+
+    def __init__(self, request, size, chunk=1000):
+        self.request = request
+        self.size = size
+        self.chunk = chunk
+        self.written = 0
+
+    def resumeProducing(self):
+        if not self.request:
+            return
+        self.request.write('x' * self.chunk)
+        self.written += self.chunk
+        if self.written >= self.size:
+            self.request.unregisterProducer()
+            self.request.finish()
+            self.stopProducing()
+
+    def stopProducing(self):
+        self.request = None
+
+
+class PushProducer(object):
+
+    paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def stopProducing(self):
+        pass
+
+
+class TestStreamScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(shaping, 'reactor', self.clock)
+        coop = task.Cooperator(scheduler=lambda f: self.clock.callLater(0, f))
+        self.scheduler = shaping.StreamScheduler(cooperate=coop.cooperate)
+
+    def tearDown(self):
+        for connection_id in list(self.scheduler.streams):
+            self.scheduler.remove(connection_id)
+
+    def start(self, connection_id, rate=0, bandwidth=None, size=10 ** 9):
+        request = FakeRequest(self.clock, bandwidth)
+        self.scheduler.add(connection_id, request, rate)
+        shaping.register_producer(request, PullProducer(request, size), False)
+        return request
+
+    def run_for(self, seconds):
+        for _ in range(int(seconds / 0.01)):
+            self.clock.advance(0.01)
+
+    def test_fair_shares(self):
+        shares = self.scheduler.fair_shares({'a': None, 'b': 10, 'c': None}, 100.0)
+        self.assertEqual(shares, {'a': 45.0, 'b': 10, 'c': 45.0})
+        shares = self.scheduler.fair_shares({'a': None, 'b': 10}, None)
+        self.assertEqual(shares, {'a': None, 'b': 10})
+
+    def test_unlimited_not_shaped(self):
+        request = FakeRequest(self.clock)
+        self.scheduler.add(1, request)
+        producer = PushProducer()
+        shaping.register_producer(request, producer, True)
+        self.assertIs(request.producer, producer)
+
+    def test_pull_producer_waiting(self):
+        self.patch(shaping.scheduler, 'cooperate', self.scheduler.cooperate)
+        request = FakeRequest(self.clock)
+        producer = PullProducer(request, 5000)
+        data = defer.Deferred()
+        resume = producer.resumeProducing
+        calls = []
+
+        def waiting_resumeProducing():
+            calls.append(1)
+            if not data.called:
+                return data
+            resume()
+        producer.resumeProducing = waiting_resumeProducing
+        shaping.register_producer(request, producer, False)
+        self.clock.advance(1)
+        self.assertEqual(calls, [1])
+        self.assertEqual(request.sentLength, 0)
+        data.callback(None)
+        self.clock.advance(1)
+        self.assertTrue(request.finished)
+        self.assertEqual(request.sentLength, 5000)
+
+    def test_shared_fairly(self):
+        self.scheduler.rate = 100000
+        r1 = self.start(1)
+        r2 = self.start(2)
+        self.run_for(2)
+        self.assertApproximates(r1.sentLength, 100000, 10000)
+        self.assertApproximates(r2.sentLength, 100000, 10000)
+
+    def test_rate_cap(self):
+        r1 = self.start(1, rate=20000)
+        self.run_for(2)
+        self.assertApproximates(r1.sentLength, 40000, 4000)
+
+    def test_push_producer_throttled(self):
+        request = FakeRequest(self.clock)
+        self.scheduler.add(1, request, 20000)
+        producer = PushProducer()
+        shaping.register_producer(request, producer, True)
+        request.write('x' * 3000)
+        self.clock.advance(0.05)
+        self.assertTrue(producer.paused)
+        # 2000 bytes over, paid off with the credit of two more ticks
+        self.clock.advance(0.05)
+        self.assertTrue(producer.paused)
+        self.clock.advance(0.05)
+        self.assertFalse(producer.paused)
+
+    def test_slow_client_leaves_its_share(self):
+        self.scheduler.rate = 100000
+        self.scheduler.min_demand = 500
+        fast = self.start(1)
+        slow = self.start(2, bandwidth=1000)
+        self.run_for(2)
+        # the slow one gets about the 20000 bytes/s it takes, the fast
+        # one all but some headroom left to the slow one
+        self.assertApproximates(slow.sentLength, 40000, 8000)
+        self.assertTrue(fast.sentLength > 115000)
+
+    def test_finished(self):
+        self.scheduler.rate = 100000
+        request = self.start(1, size=20000)
+        self.run_for(1)
+        self.assertTrue(request.finished)
+        self.assertEqual(request.sentLength, 20000)
+        stream = self.scheduler.remove(1)
+        self.assertEqual(self.scheduler.streams, {})
+        self.assertEqual(self.scheduler._ticker, None)
+        metrics = stream.metrics()
+        self.assertEqual(metrics['bytes_sent'], 20000)
+        self.assertEqual(metrics['client'], '192.168.1.20')
+        self.assertTrue(metrics['throttled_time'] > 0)
@@ -12,6 +12,7 @@ Test cases for L{upnp.core.sspd}
 import time
 
 from twisted.trial import unittest
+from twisted.internet import task
 from twisted.test import proto_helpers
 
 from coherence.upnp.core import ssdp
@@ -123,3 +124,146 @@ class TestSSDP(unittest.TestCase):
         self.assertEqual((host, port), (SSDP_ADDR, SSDP_PORT))
         recieved = data.splitlines(True)
         self.assertEqual(sorted(recieved), sorted(expected))
+
+
+USN_2 = 'uuid:4e7c5d38::urn:schemas-upnp-org:device:MediaServer:1'
+SSDP_MSEARCH_2 = (
+    'M-SEARCH * HTTP/1.1',
+    'HOST: 239.255.255.250:1900',
+    'MAN: "ssdp:discover"',
+    'MX: 0',
+    'ST: urn:schemas-upnp-org:device:MediaServer:1',
+    )
+
+
+class TestSSDPDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(ssdp, 'reactor', self.clock)
+        self.proto = ssdp.SSDPServer(test=True)
+        self.tr = proto_helpers.FakeDatagramTransport()
+        self.proto.makeConnection(self.tr)
+        self.proto.register('local', USN_2,
+                            'urn:schemas-upnp-org:device:MediaServer:1',
+                            'http://10.20.30.1:30020/4e7c5d38/')
+        del self.tr.written[:]
+
+    def _search(self, *lines, **kwargs):
+        data = '\r\n'.join(lines) + '\r\n\r\n'
+        self.proto.datagramReceived(data, ('10.20.30.40', kwargs.get('port', 1234)))
+        self.clock.advance(0)
+
+    def test_discovery_response(self):
+        self._search(*SSDP_MSEARCH_2)
+        self.assertEqual(len(self.tr.written), 1)
+        data, (host, port) = self.tr.written[0]
+        self.assertEqual((host, port), ('10.20.30.40', 1234))
+        lines = data.split('\r\n')
+        self.assertEqual(lines[0], 'HTTP/1.1 200 OK')
+        self.assertEqual(lines[-2:], ['', ''])
+        self.assertIn('USN: ' + USN_2, lines)
+        self.assertTrue(lines[-3].startswith('DATE: '))
+        self.assertNotIn('last-seen', data)
+
+    def test_discovery_ignores_remote_entries(self):
+        data = '\r\n'.join(SSDP_NOTIFY_1) + '\r\n\r\n'
+        self.proto.datagramReceived(data, ('10.20.30.40', 1234))
+        self._search('M-SEARCH * HTTP/1.1', 'MX: 0', 'ST: upnp:rootdevice')
+        self.assertEqual(self.tr.written, [])
+
+    def test_discovery_all_skips_silent(self):
+        self.proto.register('local', 'uuid:silent::upnp:rootdevice',
+                            'upnp:rootdevice', 'http://10.20.30.1/',
+                            silent=True)
+        self._search('M-SEARCH * HTTP/1.1', 'MX: 0', 'ST: ssdp:all')
+        self.assertEqual(len(self.tr.written), 1)
+        self.assertIn('USN: ' + USN_2, self.tr.written[0][0])
+
+    def test_discovery_after_unregister(self):
+        self.proto.unRegister(USN_2)
+        self._search(*SSDP_MSEARCH_2)
+        self.assertEqual(self.tr.written, [])
+
+    def test_discovery_batches_responses(self):
+        self.proto.register('local', 'uuid:4e7c5d38::upnp:rootdevice',
+                            'upnp:rootdevice', 'http://10.20.30.1/')
+        del self.tr.written[:]
+        data = '\r\n'.join(('M-SEARCH * HTTP/1.1', 'MX: 3', 'ST: ssdp:all'))
+        self.proto.datagramReceived(data + '\r\n\r\n', ('10.20.30.40', 1234))
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(3)
+        self.assertEqual(len(self.tr.written), 2)
+
+    def test_discovery_ignores_repeated_search(self):
+        self._search(*SSDP_MSEARCH_2)
+        self._search(*SSDP_MSEARCH_2)
+        self.assertEqual(len(self.tr.written), 1)
+        self.clock.advance(1)
+        self._search(*SSDP_MSEARCH_2)
+        self.assertEqual(len(self.tr.written), 2)
+
+    def test_discovery_search_from_other_port(self):
+        # another control point on the same host
+        self._search(*SSDP_MSEARCH_2)
+        self._search(*SSDP_MSEARCH_2, port=5678)
+        self.assertEqual([destination for _, destination in self.tr.written],
+                         [('10.20.30.40', 1234), ('10.20.30.40', 5678)])
+
+    def test_discovery_rate_limit(self):
+        self.proto.response_burst = 1
+        self.proto.response_rate = 1.0
+        self.proto._tokens = 1.0
+        self.proto.register('local', 'uuid:4e7c5d38::upnp:rootdevice',
+                            'upnp:rootdevice', 'http://10.20.30.1/')
+        del self.tr.written[:]
+        self._search('M-SEARCH * HTTP/1.1', 'MX: 0', 'ST: ssdp:all')
+        self.assertEqual(len(self.tr.written), 1)
+        self.clock.advance(1)
+        self.assertEqual(len(self.tr.written), 2)
+
+
+class TestSSDPExpiry(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(ssdp, 'reactor', self.clock)
+        self.proto = ssdp.SSDPServer(test=True)
+        self.tr = proto_helpers.FakeDatagramTransport()
+        self.proto.makeConnection(self.tr)
+        data = '\r\n'.join(SSDP_NOTIFY_1) + '\r\n\r\n'
+        self.proto.datagramReceived(data, ('10.20.30.40', 1234))
+
+    def test_parse_max_age(self):
+        self.assertEqual(ssdp.parse_max_age('max-age=1842'), 1842)
+        self.assertEqual(ssdp.parse_max_age('max-age = 60'), 60)
+        self.assertEqual(ssdp.parse_max_age('no-cache="Ext", max-age=90'), 90)
+        self.assertEqual(ssdp.parse_max_age('no-cache'), 1800)
+
+    def test_expires_after_max_age(self):
+        self.clock.advance(1842)
+        self.proto.check_valid()
+        self.assertTrue(self.proto.isKnown(USN_1))
+        self.clock.advance(ssdp.EXPIRY_GRACE)
+        self.proto.check_valid()
+        self.assertFalse(self.proto.isKnown(USN_1))
+        self.assertEqual(self.proto._expiry, {})
+
+    def test_notify_postpones_expiry(self):
+        self.clock.advance(1000)
+        data = '\r\n'.join(SSDP_NOTIFY_1) + '\r\n\r\n'
+        self.proto.datagramReceived(data, ('10.20.30.40', 1234))
+        self.clock.advance(1842 + ssdp.EXPIRY_GRACE - 1000)
+        self.proto.check_valid()
+        self.assertTrue(self.proto.isKnown(USN_1))
+        self.clock.advance(1000)
+        self.proto.check_valid()
+        self.assertFalse(self.proto.isKnown(USN_1))
+
+    def test_byebye_forgets_expiry(self):
+        data = '\r\n'.join(SSDP_NOTIFY_1).replace('ssdp:alive', 'ssdp:byebye')
+        self.proto.datagramReceived(data + '\r\n\r\n', ('10.20.30.40', 1234))
+        self.assertFalse(self.proto.isKnown(USN_1))
+        self.clock.advance(1842 + ssdp.EXPIRY_GRACE)
+        self.proto.check_valid()
+        self.assertEqual(self.proto._expiry_heap, [])
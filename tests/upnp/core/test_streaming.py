@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{upnp.core.streaming}
+"""
+
+import os
+
+from twisted.trial import unittest
+from twisted.python.filepath import FilePath
+from twisted.internet import reactor, defer
+from twisted.web import server, resource
+from twisted.web.client import Agent, readBody
+from twisted.web.http_headers import Headers
+
+from coherence.upnp.core import streaming
+
+CONTENT = ''.join(chr(i % 251) for i in range(300000))
+
+
+class TestMediaFile(unittest.TestCase):
+
+    def _listen(self, site):
+        return reactor.listenTCP(0, site, interface="127.0.0.1")
+
+    def setUp(self):
+        name = self.mktemp()
+        os.mkdir(name)
+        path = FilePath(name).child("media")
+        path.setContent(CONTENT)
+        root = resource.Resource()
+        self.path = path
+        root.putChild('media', streaming.MediaFile(path.path))
+        self.site = server.Site(root, timeout=None)
+        self.port = self._listen(self.site)
+        self.portno = self.port.getHost().port
+
+    def tearDown(self):
+        streaming.open_files.clear()
+        return self.port.stopListening()
+
+    def getURL(self, path):
+        return "http://127.0.0.1:%d/%s" % (self.portno, path)
+
+    def fetch(self, path, **headers):
+        headers = Headers(dict((k, [v]) for k, v in headers.items()))
+        d = Agent(reactor).request('GET', self.getURL(path), headers)
+
+        def got_response(response):
+            d = readBody(response)
+            d.addCallback(lambda body: (body, response))
+            return d
+        d.addCallback(got_response)
+        return d
+
+    def assertBody(self, result, content, code=200):
+        data, response = result
+        self.assertEqual(response.code, code)
+        self.assertEqual(len(data), len(content))
+        self.assertEqual(data, content)
+        return result
+
+    def test_full(self):
+        d = self.fetch('media')
+        d.addCallback(self.assertBody, CONTENT)
+        return d
+
+    def test_range(self):
+        d = self.fetch('media', range='bytes=1000-199999')
+        d.addCallback(self.assertBody, CONTENT[1000:200000], 206)
+
+        def check_headers(result):
+            self.assertEqual(result[1].headers.getRawHeaders('content-range'),
+                             ['bytes 1000-199999/%d' % len(CONTENT)])
+        d.addCallback(check_headers)
+        return d
+
+    def test_suffix_range(self):
+        d = self.fetch('media', range='bytes=-500')
+        d.addCallback(self.assertBody, CONTENT[-500:], 206)
+        return d
+
+    def test_full_uses_sendfile(self):
+        if streaming.sendfile is None:
+            raise unittest.SkipTest("sendfile not available")
+        sent = []
+
+        def counting_sendfile(*args):
+            count = real_sendfile(*args)
+            sent.append(count)
+            return count
+        real_sendfile = streaming.sendfile
+        self.patch(streaming, 'sendfile', counting_sendfile)
+        d = self.fetch('media')
+        d.addCallback(self.assertBody, CONTENT)
+        d.addCallback(lambda _: self.assertTrue(sum(sent) > 0))
+        return d
+
+    def test_full_without_sendfile(self):
+        self.patch(streaming, 'sendfile', None)
+        d = self.fetch('media')
+        d.addCallback(self.assertBody, CONTENT)
+        return d
+
+    def test_range_without_sendfile(self):
+        self.patch(streaming, 'sendfile', None)
+        d = self.fetch('media', range='bytes=70000-')
+        d.addCallback(self.assertBody, CONTENT[70000:], 206)
+        return d
+
+    def test_multiple_ranges(self):
+        d = self.fetch('media', range='bytes=0-9,-10')
+
+        def check(result):
+            body, response = result
+            self.assertEqual(response.code, 206)
+            content_type = response.headers.getRawHeaders('content-type')[0]
+            self.assertTrue(content_type.startswith('multipart/byteranges'))
+            self.assertIn(CONTENT[:10], body)
+            self.assertIn(CONTENT[-10:], body)
+        d.addCallback(check)
+        return d
+
+    def test_etag_not_modified(self):
+        etag = streaming.MediaFile(self.path.path).getETag()
+        d = self.fetch('media', **{'if-none-match': etag})
+        d.addCallback(self.assertBody, '', 304)
+        return d
+
+    def test_if_match_failed(self):
+        d = self.fetch('media', **{'if-match': '"0-0"'})
+        d.addCallback(self.assertBody, '', 412)
+        return d
+
+    def test_if_range_outdated(self):
+        d = self.fetch('media', range='bytes=0-9', **{'if-range': '"0-0"'})
+        d.addCallback(self.assertBody, CONTENT)
+        return d
+
+    def test_if_range_current(self):
+        etag = streaming.MediaFile(self.path.path).getETag()
+        d = self.fetch('media', range='bytes=0-9', **{'if-range': etag})
+        d.addCallback(self.assertBody, CONTENT[:10], 206)
+        return d
+
+    def test_concurrent_requests_share_file(self):
+        d = defer.gatherResults([self.fetch('media'),
+                                 self.fetch('media', range='bytes=100-')])
+
+        def check(results):
+            self.assertBody(results[0], CONTENT)
+            self.assertBody(results[1], CONTENT[100:], 206)
+            shared = streaming.open_files.files[self.path.path]
+            self.assertEqual(shared.refs, 0)
+        d.addCallback(check)
+        return d
+
+
+class TestOpenFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        FilePath(self.path).setContent(CONTENT)
+        self.files = streaming.OpenFiles()
+
+    def test_shared(self):
+        h1 = self.files.open(self.path)
+        h2 = self.files.open(self.path)
+        self.assertIs(h1.shared, h2.shared)
+        h1.seek(10)
+        self.assertEqual(h2.read(5), CONTENT[:5])
+        self.assertEqual(h1.read(5), CONTENT[10:15])
+        self.assertEqual(h1.tell(), 15)
+        h1.seek(-5, 2)
+        self.assertEqual(h1.read(), CONTENT[-5:])
+
+    def test_kept_open_when_idle(self):
+        h1 = self.files.open(self.path)
+        h2 = self.files.open(self.path)
+        shared = h1.shared
+        h1.close()
+        h1.close()
+        h2.close()
+        self.assertEqual(shared.refs, 0)
+        self.assertNotEqual(shared.fd, None)
+        self.assertIs(self.files.open(self.path).shared, shared)
+
+    def test_least_recently_used_closed(self):
+        self.files.max_idle = 2
+        paths = [self.mktemp() for _ in range(3)]
+        shared = []
+        for path in paths:
+            FilePath(path).setContent(CONTENT)
+            handle = self.files.open(path)
+            shared.append(handle.shared)
+            handle.close()
+        self.assertEqual(shared[0].fd, None)
+        self.assertEqual(sorted(self.files.files), sorted(paths[1:]))
+
+    def test_stat_cached(self):
+        handle = self.files.open(self.path)
+        handle.close()
+        self.patch(os, 'stat', lambda path: self.fail("stat called"))
+        self.assertEqual(self.files.stat(self.path).st_size, len(CONTENT))
+        self.assertTrue(self.files.exists(self.path))
+
+    def test_modified_file_reopened(self):
+        now = [1000.0]
+        self.files.clock = lambda: now[0]
+        handle = self.files.open(self.path)
+        shared = handle.shared
+        FilePath(self.path).setContent('changed')
+        # within stat_lifetime the cached result is used
+        self.assertEqual(self.files.stat(self.path).st_size, len(CONTENT))
+        now[0] += self.files.stat_lifetime + 1
+        self.assertEqual(self.files.stat(self.path).st_size, len('changed'))
+        # the running request keeps reading the file it opened
+        self.assertNotEqual(shared.fd, None)
+        handle.close()
+        self.assertEqual(shared.fd, None)
+        self.assertEqual(self.files.open(self.path).read(), 'changed')
+
+    def test_invalidate(self):
+        handle = self.files.open(self.path)
+        shared = handle.shared
+        handle.close()
+        self.files.invalidate(self.path)
+        self.assertEqual(shared.fd, None)
+        self.assertEqual(self.files.files, {})
+        os.unlink(self.path)
+        self.assertFalse(self.files.exists(self.path))
+        self.assertRaises(IOError, self.files.open, self.path)
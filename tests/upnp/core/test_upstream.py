@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{upnp.core.upstream}
+"""
+
+from twisted.trial import unittest
+from twisted.python.filepath import FilePath
+from twisted.internet import reactor, defer, error, protocol
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.web import server, resource, static
+from twisted.web.client import Agent, readBody
+from twisted.web.http_headers import Headers
+from twisted.web.test.requesthelper import DummyRequest
+
+from coherence.upnp.core import upstream, utils
+
+
+class CountingSite(server.Site):
+
+    connections = 0
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        return server.Site.buildProtocol(self, addr)
+
+
+class Shoutcast(protocol.Protocol):
+
+    def dataReceived(self, data):
+        if '\r\n\r\n' in data:
+            self.transport.write('ICY 200 OK\r\nicy-name: radio\r\n'
+                                 'content-type: audio/mpeg\r\n\r\nmusic')
+            self.transport.loseConnection()
+
+
+class Response(object):
+
+    code = 200
+    phrase = 'OK'
+
+    def __init__(self):
+        self.headers = Headers()
+        self.body = None
+
+    def deliverBody(self, protocol):
+        self.body = protocol
+        protocol.makeConnection(proto_helpers.StringTransport())
+
+
+class TestUpstreamPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = upstream.UpstreamPool()
+        self.patch(upstream, 'pool', self.pool)
+        media = FilePath(self.mktemp())
+        media.setContent('0123456789')
+        files = resource.Resource()
+        files.putChild('media', static.File(media.path))
+        self.upstream = CountingSite(files, timeout=None)
+        self.upstream_port = reactor.listenTCP(0, self.upstream, interface="127.0.0.1")
+        factory = protocol.ServerFactory()
+        factory.protocol = Shoutcast
+        self.shoutcast_port = reactor.listenTCP(0, factory, interface="127.0.0.1")
+        root = resource.Resource()
+        root.putChild('media', utils.ReverseProxyResource(
+            '127.0.0.1', self.upstream_port.getHost().port, '/media'))
+        root.putChild('radio', utils.ReverseProxyResource(
+            '127.0.0.1', self.shoutcast_port.getHost().port, '/'))
+        self.port = reactor.listenTCP(0, server.Site(root, timeout=None),
+                                      interface="127.0.0.1")
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.pool.shutdown()
+        yield self.port.stopListening()
+        yield self.upstream_port.stopListening()
+        yield self.shoutcast_port.stopListening()
+
+    @defer.inlineCallbacks
+    def fetch(self, path, headers=None):
+        url = "http://127.0.0.1:%d/%s" % (self.port.getHost().port, path)
+        response = yield Agent(reactor).request('GET', url, Headers(headers or {}))
+        body = yield readBody(response)
+        defer.returnValue((response, body))
+
+    @defer.inlineCallbacks
+    def test_keep_alive(self):
+        response, body = yield self.fetch('media')
+        self.assertEqual(body, '0123456789')
+        response, body = yield self.fetch('media', {'range': ['bytes=4-']})
+        self.assertEqual(response.code, 206)
+        self.assertEqual(body, '456789')
+        self.assertEqual(response.headers.getRawHeaders('content-range'),
+                         ['bytes 4-9/10'])
+        self.assertEqual(self.upstream.connections, 1)
+
+    @defer.inlineCallbacks
+    def test_icy(self):
+        port = self.shoutcast_port.getHost().port
+        response, body = yield self.fetch('radio')
+        self.assertEqual(body, 'music')
+        self.assertEqual(response.headers.getRawHeaders('content-type'), ['audio/mpeg'])
+        self.assertFalse(response.headers.hasHeader('icy-name'))
+        self.assertTrue(self.pool.is_legacy('127.0.0.1', port))
+        response, body = yield self.fetch('radio')
+        self.assertEqual(body, 'music')
+
+    @defer.inlineCallbacks
+    def test_bad_gateway(self):
+        yield self.upstream_port.stopListening()
+        response, body = yield self.fetch('media')
+        self.assertEqual(response.code, 502)
+
+    def test_client_gone(self):
+        requested = defer.Deferred()
+        self.patch(self.pool, 'request', lambda *args: requested)
+        request = DummyRequest(['media'])
+        request.registerProducer = lambda producer, streaming: None
+        d = self.pool.forward(request, '127.0.0.1', 80, '/media')
+        response = Response()
+        requested.callback(response)
+        response.body.dataReceived('01234')
+        # the client went away in the middle of the stream
+        request.processingFailed(failure.Failure(error.ConnectionDone()))
+        self.assertEqual(response.body.transport.producerState, 'stopped')
+        response.body.connectionLost(failure.Failure(error.ConnectionDone()))
+        self.assertEqual(request.written, ['01234'])
+        return d
@@ -13,7 +13,9 @@ import os
 from twisted.trial import unittest
 from twisted.python.filepath import FilePath
 from twisted.internet import reactor
-from twisted.web import static, server
+from twisted.web import static, server, resource
+from twisted.web.client import Agent, readBody
+from twisted.web.http_headers import Headers
 from twisted.protocols import policies
 
 from coherence.upnp.core import utils
@@ -171,5 +173,100 @@ class TestClient(unittest.TestCase):
         return d
 
 
+class TestGrowingFile(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        FilePath(self.path).setContent('01234')
+
+    def test_initial_size(self):
+        growing = utils.GrowingFile(self.path, 10)
+        self.assertEqual(growing.size, 5)
+        self.assertFalse(growing.finished)
+
+    def test_wait_for_available(self):
+        growing = utils.GrowingFile(self.path, 10)
+        d = growing.wait_for(4)
+        self.assertEqual(self.successResultOf(d), 5)
+
+    def test_wait_for_written(self):
+        growing = utils.GrowingFile(self.path, 10)
+        d1 = growing.wait_for(7)
+        d2 = growing.wait_for(5)
+        self.assertNoResult(d1)
+        self.assertNoResult(d2)
+        growing.written(1)
+        self.assertEqual(self.successResultOf(d2), 6)
+        self.assertNoResult(d1)
+        growing.finish()
+        self.assertEqual(self.successResultOf(d1), 6)
+
+    def test_cancelled_waiter(self):
+        growing = utils.GrowingFile(self.path, 10)
+        d = growing.wait_for(7)
+        d.cancel()
+        self.failureResultOf(d)
+        growing.written(5)
+
+
+class TestBufferFile(unittest.TestCase):
+
+    content = ''.join(chr(i % 251) for i in range(200000))
+
+    def setUp(self):
+        self.path = self.mktemp()
+        FilePath(self.path).setContent(self.content[:1000])
+        self.growing = utils.GrowingFile(self.path, len(self.content))
+        root = resource.Resource()
+        root.putChild('buffer', utils.BufferFile(self.path, len(self.content),
+                                                 growing_file=self.growing))
+        self.port = reactor.listenTCP(0, server.Site(root, timeout=None),
+                                      interface="127.0.0.1")
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    def fetch(self, **headers):
+        url = "http://127.0.0.1:%d/buffer" % self.port.getHost().port
+        headers = Headers(dict((k, [v]) for k, v in headers.items()))
+        d = Agent(reactor).request('GET', url, headers)
+        d.addCallback(readBody)
+        return d
+
+    def grow(self, end):
+        f = open(self.path, 'ab')
+        f.write(self.content[self.growing.size:end])
+        f.close()
+        self.growing.written(end - self.growing.size)
+
+    def test_streams_growing_file(self):
+        d = self.fetch()
+        reactor.callLater(0.05, self.grow, 50000)
+        reactor.callLater(0.1, self.grow, len(self.content))
+        reactor.callLater(0.1, self.growing.finish)
+        d.addCallback(self.assertEqual, self.content)
+        return d
+
+    def test_range_waits_for_data(self):
+        d = self.fetch(range='bytes=150000-')
+        reactor.callLater(0.05, self.grow, 100000)
+        reactor.callLater(0.1, self.grow, len(self.content))
+        d.addCallback(self.assertEqual, self.content[150000:])
+        return d
+
+    def test_suffix_range(self):
+        self.grow(len(self.content))
+        self.growing.finish()
+        d = self.fetch(range='bytes=-100')
+        d.addCallback(self.assertEqual, self.content[-100:])
+        return d
+
+    def test_multiple_ranges_send_everything(self):
+        self.grow(len(self.content))
+        self.growing.finish()
+        d = self.fetch(range='bytes=0-10,20-30')
+        d.addCallback(self.assertEqual, self.content)
+        return d
+
 
 # $Id:$